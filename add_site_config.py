@@ -9,13 +9,23 @@ Creates site-specific Django settings files. Creates configuration
 file for supervisor (http://supervisord.org/), which allows to
 start wwwhisper application under the control of the supervisor
 daemon. Initializes database to store access control list.
+
+In batch mode (--manifest) many sites are configured in parallel by
+a pool of processes. The database schema is then created only once,
+in a template database, which is copied for each site. Pool workers
+set up Django once and create initial data of each site directly in
+its copy of the database (migrate is not run for each site).
 """
 
 import getopt
+import multiprocessing
 import os
+import shutil
 import sys
 import random
 import subprocess
+import tempfile
+import time
 
 from urlparse import urlparse
 
@@ -24,12 +34,19 @@ DJANGO_CONFIG_DIR = 'django'
 DJANGO_CONFIG_FILE = 'site_settings.py'
 SUPERVISOR_CONFIG_DIR = 'supervisor'
 SUPERVISOR_CONFIG_FILE= 'site.conf'
+UWSGI_PROFILE_FILE = 'uwsgi_profile'
 DB_DIR = 'db'
 DB_NAME = 'acl_db'
 
 WWWHISPER_USER = 'wwwhisper'
 WWWHISPER_GROUP = 'www-data'
 DEFAULT_INITIAL_LOCATIONS = ['/', '/wwwhisper/admin/']
+# Threads allow a worker to serve auth requests while another request
+# is blocked (on sending a token email or on a cache reload).
+DEFAULT_THREADS = 4
+
+class ProvisioningError(Exception):
+    pass
 
 def err_quit(errmsg):
     """Prints an error message and quits."""
@@ -60,7 +77,21 @@ Usage:
       -o, --output-dir A directory to store configuration (defaults to
             '%(config-dir)s' in the wwwhisper directory).
       -n, --no-supervisor Do not generate config file for supervisord.
-""" % {'prog': sys.argv[0], 'config-dir': SITES_DIR}
+      -p, --processes A number of uWSGI worker processes (defaults to
+            the number of CPU cores).
+      -t, --threads A number of threads in each worker process
+            (defaults to %(threads)d).
+      -m, --manifest A file with sites to configure, used instead of
+            --site-url and --admin-email. Each line describes a single
+            site:
+              site-url admin-email[,admin-email...] [location[,location...]]
+            Empty lines and lines starting with # are ignored. If
+            locations are not given, --location values (or defaults)
+            are used.
+      -j, --jobs A number of sites configured in parallel in batch mode
+            (defaults to the number of CPU cores).
+""" % {'prog': sys.argv[0], 'config-dir': SITES_DIR,
+     'threads': DEFAULT_THREADS}
     sys.exit(1)
 
 def generate_secret_key():
@@ -95,24 +126,19 @@ def generate_secret_key():
 def write_to_file(dir_path, file_name, file_content):
     """Writes a string to a file with a given name in a given directory.
 
-    If the file does not exist it is created. Dies on error.
+    If the file does not exist it is created. Raises ProvisioningError
+    on error.
     """
     file_path = os.path.join(dir_path, file_name)
     try:
         with open(file_path, 'w') as destination:
             destination.write(file_content)
     except IOError as ex:
-        err_quit('Failed to create file %s: %s.' % (file_path, ex))
+        raise ProvisioningError(
+            'Failed to create file %s: %s.' % (file_path, ex))
 
-def create_django_config_file(site_url, emails, locations, django_config_path,
-                              db_path):
-    """Creates a site specific Django configuration file.
-
-    Settings that are common for all sites reside in the
-    wwwhisper_service module.
-    """
-
-    settings = """# Don't share this with anybody.
+def django_db_settings(db_file_path):
+    return """# Don't share this with anybody.
 SECRET_KEY = '%s'
 
 DATABASES = {
@@ -121,13 +147,21 @@ DATABASES = {
         'NAME': '%s',
     }
 }
+""" % (generate_secret_key(), db_file_path)
 
+def create_django_config_file(site_url, emails, locations, django_config_path,
+                              db_path):
+    """Creates a site specific Django configuration file.
+
+    Settings that are common for all sites reside in the
+    wwwhisper_service module.
+    """
+
+    settings = django_db_settings(os.path.join(db_path, DB_NAME)) + """
 WWWHISPER_INITIAL_SITE_URL = '%s'
 WWWHISPER_INITIAL_ADMINS = (%s,)
 WWWHISPER_INITIAL_LOCATIONS = (%s,)
-""" % (generate_secret_key(),
-       os.path.join(db_path, DB_NAME),
-       site_url,
+""" % (site_url,
        ", ".join("'" + email + "'" for email in emails),
        ", ".join("'" + location + "'" for location in locations))
     write_to_file(django_config_path, '__init__.py', '')
@@ -164,35 +198,68 @@ stopasgroup=true
     write_to_file(
         supervisor_config_path, SUPERVISOR_CONFIG_FILE, settings)
 
+def default_processes():
+    """Returns a number of worker processes sized to the core count."""
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+def create_uwsgi_profile_file(processes, threads, site_config_path):
+    """Creates a file with uWSGI workers settings.
+
+    The file is sourced by run_wwwhisper_for_site.sh.
+    """
+    settings = """WWWHISPER_PROCESSES=%d
+WWWHISPER_THREADS=%d
+""" % (processes, threads)
+    write_to_file(site_config_path, UWSGI_PROFILE_FILE, settings)
+
+def parse_positive_int(option, arg):
+    """Parses a positive integer option argument. Dies on error."""
+    try:
+        value = int(arg)
+    except ValueError:
+        value = 0
+    if value < 1:
+        err_quit('%s should be a positive integer.' % option)
+    return value
+
 def parse_url(url):
     """Parses and validates a URL.
 
     URL needs to have scheme://hostname:port format, scheme and hostname
     are mandatory, port is optional. Converts scheme and hostname to
     lower case and returns scheme, hostname, port (as string) tupple.
-    Dies if the URL is invalid.
+    Raises ProvisioningError if the URL is invalid.
     """
 
     err_prefix = 'Invalid site address - '
     parsed_url = urlparse(url)
     scheme = parsed_url.scheme.lower()
     if scheme == '' or scheme not in ('https', 'http'):
-        err_quit(err_prefix + 'scheme missing. '
-                 'URL schould start with https:// (recommended) or http://')
+        raise ProvisioningError(
+            err_prefix + 'scheme missing. '
+            'URL schould start with https:// (recommended) or http://')
     if parsed_url.hostname is None:
-        err_quit(err_prefix + 'host name missing.'
-                 'URL should include full host name (like https://foo.org).')
+        raise ProvisioningError(
+            err_prefix + 'host name missing.'
+            'URL should include full host name (like https://foo.org).')
     if parsed_url.path  != '':
-        err_quit(err_prefix + 'URL should not include resource path '
-                 '(/foo/bar).')
+        raise ProvisioningError(err_prefix + 'URL should not include '
+                                'resource path (/foo/bar).')
     if parsed_url.params  != '':
-        err_quit(err_prefix + 'URL should not include parameters (;foo=bar).')
+        raise ProvisioningError(
+            err_prefix + 'URL should not include parameters (;foo=bar).')
     if parsed_url.query  != '':
-        err_quit(err_prefix + 'URL should not include query (?foo=bar).')
+        raise ProvisioningError(
+            err_prefix + 'URL should not include query (?foo=bar).')
     if parsed_url.fragment  != '':
-        err_quit(err_prefix + 'URL should not include query (#foo).')
+        raise ProvisioningError(
+            err_prefix + 'URL should not include query (#foo).')
     if parsed_url.username != None:
-        err_quit(err_prefix + 'URL should not include username (foo@).')
+        raise ProvisioningError(
+            err_prefix + 'URL should not include username (foo@).')
 
     hostname = parsed_url.hostname.lower()
     port = None
@@ -203,6 +270,211 @@ def parse_url(url):
 
     return (scheme, hostname, port)
 
+def run_migrate(wwwhisper_path, django_config_path, quiet=False):
+    """Creates tables and initial data in a database of a site.
+
+    If quiet is True, the output is printed only on error.
+    """
+    manage_path = os.path.join(wwwhisper_path, 'manage.py')
+    # Use Python from the virtual environment to run syncdb.
+    migrate = subprocess.Popen(
+        ['/usr/bin/env', 'python', manage_path, 'migrate',
+         '--run-syncdb', '--pythonpath=' + django_config_path],
+        stdout=subprocess.PIPE if quiet else None,
+        stderr=subprocess.STDOUT if quiet else None)
+    output = migrate.communicate()[0]
+    if migrate.returncode != 0:
+        raise ProvisioningError('Failed to initialize wwwhisper database.%s'
+                                % ('\n' + output if output else ''))
+
+def create_template_db(wwwhisper_path, template_dir):
+    """Creates a database with all tables, but without any site.
+
+    Returns a path to the database file and a path to a directory
+    with Django settings that use it.
+    """
+    django_config_path = os.path.join(template_dir, DJANGO_CONFIG_DIR)
+    os.makedirs(django_config_path)
+    db_file_path = os.path.join(template_dir, DB_NAME)
+    write_to_file(django_config_path, '__init__.py', '')
+    write_to_file(django_config_path, DJANGO_CONFIG_FILE,
+                  django_db_settings(db_file_path))
+    run_migrate(wwwhisper_path, django_config_path, quiet=True)
+    return (db_file_path, django_config_path)
+
+def setup_django(wwwhisper_path, django_config_path):
+    """Sets up Django in the current process (pool initializer).
+
+    Settings are taken from a given configuration directory (of the
+    template database), create_initial_data then switches the
+    database to a database of each site.
+    """
+    sys.path[:0] = [wwwhisper_path, django_config_path]
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'wwwhisper_service.settings'
+    import django
+    django.setup()
+
+def create_initial_data(db_file_path, site_url, emails, locations):
+    """Creates a site, admins and locations in a database of a site.
+
+    The database needs to have all tables already (a copy of the
+    template database) and setup_django needs to be called first.
+    """
+    from django.core.exceptions import ImproperlyConfigured
+    from django.db import connection
+    from django.db import transaction
+    from wwwhisper_admin.appconfig import create_initial_site
+    connection.close()
+    connection.settings_dict['NAME'] = db_file_path
+    try:
+        with transaction.atomic():
+            create_initial_site(site_url, emails, locations)
+    except ImproperlyConfigured as ex:
+        raise ProvisioningError(str(ex))
+    finally:
+        connection.close()
+
+def provision_site(site_url, emails, locations, output_path, wwwhisper_path,
+                   need_supervisor, processes, threads, template_db=None):
+    """Generates configuration files and a database for a site.
+
+    If template_db is given, the database is copied from it, and
+    initial site data is created in the copy directly (tables already
+    exist, setup_django needs to be called first).
+
+    Returns a name of the site configuration directory. Raises
+    ProvisioningError on error. On any error after the configuration
+    directory is created, the directory is removed, so provisioning
+    can be repeated.
+    """
+    (scheme, hostname, port) = parse_url(site_url)
+    site_url = scheme + '://' + hostname
+    # URL should include the port number only if it is non-default.
+    if not is_default_port(scheme, port):
+        site_url += ":" + port
+    # But settings directory name should always include the port.
+    site_dir_name = '.'.join([scheme, hostname, port])
+
+    site_config_path = os.path.join(output_path, site_dir_name)
+    django_config_path = os.path.join(site_config_path, DJANGO_CONFIG_DIR)
+    db_path = os.path.join(site_config_path, DB_DIR)
+    supervisor_config_path = os.path.join(
+        site_config_path, SUPERVISOR_CONFIG_DIR)
+    try:
+        os.umask(067)
+        os.makedirs(site_config_path, 0710)
+    except OSError as ex:
+        raise ProvisioningError(
+            'Failed to initialize configuration directory %s: %s.'
+            % (site_config_path, ex))
+    try:
+        try:
+            os.umask(077)
+            os.makedirs(django_config_path)
+            os.makedirs(db_path)
+            if need_supervisor:
+                os.makedirs(supervisor_config_path)
+        except OSError as ex:
+            raise ProvisioningError(
+                'Failed to initialize configuration directory %s: %s.'
+                % (site_config_path, ex))
+
+        create_django_config_file(
+            site_url, emails, locations, django_config_path, db_path)
+        create_uwsgi_profile_file(processes, threads, site_config_path)
+
+        if need_supervisor:
+            create_supervisor_config_file(
+                site_dir_name, wwwhisper_path, site_config_path,
+                supervisor_config_path)
+
+        if template_db is None:
+            run_migrate(wwwhisper_path, django_config_path)
+            return site_dir_name
+        db_file_path = os.path.join(db_path, DB_NAME)
+        try:
+            shutil.copyfile(template_db, db_file_path)
+        except IOError as ex:
+            raise ProvisioningError(
+                'Failed to copy template database: %s.' % ex)
+        create_initial_data(db_file_path, site_url, emails, locations)
+        return site_dir_name
+    except:
+        # Partially configured site would make a next attempt fail.
+        shutil.rmtree(site_config_path, ignore_errors=True)
+        raise
+
+def parse_manifest(manifest_path, default_locations):
+    """Returns a list of (site url, emails, locations) tuples."""
+    sites = []
+    try:
+        with open(manifest_path) as manifest:
+            for (line_num, line) in enumerate(manifest, 1):
+                fields = line.split()
+                if not fields or fields[0].startswith('#'):
+                    continue
+                if len(fields) not in (2, 3):
+                    err_quit('%s:%d: expected site-url, admin emails and '
+                             'optional locations.' % (manifest_path, line_num))
+                locations = default_locations
+                if len(fields) == 3:
+                    locations = fields[2].split(',')
+                sites.append((fields[0], fields[1].split(','), locations))
+    except IOError as ex:
+        err_quit('Failed to read manifest %s: %s.' % (manifest_path, ex))
+    return sites
+
+def _provision_site_timed(args):
+    """Pool task, returns (site url, seconds, error message or None)."""
+    start = time.time()
+    error = None
+    try:
+        provision_site(*args)
+    except ProvisioningError as ex:
+        error = str(ex)
+    except Exception as ex:
+        error = 'Unexpected error: %s' % ex
+    return (args[0], time.time() - start, error)
+
+def provision_sites(sites, jobs, output_path, wwwhisper_path,
+                    need_supervisor, processes, threads):
+    """Configures many sites in parallel, reports time taken by each.
+
+    Returns True if all sites were successfully configured.
+    """
+    start = time.time()
+    template_dir = tempfile.mkdtemp()
+    try:
+        try:
+            (template_db, template_config_path) = create_template_db(
+                wwwhisper_path, template_dir)
+        except ProvisioningError as ex:
+            err_quit('Failed to create template database: %s' % ex)
+        print 'Template database created in %.2fs.' % (time.time() - start)
+        tasks = [(site_url, emails, locations, output_path, wwwhisper_path,
+                  need_supervisor, processes, threads, template_db)
+                 for (site_url, emails, locations) in sites]
+        pool = multiprocessing.Pool(
+            jobs, setup_django, (wwwhisper_path, template_config_path))
+        failed = 0
+        try:
+            for (site_url, seconds, error) in pool.imap_unordered(
+                _provision_site_timed, tasks):
+                if error is None:
+                    print '%s: configured in %.2fs.' % (site_url, seconds)
+                else:
+                    failed += 1
+                    print >> sys.stderr, '%s: failed after %.2fs: %s' % (
+                        site_url, seconds, error)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        shutil.rmtree(template_dir)
+    print '%d of %d sites configured in %.2fs.' % (
+        len(sites) - failed, len(sites), time.time() - start)
+    return failed == 0
+
 def main():
     site_url = None
     emails = []
@@ -210,16 +482,24 @@ def main():
     wwwhisper_path = os.path.dirname(os.path.abspath(sys.argv[0]))
     output_path = os.path.join(wwwhisper_path, SITES_DIR)
     need_supervisor = True
+    processes = default_processes()
+    threads = DEFAULT_THREADS
+    manifest_path = None
+    jobs = default_processes()
 
     try:
         optlist, _ = getopt.gnu_getopt(
             sys.argv[1:],
-            's:a:l:o:nh',
+            's:a:l:o:np:t:m:j:h',
             ['site-url=',
              'admin-email=',
              'locations=',
              'output-dir=',
              'no-supervisor',
+             'processes=',
+             'threads=',
+             'manifest=',
+             'jobs=',
              'help'])
 
     except getopt.GetoptError, ex:
@@ -239,57 +519,41 @@ def main():
             output_path = arg
         elif opt in ('-n', '--no-supervisor'):
             need_supervisor = False
+        elif opt in ('-p', '--processes'):
+            processes = parse_positive_int(opt, arg)
+        elif opt in ('-t', '--threads'):
+            threads = parse_positive_int(opt, arg)
+        elif opt in ('-m', '--manifest'):
+            manifest_path = arg
+        elif opt in ('-j', '--jobs'):
+            jobs = parse_positive_int(opt, arg)
         else:
             assert False, 'unhandled option'
 
 
+    if not locations:
+        locations += DEFAULT_INITIAL_LOCATIONS
+
+    if manifest_path is not None:
+        if site_url is not None or emails:
+            err_quit('--manifest can not be used with --site-url and '
+                     '--admin-email.')
+        sites = parse_manifest(manifest_path, locations)
+        if not provision_sites(sites, jobs, output_path, wwwhisper_path,
+                               need_supervisor, processes, threads):
+            sys.exit(1)
+        return
+
     if site_url is None:
         err_quit('--site-url is missing.')
     if not emails:
         err_quit('--admin-email is missing.')
-    if not locations:
-        locations += DEFAULT_INITIAL_LOCATIONS
-
-    (scheme, hostname, port) = parse_url(site_url)
-    site_url = scheme + '://' + hostname
-    # URL should include the port number only if it is non-default.
-    if not is_default_port(scheme, port):
-        site_url += ":" + port
-    # But settings directory name should always include the port.
-    site_dir_name = '.'.join([scheme, hostname, port])
 
-    site_config_path = os.path.join(output_path, site_dir_name)
-    django_config_path = os.path.join(site_config_path, DJANGO_CONFIG_DIR)
-    db_path = os.path.join(site_config_path, DB_DIR)
-    supervisor_config_path = os.path.join(
-        site_config_path, SUPERVISOR_CONFIG_DIR)
     try:
-        os.umask(067)
-        os.makedirs(site_config_path, 0710)
-        os.umask(077)
-        os.makedirs(django_config_path)
-        os.makedirs(db_path)
-        if need_supervisor:
-            os.makedirs(supervisor_config_path)
-    except OSError as ex:
-        err_quit('Failed to initialize configuration directory %s: %s.'
-                 % (site_config_path, ex))
-
-    create_django_config_file(
-        site_url, emails, locations, django_config_path, db_path)
-
-    if need_supervisor:
-        create_supervisor_config_file(
-            site_dir_name, wwwhisper_path, site_config_path,
-            supervisor_config_path)
-
-    manage_path = os.path.join(wwwhisper_path, 'manage.py')
-    # Use Python from the virtual environment to run syncdb.
-    exit_status = subprocess.call(
-        ['/usr/bin/env', 'python', manage_path, 'migrate',
-         '--run-syncdb', '--pythonpath=' + django_config_path])
-    if exit_status != 0:
-        err_quit('Failed to initialize wwwhisper database.');
+        provision_site(site_url, emails, locations, output_path,
+                       wwwhisper_path, need_supervisor, processes, threads)
+    except ProvisioningError as ex:
+        err_quit(str(ex))
 
     print 'Site configuration successfully created.'
 
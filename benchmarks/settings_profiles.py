@@ -0,0 +1,156 @@
+#!/usr/bin/env python
+
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Compares startup and per-request costs of Django settings profiles.
+
+Each profile is measured in a fresh process that uses an in-memory
+sqlite DB. Reported are: time to load Django and the WSGI application
+(including the first request, which imports the URL conf), max RSS of
+the process, number of loaded modules and the mean time of
+is-authorized requests (served with all middlewares of the profile).
+
+Example usage (from the wwwhisper root directory):
+    python benchmarks/settings_profiles.py \\
+       wwwhisper_service.settings wwwhisper_service.auth_node_settings
+"""
+
+import getopt
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+DEFAULT_PROFILES = ['wwwhisper_service.settings',
+                    'wwwhisper_service.auth_node_settings']
+SITE_URL = 'https://bench.example.com'
+
+SITE_SETTINGS = """
+SECRET_KEY = 'benchmark-only-secret-key'
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+WWWHISPER_PRELOAD_SITES = False
+"""
+
+def err_quit(errmsg):
+    """Prints an error message and quits."""
+    print >> sys.stderr, errmsg
+    sys.exit(1)
+
+def usage():
+    print """
+
+Compares startup and per-request costs of Django settings profiles.
+
+Usage:
+
+  %(prog)s [-n requests] [settings_module ...]
+      -n, --requests
+          Number of measured requests to each endpoint (default 2000).
+""" % {'prog': sys.argv[0]}
+    sys.exit(1)
+
+def _time_requests(client, path, expected_status, requests):
+    for _ in xrange(requests / 10):
+        client.get(path, HTTP_SITE_URL=SITE_URL)
+    start = time.time()
+    for _ in xrange(requests):
+        response = client.get(path, HTTP_SITE_URL=SITE_URL)
+    elapsed = time.time() - start
+    if response.status_code != expected_status:
+        err_quit('Unexpected status %d for %s'
+                 % (response.status_code, path))
+    return elapsed / requests
+
+def measure(requests):
+    """Runs in a child process configured with a measured profile."""
+    start = time.time()
+    import django
+    django.setup()
+    from wwwhisper_service.wsgi import application
+    startup = time.time() - start
+
+    from django.core.management import call_command
+    from django.test.client import Client
+    from wwwhisper_auth.models import SitesCollection, SINGLE_SITE_ID
+    call_command('migrate', run_syncdb=True, verbosity=0)
+    site = SitesCollection().create_item(SINGLE_SITE_ID)
+    site.aliases.create_item(SITE_URL)
+    site.locations.create_item('/open/').grant_open_access()
+    site.locations.create_item('/protected/')
+    client = Client()
+    # The first request imports the URL conf and views.
+    start = time.time()
+    client.get('/wwwhisper/auth/api/is-authorized/?path=/open/',
+               HTTP_SITE_URL=SITE_URL)
+    startup += time.time() - start
+    modules = len(sys.modules)
+
+    open_path = '/wwwhisper/auth/api/is-authorized/?path=/open/'
+    protected_path = '/wwwhisper/auth/api/is-authorized/?path=/protected/'
+    open_time = _time_requests(client, open_path, 200, requests)
+    protected_time = _time_requests(client, protected_path, 401, requests)
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    print '%f %d %d %f %f' % (
+        startup, rss, modules, open_time, protected_time)
+
+def run_profile(settings_module, site_settings_dir, requests):
+    env = dict(os.environ)
+    env['DJANGO_SETTINGS_MODULE'] = settings_module
+    env['PYTHONPATH'] = os.pathsep.join(
+        [site_settings_dir, ROOT_DIR, env.get('PYTHONPATH', '')])
+    output = subprocess.check_output(
+        [sys.executable, os.path.realpath(__file__), '--child',
+         '-n', str(requests)], env=env, cwd=ROOT_DIR)
+    startup, rss, modules, open_time, protected_time = output.split()[-5:]
+    return (float(startup), int(rss), int(modules),
+            float(open_time), float(protected_time))
+
+def main():
+    requests = 2000
+    child = False
+    try:
+        optlist, args = getopt.gnu_getopt(
+            sys.argv[1:], 'n:h', ['requests=', 'child', 'help'])
+    except getopt.GetoptError, ex:
+        print 'Arguments parsing error: ', ex,
+        usage()
+    for opt, arg in optlist:
+        if opt in ('-h', '--help'):
+            usage()
+        elif opt in ('-n', '--requests'):
+            requests = int(arg)
+        elif opt == '--child':
+            child = True
+    if child:
+        measure(requests)
+        return
+
+    site_settings_dir = tempfile.mkdtemp()
+    try:
+        with open(os.path.join(site_settings_dir, 'site_settings.py'),
+                  'w') as out:
+            out.write(SITE_SETTINGS)
+        print '%-40s %10s %10s %8s %12s %12s' % (
+            'profile', 'startup ms', 'RSS KB', 'modules',
+            'open us/req', '401 us/req')
+        for settings_module in args or DEFAULT_PROFILES:
+            startup, rss, modules, open_time, protected_time = run_profile(
+                settings_module, site_settings_dir, requests)
+            print '%-40s %10.1f %10d %8d %12.1f %12.1f' % (
+                settings_module, startup * 1000, rss, modules,
+                open_time * 1e6, protected_time * 1e6)
+    finally:
+        shutil.rmtree(site_settings_dir)
+
+if __name__ == '__main__':
+    main()
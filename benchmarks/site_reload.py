@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Measures time and memory needed to load a site with all its data.
+
+Creates a site with a given number of users, locations and
+permissions in an in-memory sqlite DB, then loads the site (as the
+site cache does after the site is modified) several times. Reported
+memory is the growth of the process RSS per loaded site copy.
+
+Example usage (from the wwwhisper root directory):
+    python benchmarks/site_reload.py -u 10000 -l 1000 -g 100000
+"""
+
+import getopt
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+SITE_ID = 'https://bench.example.com'
+
+SITE_SETTINGS = """
+SECRET_KEY = 'benchmark-only-secret-key'
+DATABASES = {
+    'default': {
+        'ENGINE': 'django.db.backends.sqlite3',
+        'NAME': ':memory:',
+    }
+}
+WWWHISPER_PRELOAD_SITES = False
+"""
+
+def usage():
+    print """
+
+Measures time and memory needed to load a site with all its data.
+
+Usage:
+
+  %(prog)s [-u users] [-l locations] [-g grants] [-n loads] [-d] [-t]
+      -u, --users
+          Number of users of the site (default 10000).
+      -l, --locations
+          Number of locations of the site (default 1000).
+      -g, --grants
+          Number of permissions, randomly assigned (default 100000).
+      -n, --loads
+          Number of measured loads (default 5).
+      -d, --disk
+          Load the site from the on-disk snapshot cache instead of the
+          DB (see wwwhisper_auth/snapshot_cache.py).
+      -t, --team
+          Grant all users access to all locations through a single
+          group, instead of with per user permissions (-g is ignored).
+""" % {'prog': sys.argv[0]}
+    sys.exit(1)
+
+def rss_kb():
+    with open('/proc/self/statm') as statm:
+        pages = int(statm.read().split()[1])
+    return pages * os.sysconf('SC_PAGE_SIZE') / 1024
+
+def setup_django(site_settings_dir):
+    with open(os.path.join(site_settings_dir, 'site_settings.py'), 'w') as out:
+        out.write(SITE_SETTINGS)
+    sys.path[0:0] = [site_settings_dir, ROOT_DIR]
+    os.environ['DJANGO_SETTINGS_MODULE'] = 'wwwhisper_service.settings'
+    import django
+    django.setup()
+    from django.core.management import call_command
+    call_command('migrate', run_syncdb=True, verbosity=0)
+
+def create_site(users, locations, grants, team):
+    from wwwhisper_auth.models import Location, Permission, User
+    from wwwhisper_auth.models import Group, GroupMembership, GroupPermission
+    from wwwhisper_auth.models import SitesCollection
+    import random
+    import uuid
+    site = SitesCollection().create_item(SITE_ID)
+    User.objects.bulk_create(
+        User(site_id=SITE_ID, uuid=str(uuid.uuid4()),
+             email='user%d@example.com' % i) for i in xrange(users))
+    Location.objects.bulk_create(
+        Location(site_id=SITE_ID, uuid=str(uuid.uuid4()), path='/loc%d/' % i)
+        for i in xrange(locations))
+    user_ids = list(User.objects.values_list('id', flat=True))
+    location_ids = list(Location.objects.values_list('id', flat=True))
+    if team:
+        group = Group.objects.create(
+            site_id=SITE_ID, uuid=str(uuid.uuid4()), name='team')
+        GroupMembership.objects.bulk_create(
+            (GroupMembership(site_id=SITE_ID, group_id=group.id,
+                             user_id=user_id) for user_id in user_ids),
+            batch_size=500)
+        GroupPermission.objects.bulk_create(
+            GroupPermission(site_id=SITE_ID, group_id=group.id,
+                            http_location_id=location_id)
+            for location_id in location_ids)
+        site.site_modified()
+        return
+    random.seed(0)
+    pairs = set()
+    while len(pairs) < min(grants, users * locations):
+        pairs.add((random.choice(location_ids), random.choice(user_ids)))
+    Permission.objects.bulk_create(
+        (Permission(site_id=SITE_ID, http_location_id=location_id,
+                    user_id=user_id) for (location_id, user_id) in pairs),
+        batch_size=500)
+    site.site_modified()
+
+def measure(loads, snapshot_dir):
+    from wwwhisper_auth.models import SitesCollection
+    from wwwhisper_auth.snapshot_cache import SnapshotCache
+    import gc
+    find_item = SitesCollection().find_item
+    if snapshot_dir is not None:
+        snapshots = SnapshotCache(snapshot_dir)
+        snapshots.store(find_item(SITE_ID))
+        find_item = snapshots.load
+    # Not measured, loads all modules used by the load.
+    find_item(SITE_ID).locations.find_location('/loc1/')
+    gc.collect()
+    times = []
+    loaded = []
+    rss_before = rss_kb()
+    for _ in xrange(loads):
+        start = time.time()
+        loaded.append(find_item(SITE_ID))
+        times.append(time.time() - start)
+    gc.collect()
+    return sorted(times)[len(times) / 2], (rss_kb() - rss_before) / loads
+
+def main():
+    users, locations, grants, loads = 10000, 1000, 100000, 5
+    disk = False
+    team = False
+    try:
+        optlist, args = getopt.gnu_getopt(
+            sys.argv[1:], 'u:l:g:n:dth',
+            ['users=', 'locations=', 'grants=', 'loads=', 'disk', 'team',
+             'help'])
+    except getopt.GetoptError, ex:
+        print 'Arguments parsing error: ', ex,
+        usage()
+    for opt, arg in optlist:
+        if opt in ('-h', '--help'):
+            usage()
+        elif opt in ('-u', '--users'):
+            users = int(arg)
+        elif opt in ('-l', '--locations'):
+            locations = int(arg)
+        elif opt in ('-g', '--grants'):
+            grants = int(arg)
+        elif opt in ('-n', '--loads'):
+            loads = int(arg)
+        elif opt in ('-d', '--disk'):
+            disk = True
+        elif opt in ('-t', '--team'):
+            team = True
+
+    site_settings_dir = tempfile.mkdtemp()
+    try:
+        setup_django(site_settings_dir)
+        create_site(users, locations, grants, team)
+        median_time, rss_per_site = measure(
+            loads, site_settings_dir if disk else None)
+        print ('users %d, locations %d, %s%s: '
+               'load %.1f ms (median), %d KB RSS per site' % (
+                users, locations,
+                'team group' if team else 'grants %d' % grants,
+                ' (from disk)' if disk else '',
+                median_time * 1000, rss_per_site))
+    finally:
+        shutil.rmtree(site_settings_dir)
+
+if __name__ == '__main__':
+    main()
@@ -59,12 +59,33 @@ assert_dir_exists ${SITE_DIR}
 source ${VIRTUALENV_DIR}/bin/activate \
     || err_quit "Failed to activate virtualenv in ${VIRTUALENV_DIR}."
 
+# Workers profile generated by 'add_site_config.py' (sets
+# WWWHISPER_PROCESSES and WWWHISPER_THREADS). Values set in the
+# environment take precedence over the profile.
+PROCESSES=${WWWHISPER_PROCESSES}
+THREADS=${WWWHISPER_THREADS}
+if [[ -f "${SITE_DIR}/uwsgi_profile" ]]; then
+    source "${SITE_DIR}/uwsgi_profile"
+fi
+PROCESSES=${PROCESSES:-${WWWHISPER_PROCESSES:-$(nproc)}}
+THREADS=${THREADS:-${WWWHISPER_THREADS:-4}}
+# wwwhisper_service.auth_node_settings runs a process that serves only
+# the auth API (the admin API then needs a separate instance).
+SETTINGS_MODULE=${WWWHISPER_SETTINGS_MODULE:-wwwhisper_service.settings}
+
+# The application is loaded by the master before workers are forked
+# (--lazy-apps is not used), so sites preloaded into the cache are
+# shared copy-on-write by all workers and no worker starts cold.
 exec uwsgi  --socket="${SITE_DIR}/uwsgi.sock"\
  --chdir="${SCRIPT_DIR}/"\
  --module="wwwhisper_service.wsgi:application"\
+ --env="DJANGO_SETTINGS_MODULE=${SETTINGS_MODULE}"\
  --master\
  --vacuum\
- --processes=1\
+ --processes="${PROCESSES}"\
+ --threads="${THREADS}"\
+ --enable-threads\
+ --py-call-osafterfork\
  --chmod-socket=660\
  --buffer-size=16384\
  --plugins=python\
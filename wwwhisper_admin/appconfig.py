@@ -10,21 +10,20 @@ from django.core.exceptions import ImproperlyConfigured
 
 SITE_URL = getattr(settings, 'WWWHISPER_INITIAL_SITE_URL', None)
 
-def _create_site():
-    """Creates a site configured in settings.py."""
+def _create_site(site_url):
+    """Creates a site with a given alias."""
     from wwwhisper_auth import models as auth_models
     try:
         site =  auth_models.SitesCollection().create_item(
             auth_models.SINGLE_SITE_ID)
-        site.aliases.create_item(SITE_URL)
+        site.aliases.create_item(site_url)
         return site
     except ValidationError as ex:
         raise ImproperlyConfigured('Failed to create site %s: %s'
-                                   % (SITE_URL, ex))
+                                   % (site_url, ex))
 
-def _create_initial_locations(site):
-    """Creates all locations listed in WWWHISPER_INITIAL_LOCATIONS setting."""
-    locations_paths = getattr(settings, 'WWWHISPER_INITIAL_LOCATIONS', [])
+def _create_initial_locations(site, locations_paths):
+    """Creates all locations with given paths."""
     for path in locations_paths:
         try:
             site.locations.create_item(path)
@@ -32,9 +31,8 @@ def _create_initial_locations(site):
             raise ImproperlyConfigured('Failed to create location %s: %s'
                                        % (path, ', '.join(ex.messages)))
 
-def _create_initial_admins(site):
-    """Creates all users listed in WWWHISPER_INITIAL_ADMINS setting."""
-    emails = getattr(settings, 'WWWHISPER_INITIAL_ADMINS', [])
+def _create_initial_admins(site, emails):
+    """Creates all users with given emails."""
     for email in emails:
         try:
             user = site.users.create_item(email)
@@ -47,6 +45,16 @@ def _grant_admins_access_to_all_locations(site):
         for location in site.locations.all():
             location.grant_access(user.uuid)
 
+def create_initial_site(site_url, emails, locations_paths):
+    """Creates a site that admins can access at given locations.
+
+    Raises ImproperlyConfigured if any of the items is invalid.
+    """
+    site = _create_site(site_url)
+    _create_initial_locations(site, locations_paths)
+    _create_initial_admins(site, emails)
+    _grant_admins_access_to_all_locations(site)
+
 def grant_initial_permission(sender, *args, **kwargs):
     """Configures initial permissions for wwwhisper protected site.
 
@@ -58,12 +66,11 @@ def grant_initial_permission(sender, *args, **kwargs):
     manages access to itself, so it can be used to add and remove
     users that can perform administrative operations.
     """
-    from wwwhisper_auth import models as auth_models
     if kwargs.get('interactive', True):
-        site = _create_site()
-        _create_initial_locations(site)
-        _create_initial_admins(site)
-        _grant_admins_access_to_all_locations(site)
+        create_initial_site(
+            SITE_URL,
+            getattr(settings, 'WWWHISPER_INITIAL_ADMINS', []),
+            getattr(settings, 'WWWHISPER_INITIAL_LOCATIONS', []))
 
 
 
@@ -93,6 +93,18 @@ class UserTest(AdminViewTestCase):
         self.assertEqual(404, response.status_code)
         self.assertRegexpMatches(response.content, 'User not found')
 
+    def test_add_user_with_expiration(self):
+        response = self.post('/wwwhisper/admin/api/users/',
+                             {'email': TEST_USER_EMAIL,
+                              'expiresAt': '2030-01-02T03:04:05'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('2030-01-02T03:04:05',
+                         json.loads(response.content)['expiresAt'])
+        response = self.post('/wwwhisper/admin/api/users/',
+                             {'email': 'bar@example.com',
+                              'expires_at': '2030-01-02T03:04:05'})
+        self.assertEqual(400, response.status_code)
+
     def test_add_user_invalid_email(self):
         response = self.post('/wwwhisper/admin/api/users/',
                              {'email' : 'foo.bar'})
@@ -407,6 +419,59 @@ class AccessControlTest(AdminViewTestCase):
 
         self.assertFalse(self.can_access(location_url, user_uuid))
 
+    def test_grant_access_with_expiration(self):
+        location_url = self.add_location()['self']
+        user_uuid = extract_uuid(self.add_user()['id'])
+        allowed_url = location_url + 'allowed-users/' + user_uuid + '/'
+        response = self.put(allowed_url, {'expiresAt': '2030-01-02T03:04:05'})
+        self.assertEqual(201, response.status_code)
+        self.assertEqual('2030-01-02T03:04:05',
+                         json.loads(response.content)['expiresAt'])
+        self.assertEqual(
+            '2030-01-02T03:04:05',
+            json.loads(self.get(allowed_url).content)['expiresAt'])
+        response = self.put(allowed_url, {'expiresAt': 'tomorrow'})
+        self.assertEqual(400, response.status_code)
+        self.assertRegexpMatches(response.content,
+                                 'Invalid expiration time format')
+        # Granting without expiresAt makes the access permanent.
+        response = self.put(allowed_url)
+        self.assertEqual(200, response.status_code)
+        self.assertNotIn('expiresAt', json.loads(response.content))
+
+    def test_grant_and_revoke_domain_access(self):
+        location_url = self.add_location()['self']
+        allowed_url = location_url + 'allowed-domains/example.org/'
+        self.assertEqual(404, self.get(allowed_url).status_code)
+
+        response = self.put(location_url + 'allowed-domains/Example.ORG/')
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(allowed_url, response['Location'])
+        self.assertEqual('example.org',
+                         json.loads(response.content)['domain'])
+        self.assertEqual(200, self.put(allowed_url).status_code)
+        self.assertEqual(200, self.get(allowed_url).status_code)
+        self.assertEqual(['example.org'], json.loads(
+                self.get(location_url).content)['allowedDomains'])
+
+        self.assertEqual(204, self.delete(allowed_url).status_code)
+        response = self.delete(allowed_url)
+        self.assertEqual(404, response.status_code)
+        self.assertRegexpMatches(response.content,
+                                 'Domain can not access location')
+        self.assertEqual([], json.loads(
+                self.get(location_url).content)['allowedDomains'])
+
+    def test_grant_access_to_invalid_domain(self):
+        location_url = self.add_location()['self']
+        response = self.put(location_url + 'allowed-domains/example/')
+        self.assertEqual(400, response.status_code)
+        self.assertRegexpMatches(response.content, 'Invalid domain format')
+        response = self.put(
+            '/wwwhisper/admin/api/locations/%s/allowed-domains/example.org/'
+            % FAKE_UUID)
+        self.assertEqual(404, response.status_code)
+
 
 class AliasTest(AdminViewTestCase):
 
@@ -458,6 +523,104 @@ class AliasTest(AdminViewTestCase):
                                'https://foo.example.org:8080'],
                               [item['url'] for item in aliases])
 
+class GroupTest(AdminViewTestCase):
+
+    def add_group(self, name='staff'):
+        response = self.post('/wwwhisper/admin/api/groups/', {'name' : name})
+        self.assertEqual(201, response.status_code)
+        return json.loads(response.content)
+
+    def test_add_group(self):
+        response = self.post('/wwwhisper/admin/api/groups/',
+                             {'name' : 'staff'})
+        self.assertEqual(201, response.status_code)
+        parsed_response_body = json.loads(response.content)
+        group_uuid = extract_uuid(parsed_response_body['id'])
+        self.assertEqual('staff', parsed_response_body['name'])
+        self.assertEqual([], parsed_response_body['members'])
+        self_url = '%s/wwwhisper/admin/api/groups/%s/' % (
+            TEST_SITE, group_uuid)
+        self.assertEqual(self_url, parsed_response_body['self'])
+        self.assertEqual(self_url, response['Location'])
+
+    def test_add_existing_group(self):
+        self.add_group()
+        response = self.post('/wwwhisper/admin/api/groups/',
+                             {'name' : 'staff'})
+        self.assertEqual(400, response.status_code)
+        self.assertRegexpMatches(response.content, 'Group already exists')
+
+    def test_get_groups_list(self):
+        self.add_group('staff')
+        self.add_group('admins')
+        response = self.get('/wwwhisper/admin/api/groups/')
+        self.assertEqual(200, response.status_code)
+        groups = json.loads(response.content)['groups']
+        self.assertItemsEqual(['staff', 'admins'],
+                              [item['name'] for item in groups])
+
+    def test_add_and_remove_member(self):
+        group_url = self.add_group()['self']
+        user = self.add_user()
+        member_url = group_url + 'members/' + extract_uuid(user['id']) + '/'
+        self.assertEqual(404, self.get(member_url).status_code)
+
+        response = self.put(member_url)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(member_url, response['Location'])
+        self.assertEqual(user, json.loads(response.content)['user'])
+        self.assertEqual(200, self.put(member_url).status_code)
+        self.assertEqual(200, self.get(member_url).status_code)
+        self.assertEqual([user],
+                         json.loads(self.get(group_url).content)['members'])
+
+        self.assertEqual(204, self.delete(member_url).status_code)
+        response = self.delete(member_url)
+        self.assertEqual(404, response.status_code)
+        self.assertRegexpMatches(response.content, 'not a member')
+
+    def test_add_not_existing_member(self):
+        group_url = self.add_group()['self']
+        response = self.put(group_url + 'members/' + FAKE_UUID + '/')
+        self.assertEqual(404, response.status_code)
+        self.assertRegexpMatches(response.content, 'User not found')
+        response = self.put('/wwwhisper/admin/api/groups/%s/members/%s/' % (
+                FAKE_UUID, FAKE_UUID))
+        self.assertRegexpMatches(response.content, 'Group not found')
+
+    def test_grant_and_revoke_group_access(self):
+        location_url = self.add_location()['self']
+        group = self.add_group()
+        allowed_url = (location_url + 'allowed-groups/' +
+                       extract_uuid(group['id']) + '/')
+        self.assertEqual(404, self.get(allowed_url).status_code)
+
+        response = self.put(allowed_url)
+        self.assertEqual(201, response.status_code)
+        self.assertEqual(allowed_url, response['Location'])
+        self.assertEqual('staff',
+                         json.loads(response.content)['group']['name'])
+        self.assertEqual(200, self.put(allowed_url).status_code)
+        self.assertEqual(200, self.get(allowed_url).status_code)
+
+        # Groups of a location are listed without members.
+        allowed_groups = json.loads(
+            self.get(location_url).content)['allowedGroups']
+        self.assertEqual(1, len(allowed_groups))
+        self.assertEqual(group['id'], allowed_groups[0]['id'])
+        self.assertNotIn('members', allowed_groups[0])
+
+        self.assertEqual(204, self.delete(allowed_url).status_code)
+        response = self.delete(allowed_url)
+        self.assertEqual(404, response.status_code)
+        self.assertRegexpMatches(response.content,
+                                 'Group can not access location')
+
+    def test_delete_group(self):
+        group_url = self.add_group()['self']
+        self.assertEqual(204, self.delete(group_url).status_code)
+        self.assertEqual(404, self.get(group_url).status_code)
+
 class SkinTest(AdminViewTestCase):
 
     def test_get_skin(self):
@@ -4,12 +4,14 @@
 """Urls exposed by the wwwhisper_admin application."""
 
 from django.conf.urls import url
-from views import CollectionView, ItemView, SkinView
+from views import CollectionView, ItemView, SkinView, UsersView
 from views import OpenAccessView, AllowedUsersView
+from views import AllowedGroupsView, GroupMembersView
+from views import AllowedDomainsView
 
 urlpatterns = [
     url(r'^users/$',
-        CollectionView.as_view(collection_name='users')),
+        UsersView.as_view(collection_name='users')),
     url(r'^users/(?P<uuid>[0-9a-z-]+)/$',
         ItemView.as_view(collection_name='users'),
         name='wwwhisper_user'),
@@ -22,8 +24,25 @@ urlpatterns = [
         '(?P<user_uuid>[0-9a-z-]+)/$',
         AllowedUsersView.as_view(),
         name='wwwhisper_allowed_user'),
+    url(r'^locations/(?P<location_uuid>[0-9a-z-]+)/allowed-groups/' +
+        '(?P<group_uuid>[0-9a-z-]+)/$',
+        AllowedGroupsView.as_view(),
+        name='wwwhisper_allowed_group'),
+    url(r'^locations/(?P<location_uuid>[0-9a-z-]+)/allowed-domains/' +
+        '(?P<domain>[0-9A-Za-z.-]+)/$',
+        AllowedDomainsView.as_view(),
+        name='wwwhisper_allowed_domain'),
     url(r'^locations/(?P<location_uuid>[0-9a-z-]+)/open-access/$',
         OpenAccessView.as_view()),
+    url(r'^groups/$',
+        CollectionView.as_view(collection_name='groups')),
+    url(r'^groups/(?P<uuid>[0-9a-z-]+)/$',
+        ItemView.as_view(collection_name='groups'),
+        name='wwwhisper_group'),
+    url(r'^groups/(?P<group_uuid>[0-9a-z-]+)/members/' +
+        '(?P<user_uuid>[0-9a-z-]+)/$',
+        GroupMembersView.as_view(),
+        name='wwwhisper_group_member'),
     url(r'^aliases/$',
         CollectionView.as_view(collection_name='aliases')),
     url(r'^aliases/(?P<uuid>[0-9a-z-]+)/$',
@@ -3,8 +3,8 @@
 
 """Views that allow to manage access control list.
 
-Expose REST interface for adding/removing locations and users and for
-granting/revoking access to locations.
+Expose REST interface for adding/removing locations, users and groups
+and for granting/revoking access to locations.
 """
 
 from django.forms import ValidationError
@@ -70,6 +70,18 @@ class CollectionView(http.RestView):
                 self.collection_name: items_list
                 })
 
+class UsersView(CollectionView):
+    """Collection of users.
+
+    Like other attributes of the REST API, an expiration time of a
+    user is passed in camel case (expiresAt).
+    """
+
+    def post(self, request, email, expiresAt=None):
+        """Adds a user, optionally expiring after expiresAt (ISO 8601)."""
+        return super(UsersView, self).post(
+            request, email=email, expires_at=expiresAt)
+
 class ItemView(http.RestView):
     """Generic view over a single resource stored in a collection.
 
@@ -155,16 +167,19 @@ class OpenAccessView(http.RestView):
 class AllowedUsersView(http.RestView):
     """Manages resources that define which users can access locations."""
 
-    def put(self, request, location_uuid, user_uuid):
+    def put(self, request, location_uuid, user_uuid, expiresAt=None):
         """Creates a resource.
 
-        Grants access to a given location by a given user.
+        Grants access to a given location by a given user. If
+        expiresAt (ISO 8601) is passed in the request body, access is
+        revoked after this time.
         """
         location = request.site.locations.find_item(location_uuid)
         if not location:
             return http.HttpResponseNotFound('Location not found.')
         try:
-            (permission, created) = location.grant_access(user_uuid)
+            (permission, created) = location.grant_access(
+                user_uuid, expires_at=expiresAt)
             attributes_dict = permission.attributes_dict(request.site_url)
             if created:
                 response =  http.HttpResponseCreated(attributes_dict)
@@ -172,6 +187,8 @@ class AllowedUsersView(http.RestView):
             else:
                 response = http.HttpResponseOKJson(attributes_dict)
             return response
+        except ValidationError as ex:
+            return http.HttpResponseBadRequest(', '.join(ex.messages))
         except LookupError as ex:
             return http.HttpResponseNotFound(str(ex))
 
@@ -208,6 +225,157 @@ class AllowedUsersView(http.RestView):
         except LookupError as ex:
             return http.HttpResponseNotFound(str(ex))
 
+class AllowedGroupsView(http.RestView):
+    """Manages resources that define which groups can access locations."""
+
+    def put(self, request, location_uuid, group_uuid):
+        """Creates a resource.
+
+        Grants access to a given location by all members of a given
+        group.
+        """
+        location = request.site.locations.find_item(location_uuid)
+        if not location:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            (permission, created) = location.grant_group_access(group_uuid)
+            attributes_dict = permission.attributes_dict(request.site_url)
+            if created:
+                response =  http.HttpResponseCreated(attributes_dict)
+                response['Location'] = attributes_dict['self']
+            else:
+                response = http.HttpResponseOKJson(attributes_dict)
+            return response
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+    def get(self, request, location_uuid, group_uuid):
+        """Checks if a resource that grants access exists."""
+        location = request.site.locations.find_item(location_uuid)
+        if location is None:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            permission = location.get_group_permission(group_uuid)
+            return http.HttpResponseOKJson(
+                permission.attributes_dict(request.site_url))
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+    def delete(self, request, location_uuid, group_uuid):
+        """Deletes a resource.
+
+        Revokes access to a given location by members of a given group.
+        """
+        location = request.site.locations.find_item(location_uuid)
+        if not location:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            location.revoke_group_access(group_uuid)
+            return http.HttpResponseNoContent()
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+class AllowedDomainsView(http.RestView):
+    """Manages resources that define which domains can access locations."""
+
+    def put(self, request, location_uuid, domain):
+        """Creates a resource.
+
+        Grants access to a given location by all users with emails in
+        a given domain.
+        """
+        location = request.site.locations.find_item(location_uuid)
+        if not location:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            (permission, created) = location.grant_domain_access(domain)
+        except ValidationError as ex:
+            return http.HttpResponseBadRequest(', '.join(ex.messages))
+        attributes_dict = permission.attributes_dict(request.site_url)
+        if created:
+            response =  http.HttpResponseCreated(attributes_dict)
+            response['Location'] = attributes_dict['self']
+        else:
+            response = http.HttpResponseOKJson(attributes_dict)
+        return response
+
+    def get(self, request, location_uuid, domain):
+        """Checks if a resource that grants access exists."""
+        location = request.site.locations.find_item(location_uuid)
+        if location is None:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            permission = location.get_domain_permission(domain)
+            return http.HttpResponseOKJson(
+                permission.attributes_dict(request.site_url))
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+    def delete(self, request, location_uuid, domain):
+        """Deletes a resource.
+
+        Revokes access to a given location by users of a given domain.
+        Users that already logged in are not removed, but can no
+        longer access the location, unless granted access otherwise.
+        """
+        location = request.site.locations.find_item(location_uuid)
+        if not location:
+            return http.HttpResponseNotFound('Location not found.')
+        try:
+            location.revoke_domain_access(domain)
+            return http.HttpResponseNoContent()
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+class GroupMembersView(http.RestView):
+    """Manages resources that define which users belong to groups."""
+
+    def put(self, request, group_uuid, user_uuid):
+        """Creates a resource.
+
+        Adds a given user to a given group.
+        """
+        group = request.site.groups.find_item(group_uuid)
+        if not group:
+            return http.HttpResponseNotFound('Group not found.')
+        try:
+            (membership, created) = group.add_member(user_uuid)
+            attributes_dict = membership.attributes_dict(request.site_url)
+            if created:
+                response =  http.HttpResponseCreated(attributes_dict)
+                response['Location'] = attributes_dict['self']
+            else:
+                response = http.HttpResponseOKJson(attributes_dict)
+            return response
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+    def get(self, request, group_uuid, user_uuid):
+        """Checks if a user belongs to a group."""
+        group = request.site.groups.find_item(group_uuid)
+        if group is None:
+            return http.HttpResponseNotFound('Group not found.')
+        try:
+            membership = group.get_membership(user_uuid)
+            return http.HttpResponseOKJson(
+                membership.attributes_dict(request.site_url))
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
+    def delete(self, request, group_uuid, user_uuid):
+        """Deletes a resource.
+
+        Removes a given user from a given group.
+        """
+        group = request.site.groups.find_item(group_uuid)
+        if not group:
+            return http.HttpResponseNotFound('Group not found.')
+        try:
+            group.remove_member(user_uuid)
+            return http.HttpResponseNoContent()
+        except LookupError as ex:
+            return http.HttpResponseNotFound(str(ex))
+
 
 class SkinView(http.RestView):
     """Configures the login page."""
@@ -0,0 +1,159 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Counts accesses of users to locations without per-request writes.
+
+Each granted auth request of an authenticated user increments an in
+memory counter of the (location, user) pair. A background thread of
+each process periodically adds counters collected since the last
+flush to AccessCounter rows (one update or insert per pair). Admin
+API returns totals of these rows as approximate hits and last seen
+times of locations and users (see models.AccessStats).
+
+Counters of a process that exits before a flush are lost. Counting is
+enabled with WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL.
+"""
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import IntegrityError
+from django.db import connection
+from django.db import models
+from django.db import transaction
+from django.db.models import Case
+from django.db.models import F
+from django.db.models import Value
+from django.db.models import When
+from wwwhisper_auth import metrics
+from wwwhisper_auth.models import AccessCounter
+from wwwhisper_auth.models import Location
+from wwwhisper_auth.models import User
+
+import datetime
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+class AccessCounters(object):
+    """Per process counters flushed from a background thread.
+
+    Like site_cache.Refresher, the thread is started by the first
+    access counted by a process.
+    """
+
+    def __init__(self, flush_interval):
+        self._flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._pid = None
+
+    def hit(self, site_id, location_id, user_id):
+        self.ensure_running()
+        key = (site_id, location_id, user_id)
+        now = time.time()
+        with self._lock:
+            counter = self._counters.get(key)
+            if counter is None:
+                self._counters[key] = [1, now]
+            else:
+                counter[0] += 1
+                counter[1] = now
+
+    def ensure_running(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+
+    def flush(self):
+        """Adds counters to the DB, returns the number of updated pairs."""
+        with self._lock:
+            counters, self._counters = self._counters, {}
+        if not counters:
+            return 0
+        try:
+            with transaction.atomic():
+                for ((site_id, location_id, user_id), (hits, last_seen)) \
+                        in counters.iteritems():
+                    _add(site_id, location_id, user_id, hits,
+                         datetime.datetime.fromtimestamp(last_seen))
+        except DatabaseError as ex:
+            logger.warning('Failed to write access counters: %s' % ex)
+            # The connection can be broken, the next flush opens a
+            # new one.
+            connection.close()
+            # The transaction was rolled back, all counters are
+            # written by the next flush.
+            self._merge(counters)
+            return 0
+        metrics.registry.inc('wwwhisper_access_counters_flushed_total',
+                             len(counters))
+        return len(counters)
+
+    def _merge(self, counters):
+        """Adds counters that were not written to the current ones."""
+        with self._lock:
+            for (key, (hits, last_seen)) in counters.iteritems():
+                counter = self._counters.get(key)
+                if counter is None:
+                    self._counters[key] = [hits, last_seen]
+                else:
+                    counter[0] += hits
+                    counter[1] = max(counter[1], last_seen)
+
+    def _run(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+def _update(location_id, user_id, hits, last_seen):
+    return AccessCounter.objects.filter(
+        location_id=location_id, user_id=user_id).update(
+        hits=F('hits') + hits,
+        last_seen=Case(
+            When(last_seen__lt=last_seen, then=Value(last_seen)),
+            default=F('last_seen'),
+            output_field=models.DateTimeField()))
+
+def _add(site_id, location_id, user_id, hits, last_seen):
+    if _update(location_id, user_id, hits, last_seen):
+        return
+    # Only the first flush of a pair gets here. Not all DBs enforce
+    # foreign keys, so counters of deleted items are skipped explicitly.
+    if (not Location.objects.filter(id=location_id).exists() or
+        not User.objects.filter(id=user_id).exists()):
+        return
+    try:
+        with transaction.atomic():
+            AccessCounter.objects.create(
+                site_id=site_id, location_id=location_id, user_id=user_id,
+                hits=hits, last_seen=last_seen)
+    except IntegrityError:
+        # The row was inserted by other process in the meantime, or
+        # the location or the user was just deleted (then nothing is
+        # updated).
+        _update(location_id, user_id, hits, last_seen)
+
+def _create_counters():
+    interval = getattr(settings, 'WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL',
+                       None)
+    if not interval:
+        return None
+    return AccessCounters(interval)
+
+# None if accesses are not counted.
+counters = _create_counters()
+
+def hit(site_id, location_id, user_id):
+    """Counts granted access of a user to a location if enabled."""
+    if counters is not None:
+        counters.hit(site_id, location_id, user_id)
@@ -0,0 +1,99 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Reference evaluator of ACL snapshots (see acl_snapshot.py).
+
+Makes the same decisions as the is-authorized endpoint, but using
+only data from a snapshot file. The module depends only on the
+Python standard library and path_matcher.py and can be copied (with
+path_matcher.py) and used by processes that do not run Django (or
+serve as a specification for evaluators written in other languages).
+
+Example:
+    snapshot = AclSnapshot.load('/var/lib/wwwhisper/acl.json')
+    if snapshot.alias_defined('https://example.com'):
+        status = snapshot.authorize('/protected/page.html', user_id)
+
+The caller is responsible for validating and canonicalizing the path
+the same way the is-authorized endpoint does (absolute, no '/./',
+'/../' or '//' parts, no fragment, query stripped, decoded).
+"""
+
+from wwwhisper_auth.path_matcher import PathMatcher
+
+import json
+
+FORMAT_VERSION = 1
+
+class SnapshotFormatError(Exception):
+    pass
+
+class AclSnapshot(object):
+    """Access state of a single site.
+
+    Attributes:
+      site_id: Id of the site.
+      mod_id: Modification id of the site from which the snapshot was
+         created.
+      aliases: Set of urls that can be used to access the site.
+      users: Dict that maps user id to email.
+      locations: Dict that maps location path to a (open_access,
+         frozenset of ids of allowed users) tuple.
+    """
+
+    def __init__(self, data):
+        if data.get('format') != FORMAT_VERSION:
+            raise SnapshotFormatError(
+                'Unsupported snapshot format: %s' % data.get('format'))
+        self.site_id = data['site_id']
+        self.mod_id = data['mod_id']
+        self.aliases = frozenset(data['aliases'])
+        self.users = dict((int(user_id), email)
+                          for (user_id, email) in data['users'].iteritems())
+        self.locations = dict(
+            (path, (location['open'], frozenset(location['allowed'])))
+            for (path, location) in data['locations'].iteritems())
+        self._matcher = PathMatcher(
+            (path, path) for path in self.locations)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as src:
+            return cls(json.load(src))
+
+    def alias_defined(self, url):
+        return url in self.aliases
+
+    def find_location(self, canonical_path):
+        """Returns path of the most specific location matching a given path.
+
+        Returns None if no location matches. Uses the same rules as
+        LocationsCollection.find_location (see path_matcher.py).
+        """
+        return self._matcher.match(canonical_path)
+
+    def can_access(self, location_path, user_id):
+        open_access, allowed = self.locations[location_path]
+        return open_access or user_id in allowed
+
+    def authorize(self, canonical_path, user_id=None):
+        """Returns a status code the is-authorized endpoint would return.
+
+        Args:
+           canonical_path: Validated, canonical path of the request.
+           user_id: Id of an authenticated user, or None.
+
+        Returns:
+           200 if access is granted, 401 if the user is not
+           authenticated (or is not a user of the site), 403 if the
+           user can not access the location.
+        """
+        location_path = self.find_location(canonical_path)
+        if user_id is not None and user_id in self.users:
+            if (location_path is not None and
+                self.can_access(location_path, user_id)):
+                return 200
+            return 403
+        if location_path is not None and self.locations[location_path][0]:
+            return 200
+        return 401
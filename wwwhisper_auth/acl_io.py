@@ -0,0 +1,562 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Streaming bulk export and import of site access control lists.
+
+Used by acl_export and acl_import management commands. An ACL is a
+sequence of records, each record is one of:
+    user: email, optional expiration time
+    location: path, open access flag
+    grant: location path, user email, optional expiration time
+    alias: url
+    group: name
+    member: group name, user email
+    group_grant: location path, group name
+    domain_grant: location path, email domain
+
+Two formats are supported, JSON Lines (one json object per line):
+    {"type": "user", "email": "alice@example.org"}
+    {"type": "location", "path": "/foo/", "open": false}
+    {"type": "grant", "path": "/foo/", "email": "alice@example.org"}
+    {"type": "grant", "path": "/bar/", "email": "alice@example.org",
+     "expires_at": "2018-06-30T12:00:00"}
+    {"type": "alias", "url": "https://example.org"}
+    {"type": "group", "name": "staff"}
+    {"type": "member", "group": "staff", "email": "alice@example.org"}
+    {"type": "group_grant", "path": "/foo/", "group": "staff"}
+    {"type": "domain_grant", "path": "/foo/", "domain": "example.org"}
+
+and CSV (with the same records as rows):
+    user,alice@example.org
+    location,/foo/,n
+    grant,/foo/,alice@example.org
+    grant,/bar/,alice@example.org,2018-06-30T12:00:00
+    alias,https://example.org
+    group,staff
+    member,staff,alice@example.org
+    group_grant,/foo/,staff
+    domain_grant,/foo/,example.org
+
+Export iterates over DB rows without loading the whole site, so it
+runs in constant memory. Import reads the input several times: first
+validates all records without writing anything, then writes users,
+locations, aliases and groups, and finally grants and memberships
+(so these can precede users, locations and groups they reference).
+Expiration time (ISO 8601, the last CSV value) is written only for
+users and grants that expire.
+Records are written in chunks, each chunk with bulk_create in a
+single transaction, and the site is marked as modified once at the
+end. Records that already exist are skipped, so import can be safely
+repeated. Import keeps ids of all users, locations and groups of the
+site in memory, other data is streamed. Users created at a login
+because of a domain grant (see models.DomainUser) are not exported,
+if imported, they become regular users. In the multi-tenant mode,
+aliases with urls of other sites are rejected, like in
+AliasesCollection.create_item.
+"""
+
+from django.conf import settings
+from django.db import IntegrityError
+from django.db import transaction
+from django.forms import ValidationError
+from django.utils import timezone
+from wwwhisper_auth.models import Alias
+from wwwhisper_auth.models import AliasOwner
+from wwwhisper_auth.models import AliasesCollection
+from wwwhisper_auth.models import DomainPermission
+from wwwhisper_auth.models import DomainUser
+from wwwhisper_auth.models import Group
+from wwwhisper_auth.models import GroupMembership
+from wwwhisper_auth.models import GroupPermission
+from wwwhisper_auth.models import GroupsCollection
+from wwwhisper_auth.models import LimitExceeded
+from wwwhisper_auth.models import Location
+from wwwhisper_auth.models import LocationsCollection
+from wwwhisper_auth.models import Permission
+from wwwhisper_auth.models import PermissionExpiration
+from wwwhisper_auth.models import User
+from wwwhisper_auth.models import UserExpiration
+from wwwhisper_auth.models import UsersCollection
+from wwwhisper_auth.models import validate_expiration
+
+import csv
+import json
+import uuid as uuidgen
+
+FORMATS = ('jsonl', 'csv')
+
+# Bounds the number of parameters of 'IN' queries (SQLite limits the
+# number of query parameters to 999, a query for existing grants has
+# two 'IN' lists, each with up to chunk size elements).
+DEFAULT_CHUNK_SIZE = 400
+
+class AclImportError(Exception):
+    pass
+
+def _multi_tenant():
+    return getattr(settings, 'WWWHISPER_MULTI_TENANT', False)
+
+def export_records(site):
+    """Yields ACL records of a site (dicts in JSON Lines format)."""
+    site_id = site.site_id
+    for url in Alias.objects.filter(site_id=site_id).values_list(
+        'url', flat=True).iterator():
+        yield {'type': 'alias', 'url': url}
+    expirations = _expirations(UserExpiration, 'user_id', site_id)
+    # Users created at a login because of a domain grant are created
+    # again at the next login.
+    for (user_id, email) in User.objects.filter(site_id=site_id).exclude(
+        id__in=DomainUser.objects.filter(site_id=site_id).values(
+            'user_id')).values_list('id', 'email').iterator():
+        yield _with_expiration({'type': 'user', 'email': email},
+                               expirations.get(user_id))
+    for (path, open_access) in Location.objects.filter(
+        site_id=site_id).values_list('path', 'open_access').iterator():
+        yield {'type': 'location', 'path': path, 'open': open_access == 'y'}
+    expirations = _expirations(PermissionExpiration, 'permission_id', site_id)
+    for (permission_id, path, email) in Permission.objects.filter(
+        site_id=site_id).values_list(
+        'id', 'http_location__path', 'user__email').iterator():
+        yield _with_expiration({'type': 'grant', 'path': path, 'email': email},
+                               expirations.get(permission_id))
+    for name in Group.objects.filter(site_id=site_id).values_list(
+        'name', flat=True).iterator():
+        yield {'type': 'group', 'name': name}
+    for (name, email) in GroupMembership.objects.filter(
+        site_id=site_id).values_list('group__name', 'user__email').iterator():
+        yield {'type': 'member', 'group': name, 'email': email}
+    for (path, name) in GroupPermission.objects.filter(
+        site_id=site_id).values_list(
+        'http_location__path', 'group__name').iterator():
+        yield {'type': 'group_grant', 'path': path, 'group': name}
+    for (path, domain) in DomainPermission.objects.filter(
+        site_id=site_id).values_list(
+        'http_location__path', 'domain').iterator():
+        yield {'type': 'domain_grant', 'path': path, 'domain': domain}
+
+def _expirations(model_class, key_field, site_id):
+    """Maps ids of expiring items of a site to expiration times."""
+    return dict(model_class.objects.filter(site_id=site_id).values_list(
+            key_field, 'expires_at').iterator())
+
+def _with_expiration(record, expires_at):
+    if expires_at is not None:
+        record['expires_at'] = expires_at.isoformat()
+    return record
+
+def _to_csv_row(record):
+    record_type = record['type']
+    if record_type == 'location':
+        row = [record_type, record['path'], 'y' if record['open'] else 'n']
+    else:
+        # Optional fields are present only if set.
+        row = [record_type] + [
+            record[field] for field in _CSV_FIELDS[record_type]
+            if field in record]
+    return [value.encode('utf-8') for value in row]
+
+def write_records(records, out, format):
+    """Writes records to a file, returns the number of written records."""
+    count = 0
+    if format == 'csv':
+        writer = csv.writer(out, lineterminator='\n')
+        for record in records:
+            writer.writerow(_to_csv_row(record))
+            count += 1
+    else:
+        for record in records:
+            out.write(json.dumps(record, sort_keys=True) + '\n')
+            count += 1
+    return count
+
+_CSV_FIELDS = {
+    'user': ('email', 'expires_at'),
+    'location': ('path', 'open'),
+    'grant': ('path', 'email', 'expires_at'),
+    'alias': ('url',),
+    'group': ('name',),
+    'member': ('group', 'email'),
+    'group_grant': ('path', 'group'),
+    'domain_grant': ('path', 'domain'),
+}
+
+# Can be the last value of a CSV row or can be omitted.
+_CSV_OPTIONAL_FIELD = 'expires_at'
+
+def _from_csv_row(row):
+    row = [value.decode('utf-8') for value in row]
+    if not row or row[0] not in _CSV_FIELDS:
+        raise ValueError('Unknown record type')
+    fields = _CSV_FIELDS[row[0]]
+    if fields[-1] == _CSV_OPTIONAL_FIELD and len(row) == len(fields):
+        fields = fields[:-1]
+    if len(row) != len(fields) + 1:
+        raise ValueError('Expected %d values' % (len(fields) + 1))
+    record = dict(zip(fields, row[1:]))
+    record['type'] = row[0]
+    if 'open' in record:
+        if record['open'] not in ('y', 'n'):
+            raise ValueError("Open access flag should be 'y' or 'n'")
+        record['open'] = record['open'] == 'y'
+    return record
+
+def read_records(src, format):
+    """Yields (line number, record) tuples read from a file."""
+    if format == 'csv':
+        reader = csv.reader(src)
+        for row in reader:
+            if not row:
+                continue
+            try:
+                yield (reader.line_num, _from_csv_row(row))
+            except (ValueError, UnicodeError) as ex:
+                raise AclImportError('Line %d: %s.' % (reader.line_num, ex))
+        return
+    for (line_num, line) in enumerate(src, 1):
+        if not line.strip():
+            continue
+        try:
+            record = json.loads(line)
+            if not isinstance(record, dict):
+                raise ValueError('Record should be a json object')
+        except ValueError as ex:
+            raise AclImportError('Line %d: %s.' % (line_num, ex))
+        yield (line_num, record)
+
+class Importer(object):
+    """Imports ACL records to a site.
+
+    Attributes:
+        added: Dict with the number of added records of each type.
+    """
+
+    def __init__(self, site, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.site = site
+        self.chunk_size = chunk_size
+        self.added = dict((record_type, 0) for record_type in _CSV_FIELDS)
+
+    def _normalize(self, line_num, record):
+        """Validates a record, returns it with normalized values."""
+        try:
+            record_type = record.get('type')
+            if record_type == 'user':
+                return ('user',
+                        UsersCollection.validate_email(record['email']),
+                        validate_expiration(record.get('expires_at')))
+            elif record_type == 'location':
+                LocationsCollection.validate_path(record['path'])
+                return ('location', record['path'], bool(record['open']))
+            elif record_type == 'grant':
+                LocationsCollection.validate_path(record['path'])
+                return ('grant', record['path'],
+                        UsersCollection.validate_email(record['email']),
+                        validate_expiration(record.get('expires_at')))
+            elif record_type == 'alias':
+                return ('alias', AliasesCollection.validate_url(record['url']))
+            elif record_type == 'group':
+                return ('group', GroupsCollection.validate_name(
+                        record['name']))
+            elif record_type == 'member':
+                return ('member',
+                        GroupsCollection.validate_name(record['group']),
+                        UsersCollection.validate_email(record['email']))
+            elif record_type == 'group_grant':
+                LocationsCollection.validate_path(record['path'])
+                return ('group_grant', record['path'],
+                        GroupsCollection.validate_name(record['group']))
+            elif record_type == 'domain_grant':
+                LocationsCollection.validate_path(record['path'])
+                return ('domain_grant', record['path'],
+                        LocationsCollection.validate_domain(record['domain']))
+            raise ValueError('Unknown record type')
+        except KeyError as ex:
+            message = 'Missing %s' % ex
+        except (AttributeError, TypeError):
+            message = 'Invalid value type'
+        except ValueError as ex:
+            message = str(ex)
+        except ValidationError as ex:
+            message = ' '.join(ex.messages)
+        raise AclImportError('Line %d: %s' % (line_num, message))
+
+    def _existing(self, model_class, field):
+        return dict(model_class.objects.filter(
+                site_id=self.site.site_id).values_list(field, 'id').iterator())
+
+    def validate(self, read):
+        """Validates all records, does not write anything.
+
+        Checks that each grant and membership references a user, a
+        location and a group that are defined in the input or already
+        exist (references are checked in a second pass, so they can
+        precede the referenced records).
+
+        Args:
+            read: See import_records.
+        Raises:
+            AclImportError or LimitExceeded if the input is invalid.
+        """
+        # Kept for import_records, which validates first.
+        self._domain_user_ids = dict(DomainUser.objects.filter(
+                site_id=self.site.site_id).values_list(
+                'user__email', 'user_id').iterator())
+        self._user_ids = dict(
+            (email, user_id) for (email, user_id)
+            in self._existing(User, 'email').iteritems()
+            if email not in self._domain_user_ids)
+        self._location_ids = self._existing(Location, 'path')
+        self._urls = set(self._existing(Alias, 'url'))
+        self._group_ids = self._existing(Group, 'name')
+        emails = set(self._user_ids)
+        paths = set(self._location_ids)
+        urls = set(self._urls)
+        names = set(self._group_ids)
+        defined = {'user': emails, 'location': paths, 'alias': urls,
+                   'group': names}
+        # Line numbers of the first records of new aliases.
+        alias_lines = {}
+        for (line_num, record) in read():
+            normalized = self._normalize(line_num, record)
+            if normalized[0] in defined:
+                defined[normalized[0]].add(normalized[1])
+            if normalized[0] == 'alias' and normalized[1] not in self._urls:
+                alias_lines.setdefault(normalized[1], line_num)
+        for (line_num, record) in read():
+            normalized = self._normalize(line_num, record)
+            if normalized[0] == 'grant':
+                (_, path, email, _) = normalized
+                self._check_defined(line_num, 'location', path, paths)
+                self._check_defined(line_num, 'user', email, emails)
+            elif normalized[0] == 'member':
+                (_, name, email) = normalized
+                self._check_defined(line_num, 'group', name, names)
+                self._check_defined(line_num, 'user', email, emails)
+            elif normalized[0] == 'group_grant':
+                (_, path, name) = normalized
+                self._check_defined(line_num, 'location', path, paths)
+                self._check_defined(line_num, 'group', name, names)
+            elif normalized[0] == 'domain_grant':
+                self._check_defined(line_num, 'location', normalized[1], paths)
+        if _multi_tenant():
+            self._check_aliases_not_owned(alias_lines)
+        self._check_limit('users', self.site.users_limit, len(emails))
+        self._check_limit('locations', self.site.locations_limit, len(paths))
+        self._check_limit('aliases', self.site.aliases_limit, len(urls))
+        self._check_limit('groups', self.site.groups_limit, len(names))
+
+    def _check_aliases_not_owned(self, alias_lines):
+        """Rejects aliases with urls of other sites."""
+        urls = sorted(alias_lines)
+        owned = []
+        for i in xrange(0, len(urls), self.chunk_size):
+            owned.extend(Alias.objects.filter(
+                    url__in=urls[i:i + self.chunk_size]).exclude(
+                    site_id=self.site.site_id).values_list('url', flat=True))
+        if owned:
+            raise AclImportError(
+                'Line %d: Alias with this url belongs to other site.' %
+                min(alias_lines[url] for url in owned))
+
+    @staticmethod
+    def _check_defined(line_num, record_type, value, defined):
+        if value not in defined:
+            raise AclImportError('Line %d: Unknown %s %s.' % (
+                    line_num, record_type, value))
+
+    @staticmethod
+    def _check_limit(name, limit, count):
+        if limit is not None and count > limit:
+            raise LimitExceeded('%s limit exceeded' % name.capitalize())
+
+    def import_records(self, read):
+        """Validates and writes records to the DB.
+
+        Args:
+            read: Function that returns a new iterator over (line
+                number, record) tuples each time it is called.
+        Raises:
+            AclImportError or LimitExceeded if the input is invalid.
+        """
+        # Also reads ids of existing users, locations and groups.
+        self.validate(read)
+        self._pending = dict((record_type, []) for record_type in _CSV_FIELDS)
+        try:
+            self._write(read(), ('user', 'location', 'alias', 'group'))
+            self._write(read(), ('grant', 'member', 'group_grant',
+                                 'domain_grant'))
+        finally:
+            # Even if the import fails, already written chunks need
+            # to be visible to all processes.
+            self.site.site_modified()
+
+    def _write(self, records, record_types):
+        for (line_num, record) in records:
+            normalized = self._normalize(line_num, record)
+            if normalized[0] not in record_types:
+                continue
+            pending = self._pending[normalized[0]]
+            pending.append(normalized[1:])
+            if len(pending) >= self.chunk_size:
+                self._flush()
+        self._flush()
+
+    def _flush(self):
+        """Writes pending records in a single transaction."""
+        with transaction.atomic():
+            self._flush_users()
+            self._flush_locations()
+            self._flush_aliases()
+            self._flush_groups()
+            self._flush_grants()
+            self._flush_members()
+            self._flush_group_grants()
+            self._flush_domain_grants()
+
+    def _flush_users(self):
+        expirations = dict((email, expires_at)
+                           for (email, expires_at) in self._pending['user']
+                           if email not in self._user_ids)
+        emails = set(expirations)
+        self._pending['user'] = []
+        if not emails:
+            return
+        promoted = dict((email, self._domain_user_ids.pop(email))
+                        for email in emails
+                        if email in self._domain_user_ids)
+        if promoted:
+            # Domain users become regular users.
+            DomainUser.objects.filter(
+                user_id__in=promoted.values()).delete()
+            self._user_ids.update(promoted)
+        created = emails.difference(promoted)
+        now = timezone.now()
+        User.objects.bulk_create(
+            User(site_id=self.site.site_id, uuid=str(uuidgen.uuid4()),
+                 email=email, last_login=now) for email in created)
+        # bulk_create does not set ids of created objects for all DBs.
+        self._user_ids.update(User.objects.filter(
+                site_id=self.site.site_id, email__in=created).values_list(
+                'email', 'id'))
+        UserExpiration.objects.bulk_create(
+            UserExpiration(user_id=self._user_ids[email],
+                           site_id=self.site.site_id, expires_at=expires_at)
+            for (email, expires_at) in expirations.iteritems()
+            if expires_at is not None)
+        self.added['user'] += len(emails)
+
+    def _flush_locations(self):
+        open_access = {}
+        for (path, open_flag) in self._pending['location']:
+            if path not in self._location_ids:
+                open_access[path] = open_flag
+        self._pending['location'] = []
+        if not open_access:
+            return
+        Location.objects.bulk_create(
+            Location(site_id=self.site.site_id, uuid=str(uuidgen.uuid4()),
+                     path=path, open_access='y' if open_flag else 'n')
+            for (path, open_flag) in open_access.iteritems())
+        self._location_ids.update(Location.objects.filter(
+                site_id=self.site.site_id,
+                path__in=open_access.keys()).values_list('path', 'id'))
+        self.added['location'] += len(open_access)
+
+    def _flush_aliases(self):
+        urls = set(url for (url,) in self._pending['alias']
+                   if url not in self._urls)
+        self._pending['alias'] = []
+        if not urls:
+            return
+        Alias.objects.bulk_create(
+            Alias(site_id=self.site.site_id, uuid=str(uuidgen.uuid4()),
+                  url=url) for url in urls)
+        if _multi_tenant():
+            try:
+                AliasOwner.objects.bulk_create(
+                    AliasOwner(url=url, alias_id=alias_id)
+                    for (url, alias_id) in Alias.objects.filter(
+                        site_id=self.site.site_id,
+                        url__in=urls).values_list('url', 'id'))
+            except IntegrityError:
+                # Added by other site after the validation.
+                raise AclImportError(
+                    'Alias with this url belongs to other site.')
+        self._urls.update(urls)
+        self.added['alias'] += len(urls)
+
+    def _flush_groups(self):
+        names = set(name for (name,) in self._pending['group']
+                    if name not in self._group_ids)
+        self._pending['group'] = []
+        if not names:
+            return
+        Group.objects.bulk_create(
+            Group(site_id=self.site.site_id, uuid=str(uuidgen.uuid4()),
+                  name=name) for name in names)
+        self._group_ids.update(Group.objects.filter(
+                site_id=self.site.site_id, name__in=names).values_list(
+                'name', 'id'))
+        self.added['group'] += len(names)
+
+    def _flush_pairs(self, record_type, model_class, first_field, second_field,
+                     first_ids, second_ids=None):
+        """Writes pending records that connect two other records.
+
+        If second_ids is None, second values are written as they are.
+        Returns a set of written (first id, second id) pairs.
+        """
+        pairs = set((first_ids[first],
+                     second if second_ids is None else second_ids[second])
+                    for (first, second) in self._pending[record_type])
+        self._pending[record_type] = []
+        if not pairs:
+            return pairs
+        existing = set(model_class.objects.filter(**{
+                    'site_id': self.site.site_id,
+                    first_field + '__in': set(pair[0] for pair in pairs),
+                    second_field + '__in': set(pair[1] for pair in pairs),
+                    }).values_list(first_field, second_field))
+        pairs -= existing
+        model_class.objects.bulk_create(
+            model_class(**{'site_id': self.site.site_id,
+                           first_field: first_id, second_field: second_id})
+            for (first_id, second_id) in pairs)
+        self.added[record_type] += len(pairs)
+        return pairs
+
+    def _flush_grants(self):
+        expirations = dict(
+            ((self._location_ids[path], self._user_ids[email]), expires_at)
+            for (path, email, expires_at) in self._pending['grant']
+            if expires_at is not None)
+        self._pending['grant'] = [
+            (path, email) for (path, email, _) in self._pending['grant']]
+        written = self._flush_pairs(
+            'grant', Permission, 'http_location_id', 'user_id',
+            self._location_ids, self._user_ids)
+        expiring = written.intersection(expirations)
+        if not expiring:
+            return
+        PermissionExpiration.objects.bulk_create(
+            PermissionExpiration(
+                permission_id=permission_id, site_id=self.site.site_id,
+                expires_at=expirations[(location_id, user_id)])
+            for (location_id, user_id, permission_id)
+            in Permission.objects.filter(
+                site_id=self.site.site_id,
+                http_location_id__in=set(pair[0] for pair in expiring),
+                user_id__in=set(pair[1] for pair in expiring)).values_list(
+                'http_location_id', 'user_id', 'id')
+            if (location_id, user_id) in expiring)
+
+    def _flush_members(self):
+        self._flush_pairs('member', GroupMembership, 'group_id', 'user_id',
+                          self._group_ids, self._user_ids)
+
+    def _flush_group_grants(self):
+        self._flush_pairs('group_grant', GroupPermission, 'http_location_id',
+                          'group_id', self._location_ids, self._group_ids)
+
+    def _flush_domain_grants(self):
+        self._flush_pairs('domain_grant', DomainPermission,
+                          'http_location_id', 'domain', self._location_ids)
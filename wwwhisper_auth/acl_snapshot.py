@@ -0,0 +1,69 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Exports access state of a site for out-of-process evaluators.
+
+A snapshot is a json file with all data needed to answer auth
+requests: aliases, users, locations with open access flags and ids of
+allowed users. Expiring users and expiring permissions are left out
+(the formats have no expiration times, and an evaluator must never
+grant access that has expired), so users with such access are
+denied by evaluators. acl_evaluator.py is a reference, standalone
+implementation of decisions made from a snapshot. wwwhisper itself
+does not read snapshots.
+
+Snapshot format (version 1):
+    {
+      "format": 1,
+      "site_id": "theone",
+      "mod_id": 12,
+      "aliases": ["https://example.com"],
+      "users": {"1": "foo@example.com"},
+      "locations": {"/foo/": {"open": false, "allowed": [1]}}
+    }
+"""
+
+from wwwhisper_auth.acl_evaluator import FORMAT_VERSION
+
+import json
+import os
+
+def build(site):
+    """Returns a json serializable snapshot of the site access state."""
+    # Read before the data, so a snapshot never claims to be more
+    # recent than the data it contains.
+    mod_id = site.get_mod_id_ts()
+    users = dict((user.id, user.email) for user in site.users.all()
+                 if site.users.get_expiration(user.id) is None)
+    return {
+        'format': FORMAT_VERSION,
+        'site_id': site.site_id,
+        'mod_id': mod_id,
+        'aliases': sorted(alias.url for alias in site.aliases.all()),
+        'users': dict((str(user_id), email)
+                      for (user_id, email) in users.iteritems()),
+        'locations': dict(
+            (location.path, {
+                    'open': location.open_access_granted(),
+                    # Includes users allowed through groups.
+                    'allowed': sorted(
+                        user_id for user_id
+                        in site.locations.get_granted_user_ids(
+                            location.id, include_expiring=False)
+                        if user_id in users),
+                    })
+            for location in site.locations.all()),
+    }
+
+def write(site, path):
+    """Writes a snapshot of the site to a given file.
+
+    The file is replaced atomically, readers that reopen the file
+    after it changes never see a partial snapshot.
+    """
+    snapshot = build(site)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as out:
+        json.dump(snapshot, out, separators=(',', ':'), sort_keys=True)
+    os.rename(tmp_path, path)
+    return snapshot
@@ -0,0 +1,223 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Audit log of auth request decisions.
+
+Auth requests only push a compact record (time, site id, user id,
+location id, status) to a bounded in-process ring buffer, a background
+thread flushes the buffer in batches to per process files in
+WWWHISPER_AUDIT_LOG directory (rotated when they grow too large) or,
+if the setting is 'db', to the AuditRecord table.
+
+Requests never wait for the writer. If the buffer is full, records
+that do not fit are dropped, except every OVERFLOW_SAMPLE-th record,
+which replaces the oldest buffered one, so the log contains a sample
+of the traffic from the overload period. Dropped records are counted
+by the wwwhisper_audit_dropped_total metric.
+"""
+
+from django.conf import settings
+from django.db import DatabaseError
+from django.db import connection
+from wwwhisper_auth import metrics
+from wwwhisper_auth.models import AuditRecord
+
+import datetime
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DB = 'db'
+
+# Max number of records kept in memory by a process.
+BUFFER_SIZE = getattr(settings, 'WWWHISPER_AUDIT_BUFFER_SIZE', 10000)
+# How often (in seconds) the buffer is flushed.
+FLUSH_INTERVAL = getattr(settings, 'WWWHISPER_AUDIT_FLUSH_INTERVAL', 1)
+# Max number of records written with a single write or DB query.
+BATCH_SIZE = 500
+# One of this many records that do not fit in the full buffer is kept.
+OVERFLOW_SAMPLE = 10
+# Size after which a log file is rotated and the number of rotated
+# files kept.
+MAX_FILE_BYTES = 10 * 1024 * 1024
+BACKUP_COUNT = 5
+
+class RingBuffer(object):
+    """Bounded FIFO buffer that never blocks a producer for long."""
+
+    def __init__(self, capacity, overflow_sample=OVERFLOW_SAMPLE):
+        self._capacity = capacity
+        self._overflow_sample = overflow_sample
+        self._lock = threading.Lock()
+        self._items = [None] * capacity
+        self._start = 0
+        self._count = 0
+        self._overflow = 0
+
+    def push(self, item):
+        """Adds an item, returns False if a record was lost.
+
+        If the buffer is full, either the item is dropped, or, for every
+        overflow_sample-th such item, the oldest item is replaced.
+        """
+        with self._lock:
+            if self._count < self._capacity:
+                self._items[(self._start + self._count) % self._capacity] = \
+                    item
+                self._count += 1
+                return True
+            self._overflow += 1
+            if self._overflow % self._overflow_sample == 0:
+                self._items[self._start] = item
+                self._start = (self._start + 1) % self._capacity
+            return False
+
+    def drain(self):
+        """Removes and returns all items, the oldest first."""
+        # Allocated before the lock is taken, so producers wait only
+        # for the swap.
+        empty = [None] * self._capacity
+        with self._lock:
+            items, start, count = self._items, self._start, self._count
+            self._items, self._start, self._count = empty, 0, 0
+        end = start + count
+        if end <= self._capacity:
+            return items[start:end]
+        return items[start:] + items[:end - self._capacity]
+
+class FileWriter(object):
+    """Appends records as json lines to a file of the current process.
+
+    Each process writes to its own audit-PID.log file, so the files
+    can be rotated without coordination between processes.
+    """
+
+    def __init__(self, log_dir, max_bytes=MAX_FILE_BYTES,
+                 backup_count=BACKUP_COUNT):
+        self._log_dir = log_dir
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+
+    def path(self):
+        return os.path.join(self._log_dir, 'audit-%d.log' % os.getpid())
+
+    def write(self, records):
+        path = self.path()
+        with open(path, 'a') as out:
+            out.write(''.join(
+                    json.dumps({
+                            'time': _datetime(ts).isoformat(),
+                            'site': site_id,
+                            'user': user_id,
+                            'location': location_id,
+                            'status': status,
+                    }, sort_keys=True) + '\n'
+                    for (ts, site_id, user_id, location_id, status)
+                    in records))
+            size = out.tell()
+        if size >= self._max_bytes:
+            self._rotate(path)
+
+    def _rotate(self, path):
+        for i in xrange(self._backup_count - 1, 0, -1):
+            src = '%s.%d' % (path, i)
+            if os.path.exists(src):
+                os.rename(src, '%s.%d' % (path, i + 1))
+        if self._backup_count > 0:
+            os.rename(path, path + '.1')
+        else:
+            os.remove(path)
+
+class DbWriter(object):
+    """Inserts records to the AuditRecord table."""
+
+    def write(self, records):
+        AuditRecord.objects.bulk_create([
+                AuditRecord(time=_datetime(ts), site_id=site_id,
+                            user_id=user_id, location_id=location_id,
+                            status=status)
+                for (ts, site_id, user_id, location_id, status) in records])
+
+class AuditLog(object):
+    """Buffers records, writes them from a background thread.
+
+    Like site_cache.Refresher, the thread is started by the first
+    record pushed by a process.
+    """
+
+    def __init__(self, writer, buffer_size=BUFFER_SIZE,
+                 flush_interval=FLUSH_INTERVAL, batch_size=BATCH_SIZE):
+        self._writer = writer
+        self._buffer = RingBuffer(buffer_size)
+        self._flush_interval = flush_interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def record(self, site_id, user_id, location_id, status):
+        self.ensure_running()
+        if not self._buffer.push(
+            (time.time(), site_id, user_id, location_id, status)):
+            metrics.registry.inc('wwwhisper_audit_dropped_total')
+
+    def ensure_running(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+
+    def flush(self):
+        """Writes all buffered records, returns the number written."""
+        records = self._buffer.drain()
+        written = 0
+        for i in xrange(0, len(records), self._batch_size):
+            batch = records[i:i + self._batch_size]
+            try:
+                self._writer.write(batch)
+            except (IOError, OSError, DatabaseError) as ex:
+                logger.warning('Failed to write audit records: %s' % ex)
+                metrics.registry.inc('wwwhisper_audit_dropped_total',
+                                     len(batch))
+                if isinstance(ex, DatabaseError):
+                    # The connection can be broken, the next flush
+                    # opens a new one.
+                    connection.close()
+                continue
+            written += len(batch)
+        metrics.registry.inc('wwwhisper_audit_written_total', written)
+        return written
+
+    def _run(self):
+        while True:
+            time.sleep(self._flush_interval)
+            self.flush()
+
+def _datetime(ts):
+    # Naive local time, like timezone.now() with USE_TZ disabled.
+    return datetime.datetime.fromtimestamp(ts)
+
+def _create_log():
+    destination = getattr(settings, 'WWWHISPER_AUDIT_LOG', None)
+    if not destination:
+        return None
+    if destination == DB:
+        return AuditLog(DbWriter())
+    return AuditLog(FileWriter(destination))
+
+# None if auth decisions are not logged.
+log = _create_log()
+
+def record(site_id, user_id, location_id, status):
+    """Logs a decision of an auth request if the audit log is enabled."""
+    if log is not None:
+        log.record(site_id, user_id, location_id, status)
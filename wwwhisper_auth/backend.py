@@ -29,4 +29,26 @@ class VerifiedEmailBackend(ModelBackend):
         if verified_email is None:
             raise AuthenticationError('Token invalid or expired.')
 
-        return site.users.find_item_by_email(verified_email)
+        user = site.users.find_item_by_email(verified_email)
+        if user is None:
+            if not site.locations.is_domain_granted(verified_email):
+                return None
+            user = self._create_domain_user(site, verified_email)
+        # django.contrib.auth.login() needs a model instance.
+        return user.as_model()
+
+    @staticmethod
+    def _create_domain_user(site, verified_email):
+        """Creates a user that can login because of the email domain.
+
+        Such users are not added up front, a user is created at the
+        first login (see UsersCollection.create_domain_user).
+        """
+        try:
+            return site.users.create_domain_user(verified_email)
+        except ValidationError:
+            # The user was created concurrently with the same token,
+            # which can be used only once.
+            raise AuthenticationError('Token invalid or expired.')
+        except LimitExceeded:
+            raise AuthenticationError('Users limit exceeded.')
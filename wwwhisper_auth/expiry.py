@@ -0,0 +1,119 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Deletes expired users and permissions from the DB.
+
+Users and permissions can expire (see UserExpiration and
+PermissionExpiration). Cached sites stop honoring expired items at
+the expiration time without querying the DB, the sweep deletes
+expired rows later, so admin API, exports and reloaded sites no
+longer include them.
+
+Rows are deleted in batches, each batch in a single transaction, so
+a sweep never holds long locks. Each site is marked as modified once
+per sweep, not once per deleted row, so a sweep that deletes
+thousands of expired permissions causes a single reload of the site
+in each process.
+"""
+
+from django.db import DatabaseError
+from django.db import connection
+from django.db import transaction
+from django.utils import timezone
+from wwwhisper_auth import metrics
+from wwwhisper_auth.models import Permission
+from wwwhisper_auth.models import PermissionExpiration
+from wwwhisper_auth.models import Site
+from wwwhisper_auth.models import User
+from wwwhisper_auth.models import UserExpiration
+
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 500
+
+# (model class, expiration class, field of expiration with model id).
+_EXPIRING = (
+    (User, UserExpiration, 'user_id'),
+    (Permission, PermissionExpiration, 'permission_id'),
+)
+
+def sweep(batch_size=DEFAULT_BATCH_SIZE, now=None):
+    """Deletes expired users and permissions of all sites.
+
+    Returns the number of deleted users and permissions.
+    """
+    if now is None:
+        now = timezone.now()
+    site_ids = set()
+    for (_, expiration_class, _) in _EXPIRING:
+        site_ids.update(expiration_class.objects.filter(
+                expires_at__lte=now).values_list(
+                'site_id', flat=True).distinct())
+    deleted = 0
+    for site_id in sorted(site_ids):
+        site_deleted = 0
+        for (model_class, expiration_class, key_field) in _EXPIRING:
+            site_deleted += _delete_expired(
+                model_class, expiration_class, key_field, site_id, now,
+                batch_size)
+        site = Site.objects.filter(site_id=site_id).first()
+        if site_deleted and site is not None:
+            site.site_modified(revoking=True)
+        deleted += site_deleted
+    metrics.registry.inc('wwwhisper_expired_deleted_total', deleted)
+    return deleted
+
+def _delete_expired(model_class, expiration_class, key_field, site_id, now,
+                    batch_size):
+    deleted = 0
+    while True:
+        with transaction.atomic():
+            ids = list(expiration_class.objects.filter(
+                    site_id=site_id, expires_at__lte=now).values_list(
+                    key_field, flat=True)[:batch_size])
+            if not ids:
+                return deleted
+            # Expiration rows are deleted by cascade.
+            model_class.objects.filter(id__in=ids).delete()
+        deleted += len(ids)
+
+class Sweeper(object):
+    """Runs sweep every interval seconds from a background thread.
+
+    Like site_cache.Refresher, the thread is started by the first
+    request handled by a process.
+    """
+
+    def __init__(self, interval, batch_size=DEFAULT_BATCH_SIZE):
+        self._interval = interval
+        self._batch_size = batch_size
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_running(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+
+    def _run(self):
+        while True:
+            time.sleep(self._interval)
+            try:
+                sweep(self._batch_size)
+            except DatabaseError as ex:
+                logger.warning('Failed to delete expired items: %s' % ex)
+                # The connection can be broken, the next sweep opens
+                # a new one.
+                connection.close()
@@ -0,0 +1,34 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.management.base import BaseCommand, CommandError
+from wwwhisper_auth import acl_io
+from wwwhisper_auth.models import Site
+from wwwhisper_auth.models import SINGLE_SITE_ID
+
+import sys
+
+class Command(BaseCommand):
+    help = ('Writes users, locations, grants, aliases and groups of a site '
+            'as JSON Lines or CSV (see wwwhisper_auth/acl_io.py).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output',
+                            help='Path of the output file, - for stdout.')
+        parser.add_argument('--site-id', default=SINGLE_SITE_ID,
+                            help='Id of the exported site.')
+        parser.add_argument('--format', choices=acl_io.FORMATS,
+                            default='jsonl', help='Output format.')
+
+    def handle(self, *args, **options):
+        site = Site.objects.filter(site_id=options['site_id']).first()
+        if site is None:
+            raise CommandError('Site %s does not exist.' % options['site_id'])
+        records = acl_io.export_records(site)
+        if options['output'] == '-':
+            acl_io.write_records(records, sys.stdout, options['format'])
+            return
+        with open(options['output'], 'w') as out:
+            count = acl_io.write_records(records, out, options['format'])
+        self.stdout.write('%d records of %s written to %s.' % (
+                count, site.site_id, options['output']))
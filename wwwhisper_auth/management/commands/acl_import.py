@@ -0,0 +1,44 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.management.base import BaseCommand, CommandError
+from wwwhisper_auth import acl_io
+from wwwhisper_auth.models import LimitExceeded
+from wwwhisper_auth.models import Site
+from wwwhisper_auth.models import SINGLE_SITE_ID
+
+class Command(BaseCommand):
+    help = ('Adds users, locations, grants, aliases and groups from a JSON '
+            'Lines or CSV file to a site (see wwwhisper_auth/acl_io.py).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('input', help='Path of the input file.')
+        parser.add_argument('--site-id', default=SINGLE_SITE_ID,
+                            help='Id of the site.')
+        parser.add_argument('--format', choices=acl_io.FORMATS,
+                            default='jsonl', help='Input format.')
+        parser.add_argument('--chunk-size', type=int,
+                            default=acl_io.DEFAULT_CHUNK_SIZE,
+                            help='Number of records written in a transaction.')
+
+    def handle(self, *args, **options):
+        site = Site.objects.filter(site_id=options['site_id']).first()
+        if site is None:
+            raise CommandError('Site %s does not exist.' % options['site_id'])
+        def read():
+            with open(options['input']) as src:
+                for record in acl_io.read_records(src, options['format']):
+                    yield record
+        importer = acl_io.Importer(site, options['chunk_size'])
+        try:
+            importer.import_records(read)
+        except IOError as ex:
+            raise CommandError('Failed to read %s: %s' % (
+                    options['input'], ex))
+        except (acl_io.AclImportError, LimitExceeded) as ex:
+            raise CommandError(str(ex))
+        self.stdout.write(
+            'Added %(user)d users, %(location)d locations, %(grant)d grants, '
+            '%(alias)d aliases, %(group)d groups, %(member)d group members, '
+            '%(group_grant)d group grants and %(domain_grant)d domain '
+            'grants.' % importer.added)
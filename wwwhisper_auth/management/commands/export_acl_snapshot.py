@@ -0,0 +1,24 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.management.base import BaseCommand, CommandError
+from wwwhisper_auth import acl_snapshot
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import SINGLE_SITE_ID
+
+class Command(BaseCommand):
+    help = ('Writes access state of a site to a json file that can be '
+            'used by out-of-process auth evaluators (see acl_evaluator.py).')
+
+    def add_arguments(self, parser):
+        parser.add_argument('output', help='Path of the snapshot file.')
+        parser.add_argument('--site-id', default=SINGLE_SITE_ID,
+                            help='Id of the exported site.')
+
+    def handle(self, *args, **options):
+        site = SitesCollection().find_item(options['site_id'])
+        if site is None:
+            raise CommandError('Site %s does not exist.' % options['site_id'])
+        snapshot = acl_snapshot.write(site, options['output'])
+        self.stdout.write('Snapshot of %s (mod_id %d) written to %s.' % (
+                site.site_id, snapshot['mod_id'], options['output']))
@@ -0,0 +1,263 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Cheap in-process instrumentation exported in Prometheus text format.
+
+Counters and histograms are kept in a process wide registry, updating
+them costs a dict lookup and a short critical section. To aggregate
+data from all uWSGI workers, each worker periodically dumps its
+registry to a file in WWWHISPER_METRICS_DIR (one file per process,
+named with the pid), the exporter sums the content of all these
+files and removes files of processes that no longer exist (so data
+of a dead worker is not summed forever and is not overwritten by a
+new process that gets the same pid). Without WWWHISPER_METRICS_DIR
+only data of the exporting process is returned.
+"""
+
+from django.conf import settings
+from django.db import connection
+from django.db.backends.signals import connection_created
+from django.db.backends.utils import CursorWrapper
+
+import bisect
+import errno
+import json
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# Upper bounds (in seconds) of latency histogram buckets.
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                   0.25, 0.5, 1.0, 2.5, 5.0)
+# Upper bounds of DB queries per request histogram buckets.
+QUERIES_BUCKETS = (0, 1, 2, 3, 4, 5, 10, 20, 50, 100)
+
+# How often (in seconds) a process dumps its registry to the metrics
+# directory.
+FLUSH_INTERVAL = getattr(settings, 'WWWHISPER_METRICS_FLUSH_INTERVAL', 5)
+
+_TYPE_COUNTER = 'counter'
+_TYPE_HISTOGRAM = 'histogram'
+
+def _key(labels):
+    """Converts labels dict to a hashable, deterministically ordered key."""
+    return tuple(sorted(labels.iteritems()))
+
+class Registry(object):
+    """Stores counters and histograms of a single process.
+
+    Each metric is identified by a name and a set of labels. Histogram
+    is stored as a list of per bucket counts, followed by a sum and a
+    count of all observations.
+    """
+
+    def __init__(self, metrics_dir=None):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._types = {}
+        self._buckets = {}
+        self._metrics_dir = metrics_dir
+        self._last_flush = 0
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            self._types[name] = _TYPE_COUNTER
+            self._metrics[key] = self._metrics.get(key, 0) + value
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS, **labels):
+        key = (name, _key(labels))
+        with self._lock:
+            data = self._metrics.get(key)
+            if data is None:
+                self._types[name] = _TYPE_HISTOGRAM
+                self._buckets[name] = buckets
+                data = [0] * (len(buckets) + 3)
+                self._metrics[key] = data
+            # Observations larger than the last bound go to +Inf bucket.
+            data[bisect.bisect_left(buckets, value)] += 1
+            data[-2] += value
+            data[-1] += 1
+
+    def timer(self, name, **labels):
+        """Context manager that observes duration of the enclosed block."""
+        return _Timer(self, name, labels)
+
+    def snapshot(self):
+        """Returns a json serializable copy of all metrics."""
+        with self._lock:
+            return {
+                'types': dict(self._types),
+                'buckets': dict(self._buckets),
+                'metrics': [[name, labels, value if not isinstance(value, list)
+                             else list(value)]
+                            for ((name, labels), value)
+                            in self._metrics.iteritems()],
+            }
+
+    def maybe_flush(self):
+        """Dumps the registry to the metrics directory if it is time to."""
+        if (self._metrics_dir is None or
+            time.time() - self._last_flush < FLUSH_INTERVAL):
+            return
+        self.flush()
+
+    def flush(self):
+        if self._metrics_dir is None:
+            return
+        self._last_flush = time.time()
+        path = os.path.join(self._metrics_dir, '%d.json' % os.getpid())
+        tmp_path = path + '.tmp'
+        try:
+            with open(tmp_path, 'w') as out:
+                json.dump(self.snapshot(), out)
+            # Rename is atomic, exporter never reads a partial file.
+            os.rename(tmp_path, path)
+        except (IOError, OSError) as ex:
+            logger.warning('Failed to write metrics to %s: %s' % (path, ex))
+
+    def _all_snapshots(self):
+        if self._metrics_dir is None:
+            return [self.snapshot()]
+        self.flush()
+        snapshots = []
+        for file_name in os.listdir(self._metrics_dir):
+            if not file_name.endswith('.json'):
+                continue
+            path = os.path.join(self._metrics_dir, file_name)
+            try:
+                if not _process_exists(file_name[:-len('.json')]):
+                    os.remove(path)
+                    continue
+                with open(path) as src:
+                    snapshots.append(json.load(src))
+            except (IOError, OSError, ValueError) as ex:
+                logger.warning('Failed to read metrics file %s: %s'
+                               % (file_name, ex))
+        return snapshots
+
+    def export(self):
+        """Returns metrics of all processes in Prometheus text format."""
+        types, buckets, merged = {}, {}, {}
+        for snapshot in self._all_snapshots():
+            types.update(snapshot['types'])
+            buckets.update(snapshot['buckets'])
+            for name, labels, value in snapshot['metrics']:
+                key = (name, tuple(tuple(label) for label in labels))
+                if isinstance(value, list):
+                    current = merged.setdefault(key, [0] * len(value))
+                    for i, v in enumerate(value):
+                        current[i] += v
+                else:
+                    merged[key] = merged.get(key, 0) + value
+        lines = []
+        for name in sorted(types):
+            lines.append('# TYPE %s %s' % (name, types[name]))
+            for key in sorted(k for k in merged if k[0] == name):
+                labels = key[1]
+                value = merged[key]
+                if types[name] == _TYPE_COUNTER:
+                    lines.append('%s%s %s' % (name, _format_labels(labels),
+                                              _format_value(value)))
+                    continue
+                cumulative = 0
+                bounds = [_format_value(b) for b in buckets[name]] + ['+Inf']
+                for bound, count in zip(bounds, value[:-2]):
+                    cumulative += count
+                    lines.append('%s_bucket%s %d' % (
+                            name, _format_labels(labels + (('le', bound),)),
+                            cumulative))
+                lines.append('%s_sum%s %s' % (
+                        name, _format_labels(labels), _format_value(value[-2])))
+                lines.append('%s_count%s %d' % (
+                        name, _format_labels(labels), value[-1]))
+        return '\n'.join(lines) + '\n'
+
+def _process_exists(pid):
+    """True if a process with a given pid (a string) is running.
+
+    Files that are not named with a pid are kept.
+    """
+    if not pid.isdigit():
+        return True
+    try:
+        os.kill(int(pid), 0)
+    except OSError as ex:
+        # EPERM if the process exists, but belongs to other user.
+        return ex.errno != errno.ESRCH
+    return True
+
+class _Timer(object):
+    def __init__(self, registry, name, labels):
+        self._registry = registry
+        self._name = name
+        self._labels = labels
+
+    def __enter__(self):
+        self._start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._registry.observe(
+            self._name, time.time() - self._start, **self._labels)
+        return False
+
+def view_label(view_func):
+    """Returns a name that identifies a view in metrics and profiles.
+
+    Generic admin views are distinguished by a collection they serve
+    (for example 'CollectionView:users').
+    """
+    view_class = getattr(view_func, 'view_class', None)
+    if view_class is None:
+        return view_func.__name__
+    name = view_class.__name__
+    collection_name = view_func.view_initkwargs.get('collection_name')
+    if collection_name is not None:
+        name += ':' + collection_name
+    return name
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(
+        '%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"'))
+        for (k, v) in labels)
+
+def _format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+class _CountingCursorWrapper(CursorWrapper):
+    """Counts queries executed with a DB connection.
+
+    Unlike Django debug cursor, does not format and store executed
+    SQL, so it is cheap enough to be always enabled.
+    """
+
+    def execute(self, sql, params=None):
+        self.db.wwwhisper_queries_count += 1
+        return super(_CountingCursorWrapper, self).execute(sql, params)
+
+    def executemany(self, sql, param_list):
+        self.db.wwwhisper_queries_count += 1
+        return super(_CountingCursorWrapper, self).executemany(sql, param_list)
+
+def _install_queries_counter(sender, connection, **kwargs):
+    if getattr(connection, 'wwwhisper_queries_count', None) is not None:
+        return
+    connection.wwwhisper_queries_count = 0
+    connection.make_cursor = (
+        lambda cursor: _CountingCursorWrapper(cursor, connection))
+
+connection_created.connect(_install_queries_counter)
+
+def queries_count():
+    """Number of queries executed by the current thread connection."""
+    return getattr(connection, 'wwwhisper_queries_count', 0)
+
+registry = Registry(getattr(settings, 'WWWHISPER_METRICS_DIR', None))
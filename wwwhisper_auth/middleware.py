@@ -5,17 +5,58 @@ from django.conf import settings
 from django.core.urlresolvers import reverse
 from django.shortcuts import redirect
 
+from wwwhisper_auth import expiry
 from wwwhisper_auth import http
+from wwwhisper_auth import metrics
 from wwwhisper_auth.models import SINGLE_SITE_ID
 from wwwhisper_auth import url_utils
 
 import wwwhisper_auth.site_cache
 import logging
+import time
 
 logger = logging.getLogger(__name__)
 
 SECURE_PROXY_SSL_HEADER = getattr(settings, 'SECURE_PROXY_SSL_HEADER')[0]
 
+def _create_sweeper():
+    """Returns expiry.Sweeper if expired items should be deleted or None."""
+    interval = getattr(settings, 'WWWHISPER_EXPIRY_SWEEP_INTERVAL', None)
+    if not interval:
+        return None
+    return expiry.Sweeper(interval)
+
+class MetricsMiddleware(object):
+    """Records latency and DB queries count of each request.
+
+    Should be the first middleware, so time spent in all other
+    middlewares is also measured. Metrics are labeled with a name of
+    a view that handled the request.
+    """
+
+    def process_request(self, request):
+        request.metrics_start = (time.time(), metrics.queries_count())
+        request.metrics_view = 'unresolved'
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.metrics_view = metrics.view_label(view_func)
+        return None
+
+    def process_response(self, request, response):
+        start = getattr(request, 'metrics_start', None)
+        if start is None:
+            return response
+        start_time, start_queries = start
+        view = request.metrics_view
+        registry = metrics.registry
+        registry.observe('wwwhisper_request_duration_seconds',
+                         time.time() - start_time, view=view)
+        registry.observe('wwwhisper_request_db_queries',
+                         metrics.queries_count() - start_queries,
+                         buckets=metrics.QUERIES_BUCKETS, view=view)
+        registry.maybe_flush()
+        return response
+
 class SetSiteMiddleware(object):
     """Associates a request with the only site that is in a db.
 
@@ -27,10 +68,77 @@ class SetSiteMiddleware(object):
 
     def __init__(self):
         self.sites = wwwhisper_auth.site_cache.CachingSitesCollection()
+        self.sweeper = _create_sweeper()
+        if getattr(settings, 'WWWHISPER_PRELOAD_SITES', False):
+            # uWSGI creates middlewares in the master process, before
+            # workers are forked, so all workers start with the warm
+            # site snapshot shared copy-on-write.
+            wwwhisper_auth.site_cache.warm_up.run(
+                self.sites, [SINGLE_SITE_ID],
+                block=not getattr(
+                    settings, 'WWWHISPER_WARM_UP_IN_BACKGROUND', False))
 
     def process_request(self, request):
+        if self.sweeper is not None:
+            self.sweeper.ensure_running()
         request.site = self.sites.find_item(SINGLE_SITE_ID)
 
+class MultiTenantSiteMiddleware(object):
+    """Associates a request with a site that has the Site-Url alias.
+
+    Used instead of SetSiteMiddleware when a single wwwhisper instance
+    serves multiple sites (WWWHISPER_MULTI_TENANT setting). A site is
+    found with the in memory index of aliases of all sites
+    (site_cache.AliasIndex), so requests do not query the DB for it.
+
+    If Site-Url is http://host_foo and only https://host_foo is
+    allowed, the site with the https alias is used, so the
+    SiteUrlMiddleware (that must follow this middleware) can redirect
+    the request to https.
+    """
+
+    def __init__(self):
+        self.sites = wwwhisper_auth.site_cache.CachingSitesCollection()
+        self.alias_index = wwwhisper_auth.site_cache.alias_index
+        self.sweeper = _create_sweeper()
+        if getattr(settings, 'WWWHISPER_PRELOAD_SITES', False):
+            wwwhisper_auth.site_cache.warm_up.run(
+                self.sites, None,
+                block=not getattr(
+                    settings, 'WWWHISPER_WARM_UP_IN_BACKGROUND', False))
+
+    def _find_site(self, url):
+        # The second attempt is made if the index is out of date: the
+        # alias was removed or moved to other site by other process.
+        for _ in xrange(2):
+            site_id = self.alias_index.find_site_id(url)
+            if site_id is None:
+                return None
+            site = self.sites.find_item(site_id)
+            if (site is not None and
+                site.aliases.find_item_by_url(url) is not None):
+                return site
+            self.alias_index.invalidate()
+        return None
+
+    def process_request(self, request):
+        if self.sweeper is not None:
+            self.sweeper.ensure_running()
+        url = request.META.get('HTTP_SITE_URL', None)
+        if url is None:
+            return http.HttpResponseBadRequest('Missing Site-Url header')
+        url = url_utils.remove_default_port(url)
+        site = self._find_site(url)
+        if site is None and url.startswith('http://'):
+            site = self._find_site('https://' + url[len('http://'):])
+        if site is None:
+            msg = 'Invalid request URL, you can use wwwhisper admin to ' \
+                'allow requests from this address.'
+            logger.warning(msg)
+            return http.HttpResponseBadRequest(msg)
+        request.site = site
+        return None
+
 class SiteUrlMiddleware(object):
     """Validates and sets site_url for the request.
 
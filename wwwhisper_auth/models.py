@@ -6,8 +6,12 @@
 Each site has users, locations (paths) and permissions - rules that
 define which user can access which locations. Sites are
 isolated. Users and locations are associated with a single site and
-are used only for this site. Site has also aliases: urls that can be
-used to access the site, only requests from these urls are allowed.
+are used only for this site. Users can be also members of groups,
+access to a location can be granted to a whole group. Site has also
+aliases: urls that can be used to access the site, only requests from
+these urls are allowed. Users and permissions can have an expiration
+time, after which they are no longer valid. Approximate counts of
+accesses to locations are kept for each user.
 
 Provides methods that map to REST operations that can be performed on
 users, locations and permissions resources. Allows to retrieve
@@ -21,21 +25,29 @@ because those ids can be reused after object is deleted.
 Makes sure entered emails and paths are valid.
 """
 
+from django.conf import settings
 from django.contrib.auth.models import AbstractBaseUser
+from django.db import DEFAULT_DB_ALIAS
 from django.db import connection
 from django.db import models
 from django.db import IntegrityError
+from django.db import transaction
 from django.forms import ValidationError
 from django.utils import timezone
+from django.utils.dateparse import parse_datetime
 
 from functools import wraps
+from wwwhisper_auth import  metrics
+from wwwhisper_auth import  path_matcher
 from wwwhisper_auth import  url_utils
 from wwwhisper_auth import  email_re
 
+import heapq
 import logging
 import random
 import re
 import threading
+import time
 import uuid as uuidgen
 
 logger = logging.getLogger(__name__)
@@ -61,13 +73,16 @@ class ValidatedModel(models.Model):
         self.full_clean()
         return super(ValidatedModel, self).save(*args, **kwargs)
 
+    def as_model(self):
+        return self
+
 # Id used when wwwhisper servers just a single site.
 SINGLE_SITE_ID = 'theone'
 
 class Site(ValidatedModel):
     """A site to which access is protected.
 
-    Site has locations, users and aliases.
+    Site has locations, users, groups and aliases.
 
     Attributes:
       site_id: Can be a domain or any other string.
@@ -96,6 +111,7 @@ class Site(ValidatedModel):
     aliases_limit = None
     users_limit = None
     locations_limit = None
+    groups_limit = None
 
     def __init__(self, *args, **kwargs):
         super(Site, self).__init__(*args, **kwargs)
@@ -103,28 +119,80 @@ class Site(ValidatedModel):
         # thread.
         self.mod_id_lock = threading.Lock()
 
-    def heavy_init(self):
+    def heavy_init(self, cached=None):
         """Creates collections of all site-related data.
 
         This is a resource intensive operation that retrieves all site
         related data from the database. It is only performed if the site
         was modified since it was last retrieved.
+
+        Args:
+           cached: Data returned by export_cache(). If given, the
+              collections are filled with this data, without querying
+              the database.
+        """
+        if cached is None:
+            cached = {}
+        # Before locations, which use members of groups.
+        self.groups = GroupsCollection(self, cached.get('groups'))
+        self.locations = LocationsCollection(self, cached.get('locations'))
+        self.users = UsersCollection(self, cached.get('users'))
+        self.aliases = AliasesCollection(self, cached.get('aliases'))
+        self.access_stats = AccessStats(self)
+
+    def export_cache(self):
+        """Returns json serializable copy of the site with all data.
+
+        The copy is used to recreate the site without querying the
+        database (see snapshot_cache.py). Returns None if caches of
+        the site collections are not all up to date.
         """
-        self.locations = LocationsCollection(self)
-        self.users = UsersCollection(self)
-        self.aliases = AliasesCollection(self)
+        mod_id = self.get_mod_id_ts()
+        collections = (self.locations, self.users, self.aliases, self.groups)
+        if any(collection.cache_mod_id != mod_id
+               for collection in collections):
+            return None
+        fields = dict((field.attname, getattr(self, field.attname))
+                      for field in self._meta.concrete_fields)
+        fields['mod_id'] = mod_id
+        return {
+            'fields': fields,
+            'locations': self.locations.export_cache(),
+            'users': self.users.export_cache(),
+            'aliases': self.aliases.export_cache(),
+            'groups': self.groups.export_cache(),
+        }
+
+    @classmethod
+    def from_cache(cls, cached):
+        """Recreates a site from data returned by export_cache()."""
+        field_names = [field.attname for field in cls._meta.concrete_fields]
+        site = cls.from_db(DEFAULT_DB_ALIAS, field_names,
+                           [cached['fields'][name] for name in field_names])
+        site.heavy_init(cached)
+        return site
 
-    def site_modified(self):
+    def site_modified(self, revoking=False):
         """Increases the site modification id.
 
         This causes the site to be refreshed in web processes caches.
+
+        Args:
+           revoking: True if the modification can revoke access (for
+              example, deletes a user or a permission). Caches that
+              serve stale sites while reloading them never serve
+              sites from before such modification.
         """
-        cursor = connection.cursor()
-        cursor.execute(
-            'UPDATE wwwhisper_auth_site '
-            'SET mod_id = mod_id + 1 WHERE site_id = %s', [self.site_id])
-        cursor.close()
-        mod_id = self.mod_id_from_db()
+        with transaction.atomic():
+            cursor = connection.cursor()
+            cursor.execute(
+                'UPDATE wwwhisper_auth_site '
+                'SET mod_id = mod_id + 1 WHERE site_id = %s', [self.site_id])
+            cursor.close()
+            mod_id = self.mod_id_from_db()
+            if revoking:
+                SiteRevocation.objects.update_or_create(
+                    site_id=self.site_id, defaults={'mod_id': mod_id})
         with self.mod_id_lock:
             self.mod_id = mod_id
 
@@ -166,21 +234,133 @@ class Site(ValidatedModel):
             return None
         return row[0]
 
-def modify_site(decorated_method):
-    """Must decorate all methods that change data associated with the site.
+    def revoke_mod_id_from_db(self):
+        """Retrieves from the DB a modification id of the last revoking change.
 
-    Makes sure site is marked as modified and other Django processes
-    will retrieve new data from the DB instead of using cached data.
+        Returns 0 if access was never revoked, None if the site no
+        longer exists in the DB.
+        """
+        cursor = connection.cursor()
+        cursor.execute(
+            'SELECT r.mod_id FROM wwwhisper_auth_site s '
+            'LEFT OUTER JOIN wwwhisper_auth_siterevocation r '
+            'ON r.site_id = s.site_id WHERE s.site_id = %s', [self.site_id])
+        row = cursor.fetchone()
+        cursor.close()
+        if row is None:
+            return None
+        return row[0] or 0
+
+class SiteRevocation(models.Model):
+    """Records the last modification of a site that could revoke access.
+
+    Kept in a separate table, so the table is created for existing
+    DBs by 'migrate --run-syncdb'.
+
+    Attributes:
+      site: The site.
+      mod_id: Modification id of the site after the revoking change.
     """
+    class Meta:
+        app_label = 'wwwhisper_auth'
 
+    site = models.OneToOneField(Site, primary_key=True, related_name='+')
+    mod_id = models.IntegerField(default=0)
+
+def _wrap_site_modifier(decorated_method, revoking):
     @wraps(decorated_method)
     def wrapper(self, *args, **kwargs):
         result = decorated_method(self, *args, **kwargs)
         # If no exception.
-        self.site.site_modified()
+        self.site.site_modified(revoking=revoking)
         return result
     return wrapper
 
+def modify_site(decorated_method):
+    """Must decorate all methods that change data associated with the site.
+
+    Makes sure site is marked as modified and other Django processes
+    will retrieve new data from the DB instead of using cached data.
+    """
+    return _wrap_site_modifier(decorated_method, revoking=False)
+
+def modify_site_revoking(decorated_method):
+    """Like modify_site, but for methods that can revoke access."""
+    return _wrap_site_modifier(decorated_method, revoking=True)
+
+class CachedRecord(object):
+    """Lightweight copy of a model instance, stored in collection caches.
+
+    Records are created from values_list() rows, which is much faster
+    and takes much less memory than creating model instances. Records
+    hold only fields needed by auth and admin reads. A model instance,
+    needed to modify or delete an item, is created with as_model()
+    (without querying the DB).
+
+    Attributes (Need to be defined in subclasses):
+        model_class: Model that manages storage of the items.
+        fields: Names of the model fields held by the record (must
+            include 'id').
+    """
+    __slots__ = ('site',)
+
+    def __init__(self, site, values):
+        self.site = site
+        for (field, value) in zip(self.fields, values):
+            setattr(self, field, value)
+
+    @classmethod
+    def from_model(cls, item, site):
+        return cls(site, [getattr(item, field) for field in cls.fields])
+
+    def to_json(self):
+        """Returns values of the record fields that can be json encoded."""
+        return [getattr(self, field) for field in self.fields]
+
+    @classmethod
+    def values_from_json(cls, values):
+        """Reverses to_json()."""
+        return values
+
+    @property
+    def site_id(self):
+        return self.site.site_id
+
+    def as_model(self):
+        """Returns a model instance with fields of the record.
+
+        Fields that are not held by the record are deferred, Django
+        retrieves them from the DB on access and does not overwrite
+        them on save.
+        """
+        values = dict((field, getattr(self, field)) for field in self.fields)
+        values['site_id'] = self.site.site_id
+        field_names = [field.attname for field
+                       in self.model_class._meta.concrete_fields
+                       if field.attname in values]
+        item = self.model_class.from_db(
+            DEFAULT_DB_ALIAS, field_names,
+            [values[name] for name in field_names])
+        # Use already retrieved site, do not retrieve it again.
+        item.site = self.site
+        return item
+
+    def delete(self):
+        self.as_model().delete()
+
+    def __eq__(self, other):
+        # A record is equal to a model instance that it represents.
+        if isinstance(other, self.model_class):
+            return self.id == other.id
+        return (isinstance(other, CachedRecord) and
+                self.model_class is other.model_class and
+                self.id == other.id)
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash((self.model_class, self.id))
 
 class SitesCollection(object):
     def create_item(self, site_id, **kwargs):
@@ -210,7 +390,32 @@ class SitesCollection(object):
         site.delete()
         return True
 
-class User(AbstractBaseUser):
+class _UserMethods(object):
+    """Methods shared by User model and cached UserRecord."""
+    __slots__ = ()
+
+    def attributes_dict(self, site_url, location_id=None):
+        """Returns externally visible attributes of the user resource.
+
+        If location_id is given, hits and last seen time are of
+        accesses of the user to this location only.
+        """
+        result = {'email': self.email}
+        expires_at = self.site.users.get_expiration(self.id)
+        if expires_at is not None:
+            result['expiresAt'] = expires_at.isoformat()
+        access_stats = self.site.access_stats
+        _add_access_stats(
+            access_stats.for_user(self.id) if location_id is None
+            else access_stats.for_location_user(location_id, self.id),
+            result)
+        return _add_common_attributes(self, site_url, result)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('wwwhisper_user', (), {'uuid' : self.uuid})
+
+class User(_UserMethods, AbstractBaseUser):
     class Meta:
         app_label = 'wwwhisper_auth'
         unique_together = ('site', 'email')
@@ -227,71 +432,66 @@ class User(AbstractBaseUser):
     USERNAME_FIELD = 'uuid'
     REQUIRED_FIELDS = ['email', 'site']
 
-    def attributes_dict(self, site_url):
-        """Returns externally visible attributes of the user resource."""
-        return _add_common_attributes(self, site_url, {'email': self.email})
+    # True for instances created by DomainUserRecord.as_model().
+    is_domain_user = False
 
-    @models.permalink
-    def get_absolute_url(self):
-        return ('wwwhisper_user', (), {'uuid' : self.uuid})
+    def as_model(self):
+        return self
 
-    @modify_site
     def login_successful(self):
         """Must be called after successful login."""
         # Successful login updates User.last_login, cache refresh
         # needs to be forced for the login token to be invalidated.
-        return
+        # Domain users are not cached, they are always retrieved
+        # from the DB by login token checks.
+        if not self.is_domain_user:
+            self.site.site_modified(revoking=True)
 
-class Location(ValidatedModel):
-    """A location for which access control rules are defined.
+class UserRecord(_UserMethods, CachedRecord):
+    """Cached user (see CachedRecord)."""
+    model_class = User
+    fields = ('id', 'uuid', 'email', 'last_login')
+    __slots__ = fields
 
-    Location is uniquely identified by its canonical path. All access
-    control rules defined for a location apply also to sub-paths,
-    unless a more specific location exists. In such case the more
-    specific location takes precedence over the more generic one.
+    def login_successful(self):
+        self.as_model().login_successful()
 
-    For example, if a location with a path /pub is defined and a user
-    foo@example.com is granted access to this location, the user can
-    access /pub and all sub path of /pub. But if a location with a
-    path /pub/beer is added, and the user foo@example.com is not
-    granted access to this location, the user won't be able to access
-    /pub/beer and all its sub-paths.
+    def to_json(self):
+        values = super(UserRecord, self).to_json()
+        if self.last_login is not None:
+            values[3] = self.last_login.isoformat()
+        return values
 
-    Attributes:
-      site: Site to which the location belongs.
-      path: Canonical path of the location.
-      uuid: Externally visible UUID of the location, allows to identify a REST
-          resource representing the location.
+    @classmethod
+    def values_from_json(cls, values):
+        if values[3] is not None:
+            values[3] = parse_datetime(values[3])
+        return values
 
-      open_access: can be:
-        disabled ('n') - only explicitly allowed users can access a location;
-        enabled ('y') - everyone can access a location, no login is required;
-        (the attribute is a char not a bool for historical
-         reasons. 'a' mode used to be also supported that allowed
-         everyone access but required authentication).
+class DomainUserRecord(UserRecord):
+    """User created at a login because of a domain grant.
 
+    Such records are not cached with other users of the site (see
+    UsersCollection.create_domain_user).
     """
-    class Meta:
-        app_label = 'wwwhisper_auth'
-        unique_together = ('site', 'path')
+    __slots__ = ()
 
-    OPEN_ACCESS_CHOICES = (
-        ('n', 'no open access'),
-        ('y', 'open access'),
-        )
-    site = models.ForeignKey(Site, related_name='+')
-    path = models.TextField(db_index=True)
-    uuid = models.CharField(max_length=36, db_index=True,
-                            editable=False, unique=True)
-    open_access = models.CharField(max_length=2, choices=OPEN_ACCESS_CHOICES,
-                                   default='n')
+    def as_model(self):
+        item = super(DomainUserRecord, self).as_model()
+        item.is_domain_user = True
+        return item
 
-    def __init__(self, *args, **kwargs):
-        super(Location, self).__init__(*args, **kwargs)
+    def login_successful(self):
+        self.as_model().login_successful()
+
+class _LocationMethods(object):
+    """Methods shared by Location model and cached LocationRecord."""
+    __slots__ = ()
 
-    def permissions(self):
+    def allowed_user_ids(self):
+        """Returns a frozenset with ids of users granted access."""
         # Does not run a query to get permissions if not needed.
-        return self.site.locations.get_permissions(self.id)
+        return self.site.locations.get_allowed_user_ids(self.id)
 
     def __unicode__(self):
         return "%s" % (self.path)
@@ -301,39 +501,41 @@ class Location(ValidatedModel):
         """Constructs URL of the location resource."""
         return ('wwwhisper_location', (), {'uuid' : self.uuid})
 
-    @modify_site
-    def grant_open_access(self):
-        """Allows to access the location without authentication."""
-        self.open_access = 'y'
-        self.save()
-
     def open_access_granted(self):
         return self.open_access == 'y'
 
-    @modify_site
-    def revoke_open_access(self):
-        self.open_access = 'n'
-        self.save()
+    def allowed_group_ids(self):
+        """Returns a frozenset with ids of groups granted access."""
+        return self.site.locations.get_allowed_group_ids(self.id)
+
+    def allowed_domains(self):
+        """Returns a frozenset of email domains granted access."""
+        return self.site.locations.get_allowed_domains(self.id)
 
     def can_access(self, user):
         """Determines if a user can access the location.
 
         Returns:
-            True if the user is granted permission to access the
-            location or it the location is open.
+            True if the user, a group of the user or the email domain
+            of the user is granted permission to access the location
+            or it the location is open.
         """
         # Sanity check (this should normally be ensured by the caller).
         if user.site_id != self.site_id:
             return False
         return (self.open_access_granted()
-                or self.permissions().get(user.id) != None)
+                or self.site.locations.is_user_allowed(self.id, user))
 
-    @modify_site
-    def grant_access(self, user_uuid):
+    def grant_access(self, user_uuid, expires_at=None):
         """Grants access to the location to a given user.
 
         Args:
             user_uuid: string UUID of a user.
+            expires_at: Optional datetime (or ISO 8601 string) after
+                which the access is revoked. If the user already had
+                granted access, the expiration time is replaced (a
+                modification that can revoke access if the access
+                expires earlier than before).
 
         Returns:
             (new Permission object, True) if access to the location was
@@ -344,19 +546,38 @@ class Location(ValidatedModel):
         Raises:
             LookupError: A site to which location belongs has no user
                 with a given UUID.
+            ValidationError: expires_at is invalid.
         """
+        expires_at = validate_expiration(expires_at)
         user = self.site.users.find_item(uuid=user_uuid)
         if user is None:
             raise LookupError('User not found')
-        permission = self.permissions().get(user.id)
-        created = False
-        if permission is None:
-            created = True
-            permission = Permission.objects.create(
-                http_location_id=self.id, user_id=user.id, site_id=self.site_id)
+        revoking = False
+        with transaction.atomic():
+            # Not decided with the cache: expired permissions are
+            # dropped from the cache before the sweep deletes them
+            # from the DB, such permissions are reused.
+            permission = _find(Permission, http_location_id=self.id,
+                               user_id=user.id)
+            if permission is not None:
+                previous_expires_at = permission.get_expiration()
+                created = (previous_expires_at is not None and
+                           previous_expires_at <= timezone.now())
+                revoking = not created and expires_at is not None and (
+                    previous_expires_at is None or
+                    expires_at < previous_expires_at)
+            else:
+                permission = Permission.objects.create(
+                    http_location_id=self.id, user_id=user.id,
+                    site_id=self.site_id)
+                created = True
+            permission.http_location = self.as_model()
+            permission.user = user.as_model()
+            permission.set_expiration(expires_at)
+        self.site.site_modified(revoking=revoking)
         return (permission, created)
 
-    @modify_site
+    @modify_site_revoking
     def revoke_access(self, user_uuid):
         """Revokes access to the location from a given user.
 
@@ -367,8 +588,9 @@ class Location(ValidatedModel):
             LookupError: Site has no user with a given UUID or the
                 user can not access the location.
         """
-        permission = self.get_permission(user_uuid)
-        permission.delete()
+        user = self._find_allowed_user(user_uuid)
+        Permission.objects.filter(
+            http_location_id=self.id, user_id=user.id).delete()
 
     def get_permission(self, user_uuid):
         """Gets Permission object for a given user.
@@ -380,35 +602,268 @@ class Location(ValidatedModel):
             LookupError: No user with a given UUID or the user can not
                 access the location.
         """
+        return self._get_permission(self._find_allowed_user(user_uuid))
+
+    def _find_allowed_user(self, user_uuid):
         user = self.site.users.find_item(uuid=user_uuid)
         if user is None:
             raise LookupError('User not found.')
-        permission = self.permissions().get(user.id)
+        if user.id not in self.allowed_user_ids():
+            raise LookupError('User can not access location.')
+        return user
+
+    def _get_permission(self, user):
+        # The cache stores only ids of allowed users, Permission
+        # objects are needed only by the admin API and are retrieved
+        # from the DB.
+        permission = _find(Permission, http_location_id=self.id,
+                           user_id=user.id)
         if permission is None:
+            # Removed by another process.
             raise LookupError('User can not access location.')
+        # Use already retrieved objects, do not retrieve them again.
+        permission.http_location = self.as_model()
+        permission.user = user.as_model()
+        return permission
+
+    @modify_site
+    def grant_group_access(self, group_uuid):
+        """Grants access to the location to all members of a group.
+
+        Args:
+            group_uuid: string UUID of a group.
+
+        Returns:
+            (new GroupPermission object, True) if access to the
+                location was successfully granted.
+            (existing GroupPermission object, False) if the group
+                already had granted access to the location.
+
+        Raises:
+            LookupError: A site to which location belongs has no group
+                with a given UUID.
+        """
+        group = self.site.groups.find_item(uuid=group_uuid)
+        if group is None:
+            raise LookupError('Group not found.')
+        if group.id in self.allowed_group_ids():
+            return (self._get_group_permission(group), False)
+        permission = GroupPermission.objects.create(
+            http_location_id=self.id, group_id=group.id, site_id=self.site_id)
+        return (permission, True)
+
+    @modify_site_revoking
+    def revoke_group_access(self, group_uuid):
+        """Revokes access to the location from members of a group.
+
+        Members of the group can still access the location if they
+        are granted access directly or through other group.
+
+        Raises:
+            LookupError: Site has no group with a given UUID or the
+                group can not access the location.
+        """
+        group = self._find_allowed_group(group_uuid)
+        GroupPermission.objects.filter(
+            http_location_id=self.id, group_id=group.id).delete()
+
+    def get_group_permission(self, group_uuid):
+        """Gets GroupPermission object for a given group.
+
+        Raises:
+            LookupError: No group with a given UUID or the group can
+                not access the location.
+        """
+        return self._get_group_permission(self._find_allowed_group(group_uuid))
+
+    def _find_allowed_group(self, group_uuid):
+        group = self.site.groups.find_item(uuid=group_uuid)
+        if group is None:
+            raise LookupError('Group not found.')
+        if group.id not in self.allowed_group_ids():
+            raise LookupError('Group can not access location.')
+        return group
+
+    def _get_group_permission(self, group):
+        permission = _find(GroupPermission, http_location_id=self.id,
+                           group_id=group.id)
+        if permission is None:
+            # Removed by another process.
+            raise LookupError('Group can not access location.')
+        permission.http_location = self.as_model()
+        permission.group = group.as_model()
+        return permission
+
+    @modify_site
+    def grant_domain_access(self, domain):
+        """Grants access to the location to all users of an email domain.
+
+        Users with emails in the domain do not need to be added to
+        the site, a user is created at the first login.
+
+        Args:
+            domain: string domain (for example 'example.com').
+
+        Returns:
+            (new DomainPermission object, True) if access to the
+                location was successfully granted.
+            (existing DomainPermission object, False) if the domain
+                already had granted access to the location.
+
+        Raises:
+            ValidationError: The domain is invalid.
+        """
+        domain = LocationsCollection.validate_domain(domain)
+        if domain in self.allowed_domains():
+            return (self._get_domain_permission(domain), False)
+        permission = DomainPermission.objects.create(
+            http_location_id=self.id, domain=domain, site_id=self.site_id)
+        return (permission, True)
+
+    @modify_site_revoking
+    def revoke_domain_access(self, domain):
+        """Revokes access to the location from users of an email domain.
+
+        Users created at the first login are not removed.
+
+        Raises:
+            LookupError: The domain can not access the location.
+        """
+        domain = self._find_allowed_domain(domain)
+        DomainPermission.objects.filter(
+            http_location_id=self.id, domain=domain).delete()
+
+    def get_domain_permission(self, domain):
+        """Gets DomainPermission object for a given domain.
+
+        Raises:
+            LookupError: The domain can not access the location.
+        """
+        return self._get_domain_permission(self._find_allowed_domain(domain))
+
+    def _find_allowed_domain(self, domain):
+        domain = _encode_domain(domain)
+        if domain is None or domain not in self.allowed_domains():
+            raise LookupError('Domain can not access location.')
+        return domain
+
+    def _get_domain_permission(self, domain):
+        permission = _find(DomainPermission, http_location_id=self.id,
+                           domain=domain)
+        if permission is None:
+            # Removed by another process.
+            raise LookupError('Domain can not access location.')
+        permission.http_location = self.as_model()
         return permission
 
     def allowed_users(self):
         """"Returns a list of users that can access the location."""
-        # The code could access permission.user like this:
-        # [perm.user for perm in self.permissions().itervalues()]
-        # but this involves a single DB query per allowed user, going
-        # through cached site.users involves no queries.
-        return [self.site.users.find_item_by_pk(user_id)
-                for user_id in self.permissions().iterkeys()]
+        # Going through cached site.users involves no queries.
+        return _find_users(self.site, self.allowed_user_ids())
+
+    def allowed_groups(self):
+        """"Returns a list of groups that can access the location."""
+        return [self.site.groups.find_item_by_pk(group_id)
+                for group_id in self.allowed_group_ids()]
 
     def attributes_dict(self, site_url):
-        """Returns externally visible attributes of the location resource."""
+        """Returns externally visible attributes of the location resource.
+
+        Groups are listed without members, so the size of the
+        representation does not depend on sizes of the groups.
+        """
         result = {
             'path': self.path,
             'allowedUsers': [
-                user.attributes_dict(site_url) for user in self.allowed_users()
+                user.attributes_dict(site_url, location_id=self.id)
+                for user in self.allowed_users()
+                ],
+            'allowedGroups': [
+                group.attributes_dict(site_url, with_members=False)
+                for group in self.allowed_groups()
                 ],
+            'allowedDomains': sorted(self.allowed_domains()),
             }
         if self.open_access_granted():
             result['openAccess'] = True
+        _add_access_stats(
+            self.site.access_stats.for_location(self.id), result)
         return _add_common_attributes(self, site_url, result)
 
+class Location(_LocationMethods, ValidatedModel):
+    """A location for which access control rules are defined.
+
+    Location is uniquely identified by its canonical path. All access
+    control rules defined for a location apply also to sub-paths,
+    unless a more specific location exists. In such case the more
+    specific location takes precedence over the more generic one.
+
+    For example, if a location with a path /pub is defined and a user
+    foo@example.com is granted access to this location, the user can
+    access /pub and all sub path of /pub. But if a location with a
+    path /pub/beer is added, and the user foo@example.com is not
+    granted access to this location, the user won't be able to access
+    /pub/beer and all its sub-paths.
+
+    Path segments can be wildcards: '*' matches a single segment and
+    '**' any number of segments, so a single /users/*/private/
+    location can define access to private directories of all users
+    (see path_matcher.py).
+
+    Attributes:
+      site: Site to which the location belongs.
+      path: Canonical path of the location (can include wildcards).
+      uuid: Externally visible UUID of the location, allows to identify a REST
+          resource representing the location.
+
+      open_access: can be:
+        disabled ('n') - only explicitly allowed users can access a location;
+        enabled ('y') - everyone can access a location, no login is required;
+        (the attribute is a char not a bool for historical
+         reasons. 'a' mode used to be also supported that allowed
+         everyone access but required authentication).
+
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('site', 'path')
+
+    OPEN_ACCESS_CHOICES = (
+        ('n', 'no open access'),
+        ('y', 'open access'),
+        )
+    site = models.ForeignKey(Site, related_name='+')
+    path = models.TextField(db_index=True)
+    uuid = models.CharField(max_length=36, db_index=True,
+                            editable=False, unique=True)
+    open_access = models.CharField(max_length=2, choices=OPEN_ACCESS_CHOICES,
+                                   default='n')
+
+    @modify_site
+    def grant_open_access(self):
+        """Allows to access the location without authentication."""
+        self.open_access = 'y'
+        self.save()
+
+    @modify_site_revoking
+    def revoke_open_access(self):
+        self.open_access = 'n'
+        self.save()
+
+class LocationRecord(_LocationMethods, CachedRecord):
+    """Cached location (see CachedRecord)."""
+    model_class = Location
+    fields = ('id', 'path', 'uuid', 'open_access')
+    __slots__ = fields
+
+    def grant_open_access(self):
+        self.as_model().grant_open_access()
+        self.open_access = 'y'
+
+    def revoke_open_access(self):
+        self.as_model().revoke_open_access()
+        self.open_access = 'n'
+
 class Permission(ValidatedModel):
     """Connects a location with a user that can access the location.
 
@@ -431,12 +886,278 @@ class Permission(ValidatedModel):
                 {'location_uuid' : self.http_location.uuid,
                  'user_uuid': self.user.uuid})
 
+    def get_expiration(self):
+        """Returns time after which the permission expires or None."""
+        expiration = _find(PermissionExpiration, permission_id=self.id)
+        if expiration is None:
+            return None
+        return expiration.expires_at
+
+    def set_expiration(self, expires_at):
+        """Sets time after which the permission expires (None to never)."""
+        if expires_at is None:
+            PermissionExpiration.objects.filter(permission_id=self.id).delete()
+        else:
+            PermissionExpiration.objects.update_or_create(
+                permission_id=self.id,
+                defaults={'site_id': self.site_id, 'expires_at': expires_at})
+
     def attributes_dict(self, site_url):
         """Returns externally visible attributes of the permission resource."""
+        result = {'user': self.user.attributes_dict(site_url)}
+        expires_at = self.get_expiration()
+        if expires_at is not None:
+            result['expiresAt'] = expires_at.isoformat()
+        return _add_common_attributes(self, site_url, result)
+
+class PermissionExpiration(models.Model):
+    """Time after which a permission expires.
+
+    Kept in a separate table, so the table is created for existing
+    DBs by 'migrate --run-syncdb'. Cached sites stop honoring an
+    expired permission at the expiration time, the row is deleted
+    later by the sweeper (see expiry.py).
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+
+    permission = models.OneToOneField(
+        Permission, primary_key=True, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+    expires_at = models.DateTimeField(db_index=True)
+
+class DomainUser(models.Model):
+    """Marks a user created at a login because of a domain grant.
+
+    A site with domain grants can have many such users, so these are
+    not loaded with other users of the site, but retrieved from the
+    DB when needed. Kept in a separate table, so the table is created
+    for existing DBs by 'migrate --run-syncdb'.
+
+    Attributes:
+      user: The user, deleting it deletes the row.
+      site: Site of the user.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+
+    user = models.OneToOneField(User, primary_key=True, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+
+class UserExpiration(models.Model):
+    """Time after which a user expires (see PermissionExpiration)."""
+    class Meta:
+        app_label = 'wwwhisper_auth'
+
+    user = models.OneToOneField(User, primary_key=True, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+    expires_at = models.DateTimeField(db_index=True)
+
+class _GroupMethods(object):
+    """Methods shared by Group model and cached GroupRecord."""
+    __slots__ = ()
+
+    def __unicode__(self):
+        return "%s" % (self.name)
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('wwwhisper_group', (), {'uuid' : self.uuid})
+
+    def member_ids(self):
+        """Returns a frozenset with ids of users that belong to the group."""
+        return self.site.groups.get_member_ids(self.id)
+
+    def members(self):
+        """Returns a list of users that belong to the group."""
+        return _find_users(self.site, self.member_ids())
+
+    @modify_site
+    def add_member(self, user_uuid):
+        """Adds a given user to the group.
+
+        Args:
+            user_uuid: string UUID of a user.
+
+        Returns:
+            (new GroupMembership object, True) if the user was added.
+            (existing GroupMembership object, False) if the user
+                already belonged to the group.
+
+        Raises:
+            LookupError: A site to which group belongs has no user
+                with a given UUID.
+        """
+        user = self.site.users.find_item(uuid=user_uuid)
+        if user is None:
+            raise LookupError('User not found.')
+        if user.id in self.member_ids():
+            return (self._get_membership(user), False)
+        membership = GroupMembership.objects.create(
+            group_id=self.id, user_id=user.id, site_id=self.site_id)
+        membership.group = self.as_model()
+        membership.user = user.as_model()
+        return (membership, True)
+
+    @modify_site_revoking
+    def remove_member(self, user_uuid):
+        """Removes a given user from the group.
+
+        Raises:
+            LookupError: Site has no user with a given UUID or the
+                user does not belong to the group.
+        """
+        user = self._find_member(user_uuid)
+        GroupMembership.objects.filter(
+            group_id=self.id, user_id=user.id).delete()
+
+    def get_membership(self, user_uuid):
+        """Gets GroupMembership object for a given user.
+
+        Raises:
+            LookupError: No user with a given UUID or the user does
+                not belong to the group.
+        """
+        return self._get_membership(self._find_member(user_uuid))
+
+    def _find_member(self, user_uuid):
+        user = self.site.users.find_item(uuid=user_uuid)
+        if user is None:
+            raise LookupError('User not found.')
+        if user.id not in self.member_ids():
+            raise LookupError('User is not a member of the group.')
+        return user
+
+    def _get_membership(self, user):
+        membership = _find(GroupMembership, group_id=self.id, user_id=user.id)
+        if membership is None:
+            # Removed by another process.
+            raise LookupError('User is not a member of the group.')
+        membership.group = self.as_model()
+        membership.user = user.as_model()
+        return membership
+
+    def attributes_dict(self, site_url, with_members=True):
+        """Returns externally visible attributes of the group resource."""
+        result = {'name': self.name}
+        if with_members:
+            result['members'] = [
+                user.attributes_dict(site_url) for user in self.members()]
+        return _add_common_attributes(self, site_url, result)
+
+class Group(_GroupMethods, ValidatedModel):
+    """A named set of users of a site.
+
+    Access to a location can be granted to a group, all members of
+    the group can then access the location. Granting a team of N
+    users access to M locations takes N memberships and M group
+    permissions, instead of N * M permissions.
+
+    Attributes:
+      site: Site to which the group belongs.
+      name: Name of the group, unique within the site.
+      uuid: Externally visible UUID of the group.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('site', 'name')
+
+    site = models.ForeignKey(Site, related_name='+')
+    name = models.CharField(max_length=100)
+    uuid = models.CharField(max_length=36, db_index=True,
+                            editable=False, unique=True)
+
+class GroupRecord(_GroupMethods, CachedRecord):
+    """Cached group (see CachedRecord)."""
+    model_class = Group
+    fields = ('id', 'uuid', 'name')
+    __slots__ = fields
+
+class GroupMembership(ValidatedModel):
+    """Connects a group with a user that belongs to the group."""
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('group', 'user')
+
+    group = models.ForeignKey(Group, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+    user = models.ForeignKey(User, related_name='+')
+
+    @models.permalink
+    def get_absolute_url(self):
+        """Constructs URL of the membership resource."""
+        return ('wwwhisper_group_member', (),
+                {'group_uuid' : self.group.uuid,
+                 'user_uuid': self.user.uuid})
+
+    def attributes_dict(self, site_url):
+        """Returns externally visible attributes of the membership resource."""
         return _add_common_attributes(
             self, site_url, {'user': self.user.attributes_dict(site_url)})
 
-class Alias(ValidatedModel):
+class GroupPermission(ValidatedModel):
+    """Connects a location with a group that can access the location."""
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('http_location', 'group')
+
+    http_location = models.ForeignKey(Location, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+    group = models.ForeignKey(Group, related_name='+')
+
+    @models.permalink
+    def get_absolute_url(self):
+        """Constructs URL of the group permission resource."""
+        return ('wwwhisper_allowed_group', (),
+                {'location_uuid' : self.http_location.uuid,
+                 'group_uuid': self.group.uuid})
+
+    def attributes_dict(self, site_url):
+        """Returns externally visible attributes of the permission resource."""
+        return _add_common_attributes(
+            self, site_url,
+            {'group': self.group.attributes_dict(
+                    site_url, with_members=False)})
+
+class DomainPermission(ValidatedModel):
+    """Connects a location with an email domain that can access it.
+
+    Attributes:
+        http_location: The location to which the object gives access.
+        domain: Lower case domain, users with verified emails in the
+            domain can access the location.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('http_location', 'domain')
+
+    http_location = models.ForeignKey(Location, related_name='+')
+    site = models.ForeignKey(Site, related_name='+')
+    domain = models.CharField(max_length=253)
+
+    @models.permalink
+    def get_absolute_url(self):
+        """Constructs URL of the domain permission resource."""
+        return ('wwwhisper_allowed_domain', (),
+                {'location_uuid' : self.http_location.uuid,
+                 'domain': self.domain})
+
+    def attributes_dict(self, site_url):
+        """Returns externally visible attributes of the permission resource."""
+        return _add_common_attributes(self, site_url, {'domain': self.domain})
+
+class _AliasMethods(object):
+    """Methods shared by Alias model and cached AliasRecord."""
+    __slots__ = ()
+
+    @models.permalink
+    def get_absolute_url(self):
+        return ('wwwhisper_alias', (), {'uuid' : self.uuid})
+
+    def attributes_dict(self, site_url):
+        return _add_common_attributes(self, site_url, {'url': self.url})
+
+class Alias(_AliasMethods, ValidatedModel):
     """One of urls that can be used to access the site.
 
     Attributes:
@@ -455,13 +1176,71 @@ class Alias(ValidatedModel):
                             editable=False, unique=True)
     force_ssl = models.BooleanField(default=False)
 
-    @models.permalink
-    def get_absolute_url(self):
-        return ('wwwhisper_alias', (), {'uuid' : self.uuid})
+class AliasOwner(models.Model):
+    """Alias that owns its url in the multi-tenant mode.
 
-    def attributes_dict(self, site_url):
-        return _add_common_attributes(self, site_url, {'url': self.url})
+    In the multi-tenant mode a site is found by an alias, so an alias
+    url can belong to only one site. The primary key enforces this
+    for aliases added in this mode. Kept in a separate table, so the
+    table is created for existing DBs by 'migrate --run-syncdb'.
+
+    Attributes:
+      url: Url of the alias.
+      alias: The alias, deleting it releases the url.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+
+    url = models.TextField(primary_key=True)
+    alias = models.OneToOneField(Alias, related_name='owner')
+
+class AliasRecord(_AliasMethods, CachedRecord):
+    """Cached alias (see CachedRecord)."""
+    model_class = Alias
+    fields = ('id', 'url', 'uuid', 'force_ssl')
+    __slots__ = fields
+
+class AuditRecord(models.Model):
+    """A decision of an auth request (see audit.py).
+
+    Ids are not foreign keys, records are kept after the site, user or
+    location is deleted.
+
+    Attributes:
+      site_id: Id of the site.
+      user_id: Id of the user or None if not authenticated.
+      location_id: Id of the location or None if no location matched.
+      status: HTTP status of the auth response.
+      time: Time of the decision.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+
+    site_id = models.TextField(db_index=True)
+    user_id = models.IntegerField(null=True)
+    location_id = models.IntegerField(null=True)
+    status = models.SmallIntegerField()
+    time = models.DateTimeField(db_index=True)
 
+class AccessCounter(models.Model):
+    """Number of accesses of a user to a location.
+
+    Counted in memory by each process and periodically added to the
+    DB (see access_counters.py), so values are approximate.
+
+    Attributes:
+      hits: Number of granted auth requests.
+      last_seen: Time of the last granted auth request.
+    """
+    class Meta:
+        app_label = 'wwwhisper_auth'
+        unique_together = ('location', 'user')
+
+    site = models.ForeignKey(Site, related_name='+')
+    location = models.ForeignKey(Location, related_name='+')
+    user = models.ForeignKey(User, related_name='+')
+    hits = models.BigIntegerField(default=0)
+    last_seen = models.DateTimeField()
 
 class Collection(object):
     """A common base class for managing a collection of resources.
@@ -475,33 +1254,112 @@ class Collection(object):
     Attributes (Need to be defined in subclasses):
         item_name: Name of a resource stored in the collection.
         model_class: Class that manages storage of resources.
+        record_class: CachedRecord subclass that holds cached resources.
     """
+    # _ExpirationHeap of cached items that expire.
+    _expirations = None
 
-    def __init__(self, site):
+    def __init__(self, site, cached=None):
         self.site = site
-        self.update_cache()
+        self._reload_lock = threading.Lock()
+        if cached is None:
+            self._reload()
+        else:
+            self.import_cache(cached)
+
+    def _reload(self):
+        with metrics.registry.timer('wwwhisper_cache_reload_seconds',
+                                    collection=self.item_name):
+            self.update_cache()
+
+    def _reload_if_obsolete(self):
+        """Reloads the cache if the site was modified.
+
+        If many threads notice the modification at the same time,
+        only one of them reloads the cache, others wait for it.
+
+        Also drops cached items that expired (for collections that
+        have an _expirations heap).
+        """
+        if self.is_cache_obsolete():
+            with self._reload_lock:
+                if self.is_cache_obsolete():
+                    self._reload()
+        expirations = self._expirations
+        if (expirations is not None and
+            expirations.next_timestamp <= time.time()):
+            with self._reload_lock:
+                expired = self._expirations.pop_expired(time.time())
+                if expired:
+                    self._drop_expired(expired)
 
     def update_cache(self):
-        self._cached_items_dict = {}
-        self._cached_items_list = []
-        for item in self.model_class.objects.filter(site_id=self.site.site_id):
-            self._cached_items_dict[item.id] = item
-            self._cached_items_list.append(item)
-            # Use already retrieved site, do not retrieve it again.
-            item.site = self.site
-        self.cache_mod_id = self.site.mod_id
+        # mod_id is read before the data, if the site is modified
+        # concurrently, the cache is considered obsolete and reloaded
+        # again.
+        mod_id = self.site.mod_id
+        self._fill_cache(self._cached_items_query(
+                self.site.site_id).values_list(
+                *self.record_class.fields).iterator())
+        self._update_related_cache(self.site.site_id)
+        self._set_cache_mod_id(mod_id)
+
+    def _cached_items_query(self, site_id):
+        """Returns a QuerySet of items that are cached."""
+        return self.model_class.objects.filter(site_id=site_id)
+
+    def _update_related_cache(self, site_id):
+        """Loads cached data other than items (for subclasses)."""
+        pass
+
+    def _import_related_cache(self, cached):
+        """Like _update_related_cache, but from export_cache() data."""
+        pass
+
+    def _set_cache_mod_id(self, mod_id):
+        # Assigned only after all the cached data. Readers check
+        # cache_mod_id without the reload lock, and a reader that
+        # finds the cache up to date must never see data left from
+        # the previous reload (for example, a revoked permission).
+        # Readers that find the cache obsolete wait for the reload.
+        self.cache_mod_id = mod_id
+
+    def _fill_cache(self, rows):
+        items_dict = {}
+        items_list = []
+        # Cached items are lightweight records created from raw
+        # values, not model instances (see CachedRecord).
+        record_class = self.record_class
+        for values in rows:
+            item = record_class(self.site, values)
+            items_dict[item.id] = item
+            items_list.append(item)
+        self._cached_items_dict = items_dict
+        self._cached_items_list = items_list
+
+    def export_cache(self):
+        """Returns json serializable content of the cache."""
+        return {
+            'mod_id': self.cache_mod_id,
+            'items': [item.to_json() for item in self._cached_items_list],
+        }
+
+    def import_cache(self, cached):
+        """Fills the cache with data returned by export_cache()."""
+        self._fill_cache(self.record_class.values_from_json(values)
+                         for values in cached['items'])
+        self._import_related_cache(cached)
+        self._set_cache_mod_id(cached['mod_id'])
 
     def is_cache_obsolete(self):
         return self.site.mod_id != self.cache_mod_id
 
     def all(self):
-        if self.is_cache_obsolete():
-            self.update_cache()
+        self._reload_if_obsolete()
         return self._cached_items_list
 
     def all_dict(self):
-        if self.is_cache_obsolete():
-            self.update_cache()
+        self._reload_if_obsolete()
         return self._cached_items_dict
 
     def count(self):
@@ -526,7 +1384,7 @@ class Collection(object):
     def find_item_by_pk(self, pk):
         return self.all_dict().get(pk, None)
 
-    @modify_site
+    @modify_site_revoking
     def delete_item(self, uuid):
         """Deletes an item with a given UUID.
 
@@ -556,25 +1414,30 @@ class Collection(object):
             # IntegrityError is raised by the DB engine (translated to
             # ValidationError for consistency).
             raise ValidationError(e.message)
-        item.site = self.site
-        return item
+        return self.record_class.from_model(item, self.site)
 
 class UsersCollection(Collection):
     """Collection of users resources."""
 
     item_name = 'user'
     model_class = User
+    record_class = UserRecord
 
     @modify_site
-    def create_item(self, email):
+    def create_item(self, email, expires_at=None):
         """Creates a new User object for the site.
 
         There may be two different users with the same email but for
         different sites.
 
+        Args:
+            email: Email of the user.
+            expires_at: Optional datetime (or ISO 8601 string) after
+                which the user is removed.
+
         Raises:
-            ValidationError if the email is invalid or if a site
-            already has a user with such email.
+            ValidationError if the email or expires_at is invalid or
+            if a site already has a user with such email.
             LimitExceeded if the site defines a maximum number of
             users and adding a new one would exceed this number.
         """
@@ -582,52 +1445,337 @@ class UsersCollection(Collection):
         if (users_limit is not None and self.count() >= users_limit):
             raise LimitExceeded('Users limit exceeded')
 
-        encoded_email = _encode_email(email)
-        if encoded_email is None:
-            raise ValidationError('Invalid email format.')
+        encoded_email = self.validate_email(email)
+        expires_at = validate_expiration(expires_at)
         # Django 1.8 correctly sets last_login field to NULL for newly
         # created users. Earlier Django versions set this field to
         # date_joined and had a 'not NULL' constraint on the
         # field. For compatibility with old databases, old behavior is
         # preserved, last_login is initally set to a date when user is
         # created.
-        try:
-            return self._do_create_item(email=encoded_email,
-                                        last_login=timezone.now())
-        except ValidationError:
-            raise ValidationError('User already exists.')
+        with transaction.atomic():
+            user = self._find_domain_user(email=encoded_email)
+            if user is not None:
+                # Becomes a regular user.
+                DomainUser.objects.filter(user_id=user.id).delete()
+                user = UserRecord.from_model(user, self.site)
+            else:
+                try:
+                    user = self._do_create_item(email=encoded_email,
+                                                last_login=timezone.now())
+                except ValidationError:
+                    raise ValidationError('User already exists.')
+            if expires_at is not None:
+                UserExpiration.objects.create(
+                    user_id=user.id, site_id=self.site.site_id,
+                    expires_at=expires_at)
+        return user
+
+    def create_domain_user(self, email):
+        """Creates a user that can login because of a domain grant.
+
+        Unlike create_item, does not mark the site as modified. Such
+        users are not cached with other users (all() does not return
+        them), find_item_by_email and find_item_by_pk retrieve them
+        from the DB. This way sites with domain grants do not load
+        all users that ever logged in. Such a user becomes a regular
+        one when added with create_item.
 
+        Raises:
+            ValidationError if the email is invalid or if a site
+            already has a user with such email.
+            LimitExceeded if the site defines a maximum number of
+            users (domain users included) and adding a new one would
+            exceed this number.
+        """
+        users_limit = self.site.users_limit
+        if (users_limit is not None and User.objects.filter(
+                site_id=self.site.site_id).count() >= users_limit):
+            raise LimitExceeded('Users limit exceeded')
+        encoded_email = self.validate_email(email)
+        with transaction.atomic():
+            try:
+                user = self._do_create_item(email=encoded_email,
+                                            last_login=timezone.now())
+            except ValidationError:
+                raise ValidationError('User already exists.')
+            DomainUser.objects.create(
+                user_id=user.id, site_id=self.site.site_id)
+        return DomainUserRecord.from_model(user, self.site)
+
+    def _cached_items_query(self, site_id):
+        return super(UsersCollection, self)._cached_items_query(
+            site_id).exclude(id__in=DomainUser.objects.filter(
+                site_id=site_id).values('user_id'))
+
+    def _find_domain_user(self, **kwargs):
+        """Retrieves a domain user from the DB, returns None if missing."""
+        values = User.objects.filter(
+            site_id=self.site.site_id,
+            id__in=DomainUser.objects.filter(
+                site_id=self.site.site_id).values('user_id'),
+            **kwargs).values_list(*DomainUserRecord.fields).first()
+        if values is None:
+            return None
+        return DomainUserRecord(self.site, values)
+
+    def _update_related_cache(self, site_id):
+        self._set_expirations(dict(UserExpiration.objects.filter(
+                    site_id=site_id).values_list(
+                    'user_id', 'expires_at').iterator()))
+
+    def export_cache(self):
+        cached = super(UsersCollection, self).export_cache()
+        cached['expirations'] = [
+            [user_id, expires_at.isoformat()] for (user_id, expires_at)
+            in self._cached_expirations.iteritems()]
+        return cached
+
+    def _import_related_cache(self, cached):
+        self._set_expirations(dict(
+                (user_id, parse_datetime(expires_at))
+                for (user_id, expires_at) in cached['expirations']))
+
+    def _set_expirations(self, expirations):
+        self._cached_expirations = expirations
+        self._expirations = _ExpirationHeap(
+            (_timestamp(expires_at), user_id)
+            for (user_id, expires_at) in expirations.iteritems())
+
+    def _fill_cache(self, rows):
+        super(UsersCollection, self)._fill_cache(rows)
+        # Login and token requests find users by email, a linear
+        # search is too slow for sites with many users.
+        self._cached_items_by_email = dict(
+            (user.email, user) for user in self._cached_items_list)
+        # Domain users (or None) retrieved by auth requests since the
+        # reload, keyed by user ids stored in sessions.
+        self._domain_users_by_pk = {}
+
+    def _drop_expired(self, user_ids):
+        """Removes expired users from the cache (not from the DB)."""
+        user_ids = frozenset(user_ids)
+        items_list = [user for user in self._cached_items_list
+                      if user.id not in user_ids]
+        self._cached_items_dict = dict(
+            (user.id, user) for user in items_list)
+        self._cached_items_list = items_list
+        self._cached_items_by_email = dict(
+            (user.email, user) for user in items_list)
+
+    def get_expiration(self, user_id):
+        """Returns time after which a given user expires or None."""
+        self._reload_if_obsolete()
+        return self._cached_expirations.get(user_id)
+
+    @staticmethod
+    def validate_email(email):
+        """Returns the encoded email or raises ValidationError."""
+        encoded_email = _encode_email(email)
+        if encoded_email is None:
+            raise ValidationError('Invalid email format.')
+        return encoded_email
 
     def find_item_by_email(self, email):
         encoded_email = _encode_email(email)
         if encoded_email is None:
             return None
-        return self.get_unique(lambda user: user.email == encoded_email)
+        self._reload_if_obsolete()
+        user = self._cached_items_by_email.get(encoded_email)
+        if user is None and self.site.locations.is_domain_granted(
+            encoded_email):
+            # Not cached, so login token checks always see the
+            # current last_login.
+            user = self._find_domain_user(email=encoded_email)
+        return user
+
+    def find_item_by_pk(self, pk):
+        user = super(UsersCollection, self).find_item_by_pk(pk)
+        if user is not None:
+            return user
+        domain_users = self._domain_users_by_pk
+        if pk not in domain_users:
+            domain_users[pk] = self._find_domain_user(id=pk)
+        return domain_users[pk]
 
 class LocationsCollection(Collection):
     """Collection of locations resources."""
 
     # Can be safely risen to whatever value is needed.
     PATH_LEN_LIMIT = 300
+    # RFC 1035
+    DOMAIN_LEN_LIMIT = 253
 
     # TODO: These should rather also be all caps.
     item_name = 'location'
     model_class = Location
+    record_class = LocationRecord
+    _NO_USERS = frozenset()
+    # (cached locations list, PathMatcher compiled from it).
+    _path_matcher = (None, None)
 
-    def update_cache(self):
-        super(LocationsCollection, self).update_cache()
+    def _update_related_cache(self, site_id):
         # Retrieves permissions for all locations of the site with a
-        # single query.
-        self._cached_permissions = {}
-        for p in Permission.objects.filter(site=self.site):
-            self._cached_permissions.setdefault(
-                p.http_location_id, {})[p.user_id] = p
-
-    def get_permissions(self, location_id):
-        """Returns permissions for a given location of the site."""
-        if self.is_cache_obsolete():
-            self.update_cache()
-        return self._cached_permissions.get(location_id, {})
+        # single query. Only (location id, user id) pairs are needed
+        # to make auth decisions, creating Permission objects for each
+        # row would be much slower and would take much more memory.
+        allowed = _group_pairs(Permission.objects.filter(
+                site_id=site_id).values_list(
+                'http_location_id', 'user_id').iterator())
+        allowed_groups = _group_pairs(GroupPermission.objects.filter(
+                site_id=site_id).values_list(
+                'http_location_id', 'group_id').iterator())
+        members = self.site.groups.load_member_ids()
+        allowed_domains = _group_pairs(DomainPermission.objects.filter(
+                site_id=site_id).values_list(
+                'http_location_id', 'domain').iterator())
+        self._cached_allowed_user_ids = allowed
+        self._cached_allowed_group_ids = allowed_groups
+        self._cached_allowed_domains = allowed_domains
+        self._set_expirations(dict(
+                ((location_id, user_id), expires_at)
+                for (location_id, user_id, expires_at)
+                in PermissionExpiration.objects.filter(
+                    site_id=site_id).values_list(
+                    'permission__http_location_id', 'permission__user_id',
+                    'expires_at').iterator()))
+        # Assigned at once, so is_user_allowed never combines data
+        # from different reloads.
+        self._access = ((allowed,) +
+                        _group_access_bitsets(allowed_groups, members) +
+                        (_domain_index(allowed_domains),))
+
+    def export_cache(self):
+        cached = super(LocationsCollection, self).export_cache()
+        cached['allowed'] = [
+            [location_id, sorted(user_ids)] for (location_id, user_ids)
+            in self._cached_allowed_user_ids.iteritems()]
+        cached['allowed_groups'] = [
+            [location_id, sorted(group_ids)] for (location_id, group_ids)
+            in self._cached_allowed_group_ids.iteritems()]
+        cached['allowed_domains'] = [
+            [location_id, sorted(domains)] for (location_id, domains)
+            in self._cached_allowed_domains.iteritems()]
+        cached['expirations'] = [
+            [location_id, user_id, expires_at.isoformat()]
+            for ((location_id, user_id), expires_at)
+            in self._cached_expirations.iteritems()]
+        (_, user_bits, location_bits, _) = self._access
+        cached['user_bits'] = user_bits.items()
+        cached['location_bits'] = location_bits.items()
+        return cached
+
+    def _import_related_cache(self, cached):
+        self._cached_allowed_user_ids = dict(
+            (location_id, frozenset(user_ids))
+            for (location_id, user_ids) in cached['allowed'])
+        self._cached_allowed_group_ids = dict(
+            (location_id, frozenset(group_ids))
+            for (location_id, group_ids) in cached['allowed_groups'])
+        self._cached_allowed_domains = dict(
+            (location_id, frozenset(domains))
+            for (location_id, domains) in cached['allowed_domains'])
+        self._access = (self._cached_allowed_user_ids,
+                        dict(cached['user_bits']),
+                        dict(cached['location_bits']),
+                        _domain_index(self._cached_allowed_domains))
+        self._set_expirations(dict(
+                ((location_id, user_id), parse_datetime(expires_at))
+                for (location_id, user_id, expires_at)
+                in cached['expirations']))
+
+    def _set_expirations(self, expirations):
+        self._cached_expirations = expirations
+        self._expirations = _ExpirationHeap(
+            (_timestamp(expires_at), key)
+            for (key, expires_at) in expirations.iteritems())
+
+    def _drop_expired(self, keys):
+        """Removes expired permissions from the cache (not from the DB)."""
+        allowed = dict(self._cached_allowed_user_ids)
+        for (location_id, user_id) in keys:
+            allowed[location_id] = allowed.get(
+                location_id, self._NO_USERS).difference([user_id])
+        self._cached_allowed_user_ids = allowed
+        self._access = (allowed,) + self._access[1:]
+
+    def get_allowed_user_ids(self, location_id):
+        """Returns ids of users allowed to access a given location.
+
+        Only users granted access directly, not through groups, are
+        included.
+        """
+        self._reload_if_obsolete()
+        return self._cached_allowed_user_ids.get(location_id, self._NO_USERS)
+
+    def get_allowed_group_ids(self, location_id):
+        """Returns ids of groups allowed to access a given location."""
+        self._reload_if_obsolete()
+        return self._cached_allowed_group_ids.get(location_id, self._NO_USERS)
+
+    def get_allowed_domains(self, location_id):
+        """Returns email domains allowed to access a given location."""
+        self._reload_if_obsolete()
+        return self._cached_allowed_domains.get(location_id, self._NO_USERS)
+
+    def is_user_allowed(self, location_id, user):
+        """True if a user can access a given location.
+
+        Access can be granted to the user directly, through a group
+        or through the email domain of the user.
+        """
+        self._reload_if_obsolete()
+        (allowed, user_bits, location_bits, domain_index) = self._access
+        user_id = user.id
+        if user_id in allowed.get(location_id, self._NO_USERS):
+            return True
+        bit = user_bits.get(user_id)
+        if (bit is not None and
+            (location_bits.get(location_id, 0) >> bit) & 1 == 1):
+            return True
+        return location_id in domain_index.get(
+            _email_domain(user.email), self._NO_USERS)
+
+    def is_domain_granted(self, email):
+        """True if the email domain can access any location of the site.
+
+        Such email owner can login even if the site has no user with
+        the email.
+        """
+        encoded_email = _encode_email(email)
+        if encoded_email is None:
+            return False
+        self._reload_if_obsolete()
+        return _email_domain(encoded_email) in self._access[3]
+
+    def get_granted_user_ids(self, location_id, include_expiring=True):
+        """Returns ids of users that can access a given location.
+
+        Includes users granted access directly, through groups and
+        through email domains (only users that were added to the
+        site, not users created at a login, see DomainUser). If
+        include_expiring is False, users granted access directly with
+        a permission that expires are included only if they are
+        granted access also in other way.
+        """
+        self._reload_if_obsolete()
+        (allowed, user_bits, location_bits, _) = self._access
+        bits = location_bits.get(location_id, 0)
+        allowed = allowed.get(location_id, self._NO_USERS)
+        if not include_expiring:
+            expirations = self._cached_expirations
+            allowed = frozenset(
+                user_id for user_id in allowed
+                if (location_id, user_id) not in expirations)
+        granted = allowed.union(
+            user_id for (user_id, bit) in user_bits.iteritems()
+            if (bits >> bit) & 1)
+        domains = self.get_allowed_domains(location_id)
+        if domains:
+            granted = granted.union(
+                user.id for user in self.site.users.all()
+                if _email_domain(user.email) in domains)
+        return granted
 
     @modify_site
     def create_item(self, path):
@@ -648,11 +1796,20 @@ class LocationsCollection(Collection):
         if (locations_limit is not None and self.count() >= locations_limit):
             raise LimitExceeded('Locations limit exceeded')
 
+        self.validate_path(path)
+        try:
+            return self._do_create_item(path=path)
+        except ValidationError:
+            raise ValidationError('Location already exists.')
+
+    @classmethod
+    def validate_path(cls, path):
+        """Raises ValidationError if path can not be a location path."""
         if not url_utils.is_canonical(path):
             raise ValidationError(
                 'Path should be absolute and normalized (starting with / '\
                     'without /../ or /./ or //).')
-        if len(path) > self.PATH_LEN_LIMIT:
+        if len(path) > cls.PATH_LEN_LIMIT:
             raise ValidationError('Path too long')
         if url_utils.contains_fragment(path):
             raise ValidationError(
@@ -668,10 +1825,16 @@ class LocationsCollection(Collection):
         except UnicodeError:
             raise ValidationError(
                 'Path should contain only ascii characters.')
-        try:
-            return self._do_create_item(path=path)
-        except ValidationError:
-            raise ValidationError('Location already exists.')
+
+    @classmethod
+    def validate_domain(cls, domain):
+        """Returns the encoded email domain or raises ValidationError."""
+        if len(domain) > cls.DOMAIN_LEN_LIMIT:
+            raise ValidationError('Domain too long.')
+        encoded_domain = _encode_domain(domain)
+        if encoded_domain is None:
+            raise ValidationError('Invalid domain format.')
+        return encoded_domain
 
 
     def find_location(self, canonical_path):
@@ -681,29 +1844,18 @@ class LocationsCollection(Collection):
             canonical_path: The path for which matching location is searched.
 
         Returns:
-            The most specific location with path matching a given path or None
-            if no matching location exists.
+            The most specific location with path or pattern matching a
+            given path or None if no matching location exists (see
+            path_matcher.py for the precedence rules).
         """
-        canonical_path_len = len(canonical_path)
-        longest_matched_location = None
-        longest_matched_location_len = -1
-
-        for location in self.all():
-            probed_path = location.path
-            probed_path_len = len(probed_path)
-            trailing_slash_index = None
-            if probed_path[probed_path_len - 1] == '/':
-                trailing_slash_index = probed_path_len - 1
-            else:
-                trailing_slash_index = probed_path_len
-
-            if (canonical_path.startswith(probed_path) and
-                probed_path_len > longest_matched_location_len and
-                (probed_path_len == canonical_path_len or
-                 canonical_path[trailing_slash_index] == '/')) :
-                longest_matched_location_len = probed_path_len
-                longest_matched_location = location
-        return longest_matched_location
+        locations = self.all()
+        (compiled_locations, matcher) = self._path_matcher
+        if compiled_locations is not locations:
+            # Compiled on first use after the cache is reloaded.
+            matcher = path_matcher.PathMatcher(
+                (location.path, location) for location in locations)
+            self._path_matcher = (locations, matcher)
+        return matcher.match(canonical_path)
 
     def has_open_location(self):
         for location in self.all():
@@ -711,9 +1863,91 @@ class LocationsCollection(Collection):
                 return True
         return False
 
+class GroupsCollection(Collection):
+    """Collection of groups resources."""
+
+    item_name = 'group'
+    model_class = Group
+    record_class = GroupRecord
+    NAME_LEN_LIMIT = 100
+    _NO_USERS = frozenset()
+    # (mod_id of the site, member ids) last read by load_member_ids.
+    _loaded_member_ids = (None, None)
+
+    def _update_related_cache(self, site_id):
+        self._cached_member_ids = self.load_member_ids()
+
+    def load_member_ids(self):
+        """Returns a dict that maps group ids to frozensets of member ids.
+
+        Both groups and locations collections need members of groups
+        when reloaded after a site modification. Memberships are read
+        from the DB only by the first of them, unless the site was
+        modified in the meantime.
+        """
+        # Read before the data, like in update_cache().
+        mod_id = self.site.mod_id
+        (loaded_mod_id, member_ids) = self._loaded_member_ids
+        if loaded_mod_id is None or loaded_mod_id != mod_id:
+            member_ids = _group_pairs(GroupMembership.objects.filter(
+                    site_id=self.site.site_id).values_list(
+                    'group_id', 'user_id').iterator())
+            self._loaded_member_ids = (mod_id, member_ids)
+        return member_ids
+
+    def export_cache(self):
+        cached = super(GroupsCollection, self).export_cache()
+        cached['members'] = [
+            [group_id, sorted(user_ids)] for (group_id, user_ids)
+            in self._cached_member_ids.iteritems()]
+        return cached
+
+    def _import_related_cache(self, cached):
+        self._cached_member_ids = dict(
+            (group_id, frozenset(user_ids))
+            for (group_id, user_ids) in cached['members'])
+
+    def get_member_ids(self, group_id):
+        """Returns ids of users that belong to a given group."""
+        self._reload_if_obsolete()
+        return self._cached_member_ids.get(group_id, self._NO_USERS)
+
+    @modify_site
+    def create_item(self, name):
+        """Creates a new Group object for the site.
+
+        Raises:
+            ValidationError if the name is invalid or if a site
+            already has a group with such name.
+            LimitExceeded if the site defines a maximum number of
+            groups and adding a new one would exceed this number.
+        """
+        groups_limit = self.site.groups_limit
+        if (groups_limit is not None and self.count() >= groups_limit):
+            raise LimitExceeded('Groups limit exceeded')
+        name = self.validate_name(name)
+        try:
+            return self._do_create_item(name=name)
+        except ValidationError:
+            raise ValidationError('Group already exists.')
+
+    @classmethod
+    def validate_name(cls, name):
+        """Returns the normalized name or raises ValidationError."""
+        name = name.strip()
+        if not name:
+            raise ValidationError('Group name should not be empty.')
+        if len(name) > cls.NAME_LEN_LIMIT:
+            raise ValidationError('Group name too long.')
+        return name
+
+    def find_item_by_name(self, name):
+        return self.get_unique(lambda group: group.name == name)
+
 class AliasesCollection(Collection):
     item_name = 'alias'
     model_class = Alias
+    record_class = AliasRecord
     # RFC 1035
     ALIAS_LEN_LIMIT = 8 + 253 + 6
 
@@ -722,22 +1956,236 @@ class AliasesCollection(Collection):
         aliases_limit = self.site.aliases_limit
         if (aliases_limit is not None and self.count() >= aliases_limit):
             raise LimitExceeded('Aliases limit exceeded')
-        if len(url) > self.ALIAS_LEN_LIMIT:
+        url = self.validate_url(url)
+        multi_tenant = getattr(settings, 'WWWHISPER_MULTI_TENANT', False)
+        if multi_tenant and Alias.objects.filter(url=url).exclude(
+            site_id=self.site.site_id).exists():
+            raise ValidationError('Alias with this url belongs to other site')
+        with transaction.atomic():
+            try:
+                alias = self._do_create_item(url=url)
+            except ValidationError:
+                raise ValidationError('Alias with this url already exists')
+            if multi_tenant:
+                try:
+                    with transaction.atomic():
+                        AliasOwner.objects.create(url=url, alias_id=alias.id)
+                except IntegrityError:
+                    # Added by other site in the meantime.
+                    raise ValidationError(
+                        'Alias with this url belongs to other site')
+        return alias
+
+    @classmethod
+    def validate_url(cls, url):
+        """Returns the normalized url or raises ValidationError."""
+        if len(url) > cls.ALIAS_LEN_LIMIT:
             raise ValidationError('Url too long')
-
         url = url.strip().lower()
         (valid, error) = url_utils.validate_site_url(url)
         if not valid:
             raise ValidationError('Invalid url: ' + error)
-        url = url_utils.remove_default_port(url)
-        try:
-            return self._do_create_item(url=url)
-        except ValidationError:
-            raise ValidationError('Alias with this url already exists')
+        return url_utils.remove_default_port(url)
 
     def find_item_by_url(self, url):
         return self.get_unique(lambda item: item.url == url)
 
+def _group_pairs(pairs):
+    """Maps first values of pairs to frozensets of second values."""
+    grouped = {}
+    for (key, value) in pairs:
+        grouped.setdefault(key, []).append(value)
+    return dict((key, frozenset(values))
+                for (key, values) in grouped.iteritems())
+
+def _bitset(bits):
+    """Returns an integer with given bits set.
+
+    Built from a string of binary digits, in a time linear in the
+    number of bits (setting bits one by one copies the integer for
+    each bit).
+    """
+    if not bits:
+        return 0
+    digits = bytearray('0' * (max(bits) + 1))
+    for bit in bits:
+        digits[-1 - bit] = '1'
+    return int(str(digits), 2)
+
+def _group_access_bitsets(allowed_groups, members):
+    """Resolves group permissions into a bitset per location.
+
+    Each group member is assigned a bit, members of all groups that
+    can access a location are encoded as a single (arbitrary length)
+    integer. Resolving membership up front allows to check access
+    with a dict lookup and a shift, and a bitset of a location
+    shared by a group of 2000 users takes 250 bytes.
+
+    Args:
+        allowed_groups: Dict that maps location id to ids of allowed
+           groups.
+        members: Dict that maps group id to ids of group members.
+
+    Returns:
+        (dict that maps user id to a bit index, dict that maps
+         location id to a bitset of users that can access it through
+         groups).
+    """
+    user_bits = {}
+    for user_ids in members.itervalues():
+        for user_id in user_ids:
+            if user_id not in user_bits:
+                user_bits[user_id] = len(user_bits)
+    group_bits = dict(
+        (group_id, _bitset([user_bits[user_id] for user_id in user_ids]))
+        for (group_id, user_ids) in members.iteritems())
+    location_bits = {}
+    for (location_id, group_ids) in allowed_groups.iteritems():
+        bits = 0
+        for group_id in group_ids:
+            bits |= group_bits.get(group_id, 0)
+        location_bits[location_id] = bits
+    return (user_bits, location_bits)
+
+def _domain_index(allowed_domains):
+    """Maps email domains to frozensets of ids of locations they can access.
+
+    Args:
+        allowed_domains: Dict that maps location id to allowed domains.
+    """
+    return _group_pairs(
+        (domain, location_id)
+        for (location_id, domains) in allowed_domains.iteritems()
+        for domain in domains)
+
+def _find_users(site, user_ids):
+    """Returns users with given ids, skips expired users."""
+    users = site.users.all_dict()
+    return [users[user_id] for user_id in user_ids if user_id in users]
+
+class _ExpirationHeap(object):
+    """Min-heap of (timestamp, key) tuples of cached items that expire.
+
+    Attributes:
+        next_timestamp: Time of the earliest expiration (infinity if
+           there is none), allows to check if any item expired with
+           a single comparison, so checks done by each auth request
+           stay O(1).
+    """
+
+    def __init__(self, entries):
+        self._heap = list(entries)
+        heapq.heapify(self._heap)
+        self._update_next_timestamp()
+
+    def pop_expired(self, now):
+        """Removes and returns keys of items that expired before now."""
+        expired = []
+        while self._heap and self._heap[0][0] <= now:
+            expired.append(heapq.heappop(self._heap)[1])
+        self._update_next_timestamp()
+        return expired
+
+    def _update_next_timestamp(self):
+        if self._heap:
+            self.next_timestamp = self._heap[0][0]
+        else:
+            self.next_timestamp = float('inf')
+
+class AccessStats(object):
+    """Totals of AccessCounters of a site per location and per user.
+
+    Counters are modified without marking the site as modified, so
+    these are not a part of the cached collections. Instead, totals
+    are read from the DB when needed, at most once every TTL seconds.
+    If accesses are not counted (WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL
+    is not set), nothing is read.
+    """
+    TTL = 10
+
+    def __init__(self, site):
+        self.site = site
+        self._enabled = bool(getattr(
+                settings, 'WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL', None))
+        self._lock = threading.Lock()
+        self._loaded_at = None
+        self._by_location = {}
+        self._by_user = {}
+        self._by_pair = {}
+
+    def for_location(self, location_id):
+        """Returns (hits, last_seen) tuple or None if never accessed."""
+        self._load_if_outdated()
+        return self._by_location.get(location_id)
+
+    def for_user(self, user_id):
+        """Returns (hits, last_seen) tuple or None if never seen."""
+        self._load_if_outdated()
+        return self._by_user.get(user_id)
+
+    def for_location_user(self, location_id, user_id):
+        """Like for_location, but counts only accesses of a given user."""
+        self._load_if_outdated()
+        return self._by_pair.get((location_id, user_id))
+
+    def _load_if_outdated(self):
+        if not self._enabled:
+            return
+        with self._lock:
+            now = time.time()
+            if (self._loaded_at is not None and
+                now - self._loaded_at < self.TTL):
+                return
+            by_location, by_user, by_pair = {}, {}, {}
+            for (location_id, user_id, hits, last_seen) in \
+                    AccessCounter.objects.filter(
+                    site_id=self.site.site_id).values_list(
+                    'location_id', 'user_id', 'hits', 'last_seen'):
+                _add_hits(by_location, location_id, hits, last_seen)
+                _add_hits(by_user, user_id, hits, last_seen)
+                by_pair[(location_id, user_id)] = (hits, last_seen)
+            # Assigned at once, so readers never combine data from
+            # different loads.
+            (self._by_location, self._by_user, self._by_pair) = (
+                by_location, by_user, by_pair)
+            self._loaded_at = now
+
+def _add_hits(totals, key, hits, last_seen):
+    current = totals.get(key)
+    if current is not None:
+        hits += current[0]
+        last_seen = max(last_seen, current[1])
+    totals[key] = (hits, last_seen)
+
+def _add_access_stats(stats, attributes_dict):
+    if stats is not None:
+        attributes_dict['hits'] = stats[0]
+        attributes_dict['lastSeen'] = stats[1].isoformat()
+
+def _timestamp(naive_datetime):
+    """Converts a datetime returned by timezone.now() to time.time() units."""
+    return (time.mktime(naive_datetime.timetuple()) +
+            naive_datetime.microsecond / 1e6)
+
+def validate_expiration(expires_at):
+    """Returns expiration time as datetime or raises ValidationError.
+
+    Args:
+        expires_at: None, datetime or ISO 8601 string.
+    """
+    if expires_at is None:
+        return None
+    if isinstance(expires_at, basestring):
+        try:
+            expires_at = parse_datetime(expires_at)
+        except ValueError:
+            expires_at = None
+        if expires_at is None:
+            raise ValidationError('Invalid expiration time format.')
+    if timezone.is_aware(expires_at):
+        expires_at = timezone.make_naive(expires_at)
+    return expires_at
+
 def _uuid2urn(uuid):
     return 'urn:uuid:' + uuid
 
@@ -780,5 +2228,20 @@ def _encode_email(email):
         return None
     return encoded_email
 
+def _email_domain(encoded_email):
+    return encoded_email[encoded_email.rfind('@') + 1:]
+
+def _encode_domain(domain):
+    """Encodes and validates an email domain.
+
+    Domain can be given with a leading '@' (@example.com).
+    """
+    encoded_domain = domain.strip().lower()
+    if encoded_domain.startswith('@'):
+        encoded_domain = encoded_domain[1:]
+    if not encoded_domain or not is_email_valid('user@' + encoded_domain):
+        return None
+    return encoded_domain
+
 def is_email_valid(email):
     return re.match(email_re.EMAIL_VALIDATION_RE, email)
@@ -0,0 +1,152 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Finds the most specific location that matches a request path.
+
+A location path is a canonical path, some segments of which can be
+wildcards:
+    *   matches exactly one non-empty path segment,
+    **  matches any number (including zero) of segments.
+For example, /users/*/private/ matches /users/alice/private/ and
+/users/bob/private/, /**/secret matches /secret and /a/b/secret.
+'*' that is only a part of a segment (/foo*) is not a wildcard.
+
+Like a literal location, a pattern location matches also all
+sub-paths of matched paths (/users/*/private/ matches
+/users/alice/private/photos/1.jpg).
+
+All locations are compiled into a single tree of path segments, so
+the cost of a lookup depends on the depth of the path and the
+wildcards on the way, and not on the number of locations. Each
+'**' node is visited at most once for each position in the path, so
+patterns with many '**' segments can not make a lookup exponential.
+
+If many locations match a path, the most specific one wins:
+    1. the one with more segments (not counting '**'),
+    2. if equal, the one with a trailing slash,
+    3. if equal, the one that has a literal segment where the other
+       has a wildcard, or '*' where the other has '**' (compared
+       from the first segment).
+For literal locations, this is the same rule as 'the longest
+matching path wins'.
+
+The module depends only on the Python standard library.
+"""
+
+STAR = '*'
+GLOBSTAR = '**'
+
+def is_pattern(path):
+    """True if the location path has wildcard segments."""
+    for segment in path.split('/'):
+        if segment == STAR or segment == GLOBSTAR:
+            return True
+    return False
+
+class _Node(object):
+    """Node of the tree, reached by a sequence of location segments.
+
+    Attributes:
+      children: Dict that maps a literal segment to a child node.
+      star: Child node reached by '*' or None.
+      globstar: Child node reached by '**' or None.
+      exact: (score, value) of a location without a trailing slash
+         that ends at the node, or None.
+      dir: (score, value) of a location with a trailing slash that
+         ends at the node, or None.
+      max_score: The highest score of a location in the subtree,
+         allows to skip subtrees that can not improve a match.
+    """
+    __slots__ = ('children', 'star', 'globstar', 'exact', 'dir', 'max_score')
+
+    def __init__(self):
+        self.children = {}
+        self.star = None
+        self.globstar = None
+        self.exact = None
+        self.dir = None
+        self.max_score = -1
+
+class PathMatcher(object):
+    """Immutable set of locations compiled into a single tree."""
+
+    def __init__(self, locations):
+        """Compiles locations.
+
+        Args:
+           locations: Iterable of (location path, value) tuples,
+              paths need to be canonical and unique.
+        """
+        self._root = _Node()
+        for (path, value) in locations:
+            self._add(path, value)
+
+    def _add(self, path, value):
+        segments = path.split('/')[1:]
+        trailing_slash = segments[-1] == ''
+        if trailing_slash:
+            segments.pop()
+        score = 2 * sum(1 for segment in segments if segment != GLOBSTAR)
+        if trailing_slash:
+            score += 1
+        node = self._root
+        nodes = [node]
+        for segment in segments:
+            if segment == STAR:
+                if node.star is None:
+                    node.star = _Node()
+                node = node.star
+            elif segment == GLOBSTAR:
+                if node.globstar is None:
+                    node.globstar = _Node()
+                node = node.globstar
+            else:
+                node = node.children.setdefault(segment, _Node())
+            nodes.append(node)
+        if trailing_slash:
+            node.dir = (score, value)
+        else:
+            node.exact = (score, value)
+        for node in nodes:
+            node.max_score = max(node.max_score, score)
+
+    def match(self, canonical_path):
+        """Returns value of the most specific matching location or None."""
+        segments = canonical_path.split('/')
+        # [score, value] of the best match so far.
+        best = [-1, None]
+        self._match(self._root, segments, 1, best, set())
+        return best[1]
+
+    def _match(self, node, segments, i, best, visited):
+        """Finds matches in the subtree of node for segments[i:].
+
+        Branches are visited in the order of precedence, so a later
+        match replaces the best one only if it has a higher score.
+        A repeated visit of a '**' node at the same position can not
+        improve the best match, visited holds (node id, position)
+        pairs to skip these.
+        """
+        if node.max_score <= best[0]:
+            return
+        if node.exact is not None and node.exact[0] > best[0]:
+            best[0], best[1] = node.exact
+        segments_count = len(segments)
+        if i == segments_count:
+            return
+        if node.dir is not None and node.dir[0] > best[0]:
+            best[0], best[1] = node.dir
+        segment = segments[i]
+        child = node.children.get(segment)
+        if child is not None:
+            self._match(child, segments, i + 1, best, visited)
+        if node.star is not None and segment != '':
+            self._match(node.star, segments, i + 1, best, visited)
+        if node.globstar is not None:
+            globstar_id = id(node.globstar)
+            for j in xrange(i, segments_count + 1):
+                key = (globstar_id, j)
+                if key in visited:
+                    continue
+                visited.add(key)
+                self._match(node.globstar, segments, j, best, visited)
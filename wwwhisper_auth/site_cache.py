@@ -11,8 +11,25 @@ auth-requests. Because these requests are read only, caching is very
 efficient (cached data rarely needs to be updated).
 """
 
-import logging
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.db import connection
+from django.db.models.signals import post_delete
+from django.db.models.signals import post_save
+from wwwhisper_auth import metrics
+from wwwhisper_auth.models import Alias
+from wwwhisper_auth.models import Site
 from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.snapshot_cache import SnapshotCache
+
+import Queue
+import fcntl
+import hashlib
+import logging
+import os
+import threading
+import time
 
 logger = logging.getLogger(__name__)
 
@@ -28,33 +45,228 @@ class CacheUpdater(object):
         mod_id = site.mod_id_from_db()
         return mod_id is None or mod_id != site.mod_id
 
+    def can_serve_stale(self, site):
+        """True if the site exists and no access was revoked since the load."""
+        revoke_mod_id = site.revoke_mod_id_from_db()
+        return revoke_mod_id is not None and revoke_mod_id <= site.mod_id
+
 class SiteCache(object):
-    def __init__(self, updater):
+    """Stores sites with all associated data.
+
+    By default, each get() checks if the cached site is up to date
+    and evicts it if not, so the next request reloads the site. If
+    refresh_interval is set, get() does not check the site and a
+    Refresher keeps the cache up to date from a background thread.
+
+    If stale_grace is set, an obsolete site is not evicted, but
+    returned while it is reloaded in background (stale while
+    revalidate). This is done for at most stale_grace seconds since
+    the site was found obsolete, and never if a change since the site
+    was loaded revoked access (see Site.site_modified).
+    """
+
+    def __init__(self, updater, refresh_interval=None, stale_grace=None):
         self._updater = updater
         self._items = {}
+        self._refresher = None
+        if refresh_interval:
+            self._refresher = Refresher(self, updater, refresh_interval)
+        self._stale_grace = stale_grace
+        self._stale_since = {}
+        self._revalidating = set()
+        self._revalidating_lock = threading.Lock()
 
     def insert(self, site):
+        # Dict item assignment is atomic, a request sees either the
+        # old or the new site, never a partially loaded one.
         self._items[site.site_id] = site
+        self._stale_since.pop(site.site_id, None)
+
+    def items(self):
+        return self._items.items()
+
+    def peek(self, site_id):
+        """Returns the cached site without checking if it is up to date."""
+        return self._items.get(site_id, None)
 
     def get(self, site_id):
         site = self._items.get(site_id, None)
         if site is None:
+            metrics.registry.inc('wwwhisper_site_cache_misses_total')
             return None
-        if self._updater.is_obsolete(site):
+        if self._refresher is not None:
+            self._refresher.ensure_running()
+        elif self._updater.is_obsolete(site):
+            if self._serve_stale(site):
+                metrics.registry.inc('wwwhisper_site_cache_stale_hits_total')
+                return site
+            metrics.registry.inc('wwwhisper_site_cache_evictions_total')
             self.delete(site_id)
             return None
+        metrics.registry.inc('wwwhisper_site_cache_hits_total')
         return site
 
     def delete(self, site_id):
         self._items.pop(site_id, None)
+        self._stale_since.pop(site_id, None)
+
+    def _serve_stale(self, site):
+        if not self._stale_grace:
+            return False
+        now = time.time()
+        stale_since = self._stale_since.setdefault(site.site_id, now)
+        if (now - stale_since > self._stale_grace or
+            not self._updater.can_serve_stale(site)):
+            return False
+        self._revalidate(site.site_id)
+        return True
+
+    def _revalidate(self, site_id):
+        """Starts a background reload of a site, unless already running."""
+        with self._revalidating_lock:
+            if site_id in self._revalidating:
+                return
+            self._revalidating.add(site_id)
+        thread = threading.Thread(target=self._reload, args=(site_id,))
+        thread.daemon = True
+        thread.start()
+
+    def _reload(self, site_id):
+        try:
+            with metrics.registry.timer('wwwhisper_site_refresh_seconds'):
+                site = SitesCollection().find_item(site_id)
+            if site is None:
+                self.delete(site_id)
+            else:
+                self.insert(site)
+        except DatabaseError as ex:
+            logger.warning('Failed to reload site %s: %s' % (site_id, ex))
+        finally:
+            with self._revalidating_lock:
+                self._revalidating.discard(site_id)
+            connection.close()
+
+class Refresher(object):
+    """Replaces obsolete cached sites with fresh ones from a background thread.
+
+    Every refresh_interval seconds the thread checks if cached sites
+    were modified. A modified site is loaded with all associated data
+    into a new Site object which then replaces the cached one, so
+    requests never wait for a reload. The price is that changes made
+    by other processes are visible after up to refresh_interval
+    seconds (plus the reload time).
+
+    The thread is started by the first request handled by a process:
+    threads do not survive fork, and uWSGI forks workers after the
+    application is loaded.
+    """
+
+    def __init__(self, site_cache, updater, refresh_interval):
+        self._site_cache = site_cache
+        self._updater = updater
+        self._refresh_interval = refresh_interval
+        self._sites = SitesCollection()
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def ensure_running(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            thread = threading.Thread(target=self._run)
+            thread.daemon = True
+            thread.start()
+            self._pid = pid
+
+    def _run(self):
+        while True:
+            time.sleep(self._refresh_interval)
+            self.refresh()
+
+    def refresh(self):
+        """Reloads obsolete sites, returns the number of reloaded sites."""
+        refreshed = 0
+        for site_id, site in self._site_cache.items():
+            try:
+                if not self._updater.is_obsolete(site):
+                    continue
+                with metrics.registry.timer('wwwhisper_site_refresh_seconds'):
+                    fresh_site = self._sites.find_item(site_id)
+                if fresh_site is None:
+                    self._site_cache.delete(site_id)
+                else:
+                    self._site_cache.insert(fresh_site)
+                refreshed += 1
+            except DatabaseError as ex:
+                logger.warning('Failed to refresh site %s: %s' % (site_id, ex))
+                # The connection can be broken, the next refresh
+                # opens a new one.
+                connection.close()
+        return refreshed
+
+class _FileLock(object):
+    """Exclusive lock on a file, held by at most one process at a time."""
+
+    def __init__(self, path):
+        self._path = path
+        self._file = None
+
+    def __enter__(self):
+        self._file = open(self._path, 'a')
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *exc_info):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+        self._file.close()
+        self._file = None
+        return False
 
 class CachingSitesCollection(SitesCollection):
-    """Like models.SitesCollection but returns cached results when possible."""
+    """Like models.SitesCollection but returns cached results when possible.
+
+    Loads of a site are single-flight: when many threads miss the
+    cache at the same time (for example, all of them noticed that the
+    site was modified), one thread loads the site and others wait and
+    use the loaded site.
+
+    If snapshot_dir is set, loaded sites are also stored on disk and
+    a site missing in the cache is recreated from disk, if the site
+    was not modified since it was stored (see snapshot_cache.py).
+
+    If lock_dir is set, loads of a site are also serialized between
+    processes with a file lock. The first process that gets the lock
+    loads the site from the DB and stores it on disk, processes that
+    get the lock later recreate the site from the stored file, so
+    the DB is hit by one worker, instead of all workers. Requires
+    snapshot_dir, without it the workers would only take turns to
+    load the site from the DB.
+    """
 
-    def __init__(self, site_cache=None):
+    def __init__(self, site_cache=None, lock_dir=None, snapshot_dir=None):
         if site_cache is None:
-            site_cache = SiteCache(CacheUpdater())
+            site_cache = SiteCache(
+                CacheUpdater(),
+                getattr(settings, 'WWWHISPER_REFRESH_INTERVAL', None),
+                getattr(settings, 'WWWHISPER_STALE_GRACE', None))
         self.site_cache = site_cache
+        if lock_dir is None:
+            lock_dir = getattr(settings, 'WWWHISPER_RELOAD_LOCK_DIR', None)
+        self._lock_dir = lock_dir
+        if snapshot_dir is None:
+            snapshot_dir = getattr(
+                settings, 'WWWHISPER_SNAPSHOT_CACHE_DIR', None)
+        self._snapshots = None
+        if snapshot_dir is not None:
+            self._snapshots = SnapshotCache(snapshot_dir)
+        elif lock_dir is not None:
+            raise ImproperlyConfigured(
+                'WWWHISPER_RELOAD_LOCK_DIR requires '
+                'WWWHISPER_SNAPSHOT_CACHE_DIR')
+        self._load_locks = {}
 
     def create_item(self, site_id, **kwargs):
         site = super(CachingSitesCollection, self).create_item(
@@ -66,16 +278,297 @@ class CachingSitesCollection(SitesCollection):
         site = self.site_cache.get(site_id)
         if site is not None:
             return site
+        # dict.setdefault is atomic, all threads get the same lock.
+        with self._load_locks.setdefault(site_id, threading.Lock()):
+            # The site could be loaded by another thread while this
+            # one was waiting for the lock.
+            site = self.site_cache.peek(site_id)
+            if site is not None:
+                metrics.registry.inc('wwwhisper_site_loads_coalesced_total')
+                return site
+            if self._lock_dir is None:
+                return self._load(site_id)
+            with _FileLock(self._lock_path(site_id)):
+                # Recreated from the file stored by the process that
+                # held the lock before, if the site was not modified
+                # since then.
+                return self._load(site_id)
+
+    def _load(self, site_id):
+        if self._snapshots is not None:
+            site = self._snapshots.load(site_id)
+            if site is not None:
+                self.site_cache.insert(site)
+                return site
         site = super(CachingSitesCollection, self).find_item(site_id=site_id)
         if site is not None:
+            if self._snapshots is not None:
+                self._snapshots.store(site)
             self.site_cache.insert(site)
         return site
 
+    def _lock_path(self, site_id):
+        file_name = hashlib.sha1(site_id.encode('utf-8')).hexdigest()
+        return os.path.join(self._lock_dir, file_name + '.lock')
+
     def delete_item(self, site_id):
         rv = super(CachingSitesCollection, self).delete_item(site_id=site_id)
         self.site_cache.delete(site_id)
         return rv
 
+class AliasIndex(object):
+    """Maps aliases of all sites to ids of sites.
+
+    Allows a single process to serve many sites: a site of a request
+    is found by the Site-Url header. All aliases are loaded with a
+    single query and kept in memory. The index is replaced as a whole
+    (a request sees either the old or the new mapping), loads are
+    single-flight.
+
+    Changes to aliases made by the process invalidate the index (see
+    _alias_changed). Changes made by other processes are detected
+    lazily: an unknown url reloads the index (at most once every
+    min_reload_interval seconds, so requests with bogus Site-Urls
+    do not overload the DB), and a caller that finds that a site no
+    longer has an alias that the index returned, calls invalidate()
+    and retries.
+
+    In the multi-tenant mode, an alias url that belongs to one site
+    can not be added to other sites (see AliasOwner). If many sites
+    have the same url (aliases added when the mode was off), the site
+    that owns the url gets it, an url without an owner is ambiguous
+    and is not mapped to any site.
+    """
+
+    def __init__(self, min_reload_interval=1):
+        self._min_reload_interval = min_reload_interval
+        self._site_ids = None
+        self._loaded_at = None
+        self._lock = threading.Lock()
+        # Incremented by invalidate(), the index is up to date if it
+        # was loaded after the last invalidation.
+        self._generation = 0
+        self._loaded_generation = None
+
+    def find_site_id(self, url):
+        """Returns id of a site with the alias or None."""
+        site_ids = self._site_ids
+        if (site_ids is not None and
+            self._loaded_generation == self._generation):
+            site_id = site_ids.get(url)
+            if site_id is not None or not self._can_reload():
+                return site_id
+        return self._load().get(url)
+
+    def invalidate(self):
+        self._generation += 1
+
+    def _can_reload(self):
+        return time.time() - self._loaded_at >= self._min_reload_interval
+
+    def _load(self):
+        generation = self._generation
+        with self._lock:
+            # The index could be loaded by another thread while this
+            # one was waiting for the lock.
+            if (self._loaded_generation is not None and
+                self._loaded_generation >= generation and
+                not self._can_reload()):
+                metrics.registry.inc(
+                    'wwwhisper_alias_index_loads_coalesced_total')
+                return self._site_ids
+            generation = self._generation
+            with metrics.registry.timer('wwwhisper_alias_index_load_seconds'):
+                site_ids = _alias_site_ids(
+                    Alias.objects.values_list(
+                        'url', 'site_id', 'owner__url').iterator())
+            self._site_ids = site_ids
+            self._loaded_at = time.time()
+            self._loaded_generation = generation
+            return site_ids
+
+def _alias_site_ids(rows):
+    """Maps urls to ids of sites (see AliasIndex).
+
+    Args:
+      rows: (url, site_id, owner_url) tuples, owner_url is None if the
+        alias does not own the url.
+    """
+    site_ids = {}
+    ambiguous = set()
+    owned = set()
+    for (url, site_id, owner_url) in rows:
+        if owner_url is not None:
+            site_ids[url] = site_id
+            owned.add(url)
+        elif url in owned:
+            continue
+        elif site_ids.setdefault(url, site_id) != site_id:
+            ambiguous.add(url)
+    for url in ambiguous - owned:
+        del site_ids[url]
+    return site_ids
+
+alias_index = AliasIndex()
+
+def _alias_changed(sender, **kwargs):
+    alias_index.invalidate()
+
+post_save.connect(_alias_changed, sender=Alias)
+post_delete.connect(_alias_changed, sender=Alias)
+
+class WarmUp(object):
+    """Loads sites into a cache when the application starts.
+
+    Sites are loaded in parallel by a bounded number of threads (each
+    thread uses own DB connection, so the number of threads bounds DB
+    concurrency). The process is ready (can be put behind a load
+    balancer) only after the warm-up successfully completes.
+
+    Loads that failed (for example, because the DB was not yet up) are
+    retried with exponential backoff by a background thread, until
+    they succeed. Like site_cache.Refresher, the thread is started by
+    the process that checks readiness (uWSGI workers do not inherit
+    threads of the master that ran the warm-up).
+    """
+
+    # Delays (in seconds) between retries of failed loads.
+    RETRY_INITIAL_DELAY = 1
+    RETRY_MAX_DELAY = 60
+
+    def __init__(self):
+        self._done = threading.Event()
+        self._done.set()
+        self.error = None
+        self._lock = threading.Lock()
+        # (sites, site_ids, concurrency) of failed loads or None.
+        self._retry = None
+        self._retry_pid = None
+
+    def is_ready(self):
+        if self._retry is not None:
+            self._ensure_retrying()
+        return self._done.is_set() and self.error is None
+
+    def run(self, sites, site_ids=None, concurrency=None, block=True):
+        """Loads sites with given ids (all sites if None) into a cache.
+
+        Args:
+            sites: CachingSitesCollection to populate.
+            block: If False, the method returns immediately and sites
+               are loaded in background.
+        """
+        if concurrency is None:
+            concurrency = getattr(settings, 'WWWHISPER_WARM_UP_CONCURRENCY', 4)
+        self._done.clear()
+        self.error = None
+        self._retry = None
+        if block:
+            self._run(sites, site_ids, concurrency)
+            return
+        thread = threading.Thread(
+            target=self._run, args=(sites, site_ids, concurrency))
+        thread.daemon = True
+        thread.start()
+
+    def wait(self, timeout=None):
+        return self._done.wait(timeout)
+
+    def _run(self, sites, site_ids, concurrency):
+        try:
+            self._load_all(sites, site_ids, concurrency)
+        finally:
+            # uWSGI forks workers after the warm-up, workers must not
+            # share DB connections opened by the master.
+            self._close_connection()
+            self._done.set()
+
+    def _load_all(self, sites, site_ids, concurrency):
+        """Loads sites, records failed loads to be retried."""
+        failed = []
+        try:
+            if site_ids is None:
+                site_ids = list(Site.objects.values_list('site_id', flat=True))
+            queue = Queue.Queue()
+            for site_id in site_ids:
+                queue.put(site_id)
+            threads_count = min(concurrency, len(site_ids))
+            if threads_count <= 1:
+                self._load(sites, queue, failed)
+            else:
+                threads = [
+                    threading.Thread(target=self._load,
+                                     args=(sites, queue, failed))
+                    for _ in xrange(threads_count)]
+                for thread in threads:
+                    thread.start()
+                for thread in threads:
+                    thread.join()
+        except DatabaseError as ex:
+            # Ids of sites could not be read, all are loaded again.
+            self._failed(ex)
+            self._retry = (sites, site_ids, concurrency)
+            return
+        if failed:
+            self._retry = (sites, failed, concurrency)
+            return
+        logger.info('Warm-up loaded %d sites.' % len(site_ids))
+        self._retry = None
+        self.error = None
+
+    def _load(self, sites, queue, failed):
+        try:
+            while True:
+                try:
+                    site_id = queue.get_nowait()
+                except Queue.Empty:
+                    return
+                try:
+                    sites.find_item(site_id)
+                except DatabaseError as ex:
+                    self._failed(ex)
+                    failed.append(site_id)
+        finally:
+            self._close_connection()
+
+    def _ensure_retrying(self):
+        pid = os.getpid()
+        if self._retry_pid == pid:
+            return
+        with self._lock:
+            if self._retry_pid == pid:
+                return
+            thread = threading.Thread(target=self._retry_failed)
+            thread.daemon = True
+            thread.start()
+            self._retry_pid = pid
+
+    def _retry_failed(self):
+        delay = self.RETRY_INITIAL_DELAY
+        while True:
+            time.sleep(delay)
+            retry = self._retry
+            if retry is None:
+                break
+            try:
+                self._load_all(*retry)
+            finally:
+                self._close_connection()
+            delay = min(delay * 2, self.RETRY_MAX_DELAY)
+        with self._lock:
+            self._retry_pid = None
+
+    def _failed(self, ex):
+        logger.warning('Warm-up failed: %s' % ex)
+        self.error = str(ex)
+
+    @staticmethod
+    def _close_connection():
+        if not connection.in_atomic_block:
+            connection.close()
+
+warm_up = WarmUp()
+
 # TODO: using this leads to problems in unit tests (a single test
 # creates sites that are visible to other tests).
 sites = CachingSitesCollection()
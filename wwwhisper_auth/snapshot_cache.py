@@ -0,0 +1,107 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""On-disk cache of loaded sites, speeds up cold start of workers.
+
+Loading a site from the database runs several queries and creates
+objects for all users, locations and aliases of the site. When a
+worker is restarted (or a new one is forked) it needs to do this for
+each site it serves. With the on-disk cache, a loaded site is stored
+in a local directory, in a file keyed by the site id and the mod_id
+of the site. A worker that does not have the site in memory runs a
+single query to get the current mod_id of the site and, if a file
+for this mod_id exists, recreates the site from the file.
+
+A file is written only for a site that has all data loaded for the
+same mod_id, so a file never contains data older than its mod_id.
+Files are replaced with an atomic rename, readers never see a partial
+file.
+"""
+
+from wwwhisper_auth import metrics
+from wwwhisper_auth.models import Site
+
+import errno
+import glob
+import hashlib
+import json
+import logging
+import os
+
+logger = logging.getLogger(__name__)
+
+FORMAT_VERSION = 4
+
+class SnapshotCache(object):
+    """Stores sites with all associated data in files in a given directory."""
+
+    def __init__(self, directory):
+        self.directory = directory
+
+    def _prefix(self, site_id):
+        return os.path.join(
+            self.directory, hashlib.sha1(site_id.encode('utf-8')).hexdigest())
+
+    def _path(self, site_id, mod_id):
+        return '%s-%d.json' % (self._prefix(site_id), mod_id)
+
+    def load(self, site_id):
+        """Returns a site recreated from a file or None.
+
+        None is returned if the site does not exist in the database
+        or if there is no file for the current mod_id of the site.
+        """
+        mod_id = Site(site_id=site_id).mod_id_from_db()
+        if mod_id is None:
+            return None
+        path = self._path(site_id, mod_id)
+        try:
+            with open(path) as src:
+                data = json.load(src)
+            if (data['format'] != FORMAT_VERSION or
+                data['site_id'] != site_id or data['mod_id'] != mod_id):
+                raise ValueError('Snapshot does not match its file name')
+            site = Site.from_cache(data['site'])
+        except IOError as ex:
+            if ex.errno != errno.ENOENT:
+                logger.warning('Failed to read site snapshot %s: %s' % (
+                        path, ex))
+            metrics.registry.inc('wwwhisper_site_snapshot_misses_total')
+            return None
+        except (ValueError, KeyError, TypeError) as ex:
+            logger.warning('Invalid site snapshot %s: %s' % (path, ex))
+            metrics.registry.inc('wwwhisper_site_snapshot_misses_total')
+            return None
+        metrics.registry.inc('wwwhisper_site_snapshot_hits_total')
+        return site
+
+    def store(self, site):
+        """Writes a file for the site, removes files for older mod_ids.
+
+        Returns True if the file was written.
+        """
+        cached = site.export_cache()
+        if cached is None:
+            return False
+        mod_id = cached['fields']['mod_id']
+        path = self._path(site.site_id, mod_id)
+        # Workers can store the same site concurrently, each uses own
+        # temporary file.
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+        try:
+            with open(tmp_path, 'w') as out:
+                json.dump({
+                        'format': FORMAT_VERSION,
+                        'site_id': site.site_id,
+                        'mod_id': mod_id,
+                        'site': cached,
+                        }, out, separators=(',', ':'))
+            os.rename(tmp_path, path)
+            for old_path in glob.glob(self._prefix(site.site_id) + '-*.json'):
+                if old_path != path:
+                    os.remove(old_path)
+        except (IOError, OSError) as ex:
+            logger.warning('Failed to write site snapshot %s: %s' % (
+                    path, ex))
+            return False
+        return True
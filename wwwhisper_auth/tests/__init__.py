@@ -1,8 +1,18 @@
 """Tests wwwhisper_auth package."""
 
+from wwwhisper_auth.tests.tests_access_counters import *
+from wwwhisper_auth.tests.tests_acl_io import *
+from wwwhisper_auth.tests.tests_acl_snapshot import *
+from wwwhisper_auth.tests.tests_audit import *
+from wwwhisper_auth.tests.tests_expiry import *
 from wwwhisper_auth.tests.tests_models import *
+from wwwhisper_auth.tests.tests_path_matcher import *
+from wwwhisper_auth.tests.tests_profile import *
+from wwwhisper_auth.tests.tests_query_budgets import *
 from wwwhisper_auth.tests.tests_http import *
+from wwwhisper_auth.tests.tests_metrics import *
 from wwwhisper_auth.tests.tests_middleware import *
 from wwwhisper_auth.tests.tests_site_cache import *
+from wwwhisper_auth.tests.tests_snapshot_cache import *
 from wwwhisper_auth.tests.tests_url_utils import *
 from wwwhisper_auth.tests.tests_views import *
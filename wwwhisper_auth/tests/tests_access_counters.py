@@ -0,0 +1,128 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.db import DatabaseError
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from mock import patch
+from wwwhisper_auth import access_counters
+from wwwhisper_auth.access_counters import AccessCounters
+from wwwhisper_auth.models import AccessCounter
+from wwwhisper_auth.models import AccessStats
+from wwwhisper_auth.tests.tests_views import AuthTestCase
+from wwwhisper_auth.tests.utils import TEST_SITE
+
+import datetime
+
+def _at(ts):
+    return datetime.datetime.fromtimestamp(ts)
+
+class AccessCountersTest(AuthTestCase):
+    def setUp(self):
+        super(AccessCountersTest, self).setUp()
+        self.counters = AccessCounters(flush_interval=1)
+        patcher = patch.object(self.counters, 'ensure_running')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.alice = self.site.users.create_item('alice@example.com')
+        self.bob = self.site.users.create_item('bob@example.com')
+        self.foo = self.site.locations.create_item('/foo/')
+        self.bar = self.site.locations.create_item('/bar/')
+
+    def hit(self, location, user, count=1, now=1000):
+        with patch('wwwhisper_auth.access_counters.time.time',
+                   return_value=now):
+            for _ in xrange(count):
+                self.counters.hit(self.site.site_id, location.id, user.id)
+
+    def test_counters_added_to_db(self):
+        self.hit(self.foo, self.alice, count=3)
+        self.hit(self.bar, self.alice, now=2000)
+        self.assertEqual(2, self.counters.flush())
+        self.assertEqual(0, self.counters.flush())
+        self.hit(self.foo, self.alice, count=2, now=500)
+        self.hit(self.foo, self.bob)
+        self.assertEqual(2, self.counters.flush())
+        self.assertEqual(
+            [(self.foo.id, self.alice.id, 5, _at(1000)),
+             (self.foo.id, self.bob.id, 1, _at(1000)),
+             (self.bar.id, self.alice.id, 1, _at(2000))],
+            list(AccessCounter.objects.order_by(
+                    'location', 'user').values_list(
+                    'location_id', 'user_id', 'hits', 'last_seen')))
+
+    def test_counters_of_deleted_location_skipped(self):
+        self.hit(self.foo, self.alice)
+        self.hit(self.bar, self.alice)
+        self.site.locations.delete_item(self.bar.uuid)
+        self.assertEqual(2, self.counters.flush())
+        self.assertEqual([self.foo.id], list(
+                AccessCounter.objects.values_list('location_id', flat=True)))
+
+    def test_counters_kept_when_flush_fails(self):
+        self.hit(self.foo, self.alice, count=2, now=1000)
+        # The connection is not closed, it runs the test transaction.
+        with patch('wwwhisper_auth.access_counters._add',
+                   side_effect=DatabaseError('db down')), \
+                patch('wwwhisper_auth.access_counters.connection.close'):
+            self.assertEqual(0, self.counters.flush())
+        self.hit(self.foo, self.alice, now=1500)
+        self.hit(self.foo, self.bob)
+        self.assertEqual(2, self.counters.flush())
+        self.assertEqual(
+            [(self.foo.id, self.alice.id, 3, _at(1500)),
+             (self.foo.id, self.bob.id, 1, _at(1000))],
+            list(AccessCounter.objects.order_by('user').values_list(
+                    'location_id', 'user_id', 'hits', 'last_seen')))
+
+    @override_settings(WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL=1)
+    def test_totals_in_attributes(self):
+        self.hit(self.foo, self.alice, count=2, now=1000)
+        self.hit(self.bar, self.alice, count=3, now=2000)
+        self.hit(self.foo, self.bob, now=3000)
+        self.counters.flush()
+        self.foo.grant_access(self.alice.uuid)
+        self.site.access_stats = AccessStats(self.site)
+        foo = self.foo.attributes_dict(TEST_SITE)
+        self.assertEqual(3, foo['hits'])
+        self.assertEqual(_at(3000).isoformat(), foo['lastSeen'])
+        # Allowed users have counts of accesses to the location only.
+        [allowed_alice] = foo['allowedUsers']
+        self.assertEqual(2, allowed_alice['hits'])
+        self.assertEqual(_at(1000).isoformat(), allowed_alice['lastSeen'])
+        alice = self.alice.attributes_dict(TEST_SITE)
+        self.assertEqual(5, alice['hits'])
+        self.assertEqual(_at(2000).isoformat(), alice['lastSeen'])
+        carol = self.site.users.create_item('carol@example.com')
+        self.assertNotIn('hits', carol.attributes_dict(TEST_SITE))
+
+    @override_settings(WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL=None)
+    def test_counters_not_read_when_disabled(self):
+        self.hit(self.foo, self.alice)
+        self.counters.flush()
+        self.site.access_stats = AccessStats(self.site)
+        with CaptureQueriesContext(connection) as queries:
+            self.assertNotIn('hits', self.foo.attributes_dict(TEST_SITE))
+            self.assertNotIn('hits', self.alice.attributes_dict(TEST_SITE))
+        self.assertFalse([query for query in queries
+                          if AccessCounter._meta.db_table in query['sql']])
+
+    def test_only_granted_requests_counted(self):
+        self.foo.grant_access(self.alice.uuid)
+        pub = self.site.locations.create_item('/pub/')
+        pub.grant_open_access()
+        self.login('alice@example.com')
+        with patch.object(access_counters, 'counters', self.counters):
+            self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+            self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/a')
+            self.get('/wwwhisper/auth/api/is-authorized/?path=/bar/')
+            self.get('/wwwhisper/auth/api/is-authorized/?path=/pub/')
+            self.client.logout()
+            self.get('/wwwhisper/auth/api/is-authorized/?path=/pub/')
+        self.counters.flush()
+        # Anonymous and denied requests are not counted.
+        self.assertEqual(
+            [(self.foo.id, self.alice.id, 2), (pub.id, self.alice.id, 1)],
+            list(AccessCounter.objects.order_by('location').values_list(
+                    'location_id', 'user_id', 'hits')))
@@ -0,0 +1,224 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.forms import ValidationError
+from django.test import TestCase
+from django.test import override_settings
+from wwwhisper_auth import acl_io
+from wwwhisper_auth.models import AliasOwner
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import SINGLE_SITE_ID
+
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+
+TEST_SITE2 = 'https://example.net'
+
+class AclIoTest(TestCase):
+    def setUp(self):
+        self.sites = SitesCollection()
+        self.site = self.sites.create_item(SINGLE_SITE_ID)
+        self.site.aliases.create_item('https://foo.example.org')
+        alice = self.site.users.create_item('alice@example.org')
+        bob = self.site.users.create_item('bob@example.org')
+        self.site.locations.create_item('/foo/').grant_access(alice.uuid)
+        bar = self.site.locations.create_item('/bar')
+        bar.grant_access(alice.uuid)
+        bar.grant_access(bob.uuid)
+        self.site.locations.create_item('/pub/').grant_open_access()
+        bar.grant_domain_access('example.com')
+        staff = self.site.groups.create_item('staff')
+        staff.add_member(bob.uuid)
+        self.site.locations.find_location('/foo/').grant_group_access(
+            staff.uuid)
+        self.site2 = self.sites.create_item(TEST_SITE2)
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def acl(self, site):
+        """Returns a set of all records of a site."""
+        return set(json.dumps(record, sort_keys=True)
+                   for record in acl_io.export_records(site))
+
+    def write_input(self, lines):
+        path = os.path.join(self.dir, 'input')
+        with open(path, 'w') as out:
+            out.write('\n'.join(lines) + '\n')
+        return path
+
+    def call(self, command, *args, **kwargs):
+        call_command(command, *args, stdout=StringIO.StringIO(), **kwargs)
+
+    def assert_import_fails(self, lines, message):
+        mod_id = self.site2.mod_id_from_db()
+        with self.assertRaisesRegexp(CommandError, message):
+            self.call('acl_import', self.write_input(lines),
+                      site_id=TEST_SITE2)
+        self.assertEqual(set(), self.acl(self.site2))
+        self.assertEqual(mod_id, self.site2.mod_id_from_db())
+
+    def test_export_and_import(self):
+        for format in acl_io.FORMATS:
+            path = os.path.join(self.dir, 'acl.' + format)
+            self.call('acl_export', path, format=format)
+            site2 = self.sites.find_item(TEST_SITE2)
+            mod_id = site2.mod_id_from_db()
+            self.call('acl_import', path, format=format, site_id=TEST_SITE2,
+                      chunk_size=2)
+            self.assertEqual(self.acl(self.site), self.acl(site2))
+            self.assertEqual(mod_id + 1, site2.mod_id_from_db())
+            site2 = self.sites.find_item(TEST_SITE2)
+            bob = site2.users.find_item_by_email('bob@example.org')
+            self.assertTrue(site2.locations.find_location('/bar').can_access(
+                    bob))
+            self.assertTrue(site2.locations.find_location('/foo/').can_access(
+                    bob))
+            self.assertTrue(site2.locations.is_domain_granted(
+                    'carol@example.com'))
+            self.sites.delete_item(TEST_SITE2)
+            self.sites.create_item(TEST_SITE2)
+
+    def test_export_format(self):
+        path = os.path.join(self.dir, 'acl.csv')
+        self.call('acl_export', path, format='csv')
+        with open(path) as src:
+            rows = set(src.read().splitlines())
+        self.assertEqual(set([
+                    'alias,https://foo.example.org',
+                    'user,alice@example.org',
+                    'user,bob@example.org',
+                    'location,/foo/,n',
+                    'location,/bar,n',
+                    'location,/pub/,y',
+                    'grant,/foo/,alice@example.org',
+                    'grant,/bar,alice@example.org',
+                    'grant,/bar,bob@example.org',
+                    'group,staff',
+                    'member,staff,bob@example.org',
+                    'group_grant,/foo/,staff',
+                    'domain_grant,/bar,example.com']), rows)
+
+    def test_expirations_exported_and_imported(self):
+        carol = self.site.users.create_item(
+            'carol@example.org', expires_at='2030-01-02T03:04:05')
+        self.site.locations.find_location('/pub/').grant_access(
+            carol.uuid, expires_at='2030-02-03T04:05:06')
+        path = os.path.join(self.dir, 'acl.csv')
+        self.call('acl_export', path, format='csv')
+        with open(path) as src:
+            rows = set(src.read().splitlines())
+        self.assertIn('user,carol@example.org,2030-01-02T03:04:05', rows)
+        self.assertIn('grant,/pub/,carol@example.org,2030-02-03T04:05:06',
+                      rows)
+        self.call('acl_import', path, format='csv', site_id=TEST_SITE2)
+        self.assertEqual(self.acl(self.site), self.acl(self.site2))
+
+    def test_repeated_import_skips_existing_records(self):
+        path = os.path.join(self.dir, 'acl.jsonl')
+        self.call('acl_export', path)
+        acl = self.acl(self.site)
+        self.call('acl_import', path)
+        self.assertEqual(acl, self.acl(self.site))
+
+    def test_grants_can_precede_users_and_locations(self):
+        self.call('acl_import', self.write_input([
+                    'grant,/a/,X@example.org',
+                    'location,/a/,n',
+                    'user,x@example.org']),
+                  format='csv', site_id=TEST_SITE2)
+        site2 = self.sites.find_item(TEST_SITE2)
+        self.assertTrue(site2.locations.find_location('/a/').can_access(
+                site2.users.find_item_by_email('x@example.org')))
+
+    def test_invalid_records_rejected(self):
+        self.assert_import_fails(
+            ['{"type": "user", "email": "x@example.org"}',
+             '{"type": "user", "email": "foo"}'],
+            'Line 2: Invalid email format.')
+        self.assert_import_fails(
+            ['{"type": "location", "path": "/a/../b", "open": false}'],
+            'Line 1: Path should be absolute')
+        self.assert_import_fails(
+            ['{"type": "alias", "url": "ftp://example.org"}'],
+            'Line 1: Invalid url')
+        self.assert_import_fails(['{"type": "team"}'],
+                                 'Line 1: Unknown record type')
+        self.assert_import_fails(['{"type": "user"}'],
+                                 "Line 1: Missing 'email'")
+        self.assert_import_fails(['{"type": '], 'Line 1: ')
+        self.assert_import_fails(
+            ['{"type": "user", "email": "x@example.org", "expires_at": "x"}'],
+            'Line 1: Invalid expiration time format.')
+
+    def test_grant_for_unknown_user_rejected(self):
+        self.assert_import_fails(
+            ['{"type": "location", "path": "/a/", "open": false}',
+             '{"type": "grant", "path": "/a/", "email": "x@example.org"}'],
+            'Line 2: Unknown user x@example.org')
+
+    def test_membership_in_unknown_group_rejected(self):
+        self.assert_import_fails(
+            ['{"type": "user", "email": "x@example.org"}',
+             '{"type": "member", "group": "staff", "email": "x@example.org"}'],
+            'Line 2: Unknown group staff')
+
+    def test_domain_grant_for_unknown_location_rejected(self):
+        self.assert_import_fails(
+            ['{"type": "domain_grant", "path": "/a/", "domain": "a.org"}'],
+            'Line 1: Unknown location /a/')
+        self.assert_import_fails(
+            ['{"type": "location", "path": "/a/", "open": false}',
+             '{"type": "domain_grant", "path": "/a/", "domain": "a"}'],
+            'Line 2: Invalid domain format')
+
+    def test_invalid_csv_rejected(self):
+        with self.assertRaisesRegexp(CommandError, 'Line 2: Expected 3'):
+            self.call('acl_import', self.write_input(
+                    ['user,x@example.org', 'location,/a/']),
+                      format='csv', site_id=TEST_SITE2)
+        self.assertEqual(set(), self.acl(self.site2))
+
+    def test_domain_users_not_exported_and_imported_as_users(self):
+        carol = self.site.users.create_domain_user('carol@example.com')
+        self.assertNotIn(
+            json.dumps({'type': 'user', 'email': 'carol@example.com'},
+                       sort_keys=True), self.acl(self.site))
+        self.call('acl_import', self.write_input(
+                ['{"type": "user", "email": "carol@example.com"}']))
+        site = self.sites.find_item(SINGLE_SITE_ID)
+        self.assertEqual(carol, site.users.find_item(carol.uuid))
+        self.assertIn(
+            json.dumps({'type': 'user', 'email': 'carol@example.com'},
+                       sort_keys=True), self.acl(site))
+
+    @override_settings(WWWHISPER_MULTI_TENANT=True)
+    def test_aliases_of_other_site_rejected_in_multi_tenant_mode(self):
+        self.assert_import_fails(
+            ['{"type": "alias", "url": "https://bar.example.org"}',
+             '{"type": "alias", "url": "https://foo.example.org"}'],
+            'Line 2: Alias with this url belongs to other site.')
+        self.call('acl_import', self.write_input(
+                ['{"type": "alias", "url": "https://bar.example.org"}']),
+                  site_id=TEST_SITE2)
+        self.assertEqual(['https://bar.example.org'], [
+                alias.url for alias
+                in self.sites.find_item(TEST_SITE2).aliases.all()])
+        # The imported alias owns its url.
+        self.assertEqual(TEST_SITE2, AliasOwner.objects.get(
+                url='https://bar.example.org').alias.site_id)
+        self.assertRaisesRegexp(ValidationError, 'belongs to other site',
+                                self.site.aliases.create_item,
+                                'https://bar.example.org')
+
+    def test_missing_site(self):
+        self.assertRaises(CommandError, self.call, 'acl_export', '-',
+                          site_id='nosuchsite')
+        self.assertRaises(CommandError, self.call, 'acl_import', '/dev/null',
+                          site_id='nosuchsite')
@@ -0,0 +1,133 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.utils import timezone
+from wwwhisper_auth import acl_snapshot
+from wwwhisper_auth.acl_evaluator import AclSnapshot
+from wwwhisper_auth.acl_evaluator import SnapshotFormatError
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import SINGLE_SITE_ID
+
+import datetime
+import itertools
+import json
+import os
+import shutil
+import StringIO
+import tempfile
+
+class AclSnapshotTest(TestCase):
+    def setUp(self):
+        self.site = SitesCollection().create_item(SINGLE_SITE_ID)
+        self.site.aliases.create_item('https://foo.example.org')
+        self.alice = self.site.users.create_item('alice@example.org')
+        self.bob = self.site.users.create_item('bob@example.org')
+        paths = ['/', '/foo', '/foo/', '/foo/bar', '/foo/bar/baz/', '/qux/']
+        self.locations = dict((path, self.site.locations.create_item(path))
+                              for path in paths)
+        self.locations['/foo'].grant_access(self.alice.uuid)
+        self.locations['/foo/bar'].grant_access(self.alice.uuid)
+        self.locations['/foo/bar'].grant_access(self.bob.uuid)
+        self.locations['/qux/'].grant_open_access()
+        staff = self.site.groups.create_item('staff')
+        staff.add_member(self.bob.uuid)
+        self.locations['/foo/bar/baz/'].grant_group_access(staff.uuid)
+
+    def expected_status(self, path, user):
+        location = self.site.locations.find_location(path)
+        if user is not None:
+            if location is not None and location.can_access(user):
+                return 200
+            return 403
+        if location is not None and location.open_access_granted():
+            return 200
+        return 401
+
+    def assert_same_decisions_as_models(self, snapshot):
+        segments = ['', 'foo', 'fo', 'foobar', 'bar', 'baz', 'qux']
+        paths = set()
+        for depth in xrange(1, 4):
+            for parts in itertools.product(segments, repeat=depth):
+                path = '/' + '/'.join(parts)
+                if '//' not in path:
+                    paths.add(path)
+        for path in sorted(paths):
+            location = self.site.locations.find_location(path)
+            self.assertEqual(location.path if location else None,
+                             snapshot.find_location(path), path)
+            for user in (None, self.alice, self.bob):
+                self.assertEqual(
+                    self.expected_status(path, user),
+                    snapshot.authorize(path, user.id if user else None),
+                    '%s %s' % (path, user))
+
+    def test_same_decisions_as_models(self):
+        self.assert_same_decisions_as_models(AclSnapshot(
+                json.loads(json.dumps(acl_snapshot.build(self.site)))))
+
+    def test_pattern_locations_same_decisions_as_models(self):
+        self.site.locations.create_item('/*/bar/').grant_open_access()
+        self.site.locations.create_item('/**/baz').grant_access(self.bob.uuid)
+        self.assert_same_decisions_as_models(AclSnapshot(
+                json.loads(json.dumps(acl_snapshot.build(self.site)))))
+
+    def test_snapshot_content(self):
+        data = acl_snapshot.build(self.site)
+        self.assertEqual(SINGLE_SITE_ID, data['site_id'])
+        self.assertEqual(self.site.get_mod_id_ts(), data['mod_id'])
+        self.assertEqual(['https://foo.example.org'], data['aliases'])
+        self.assertEqual('bob@example.org', data['users'][str(self.bob.id)])
+        self.assertEqual({'open': False,
+                          'allowed': sorted([self.alice.id, self.bob.id])},
+                         data['locations']['/foo/bar'])
+        self.assertTrue(data['locations']['/qux/']['open'])
+
+    def test_expiring_access_left_out(self):
+        expires_at = timezone.now() + datetime.timedelta(hours=1)
+        carol = self.site.users.create_item(
+            'carol@example.org', expires_at=expires_at)
+        self.locations['/foo'].grant_access(carol.uuid)
+        self.locations['/foo'].grant_access(
+            self.bob.uuid, expires_at=expires_at)
+        # Bob is also granted access through the group.
+        self.locations['/foo/bar/baz/'].grant_access(
+            self.bob.uuid, expires_at=expires_at)
+        data = acl_snapshot.build(self.site)
+        self.assertNotIn(str(carol.id), data['users'])
+        self.assertEqual([self.alice.id], data['locations']['/foo']['allowed'])
+        self.assertEqual([self.bob.id],
+                         data['locations']['/foo/bar/baz/']['allowed'])
+        snapshot = AclSnapshot(data)
+        self.assertEqual(401, snapshot.authorize('/foo', carol.id))
+        self.assertEqual(403, snapshot.authorize('/foo', self.bob.id))
+        self.assertEqual(200, snapshot.authorize('/foo/bar/baz/', self.bob.id))
+
+    def test_unknown_user_not_authenticated(self):
+        snapshot = AclSnapshot(acl_snapshot.build(self.site))
+        self.assertEqual(401, snapshot.authorize('/foo', 12345))
+
+    def test_unsupported_format_rejected(self):
+        data = acl_snapshot.build(self.site)
+        data['format'] = 2
+        self.assertRaises(SnapshotFormatError, AclSnapshot, data)
+
+    def test_export_command(self):
+        out_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(out_dir, 'acl.json')
+            call_command('export_acl_snapshot', path,
+                         stdout=StringIO.StringIO())
+            snapshot = AclSnapshot.load(path)
+            self.assertEqual(self.site.get_mod_id_ts(), snapshot.mod_id)
+            self.assertTrue(snapshot.alias_defined('https://foo.example.org'))
+            self.assertEqual(200, snapshot.authorize('/foo', self.alice.id))
+            self.assertEqual(['acl.json'], os.listdir(out_dir))
+        finally:
+            shutil.rmtree(out_dir)
+
+    def test_export_command_fails_for_missing_site(self):
+        self.assertRaises(CommandError, call_command, 'export_acl_snapshot',
+                          '/tmp/acl.json', site_id='nosuchsite')
@@ -0,0 +1,106 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.test import TestCase
+from mock import patch
+from wwwhisper_auth import audit
+from wwwhisper_auth.audit import AuditLog
+from wwwhisper_auth.audit import DbWriter
+from wwwhisper_auth.audit import FileWriter
+from wwwhisper_auth.audit import RingBuffer
+from wwwhisper_auth.models import AuditRecord
+from wwwhisper_auth.tests.tests_views import AuthTestCase
+from wwwhisper_auth.tests.utils import TEST_SITE
+
+import json
+import os
+import shutil
+import tempfile
+
+class RingBufferTest(TestCase):
+    def test_push_and_drain(self):
+        buf = RingBuffer(3)
+        self.assertTrue(buf.push(1))
+        self.assertTrue(buf.push(2))
+        self.assertEqual([1, 2], buf.drain())
+        self.assertEqual([], buf.drain())
+        for i in xrange(3):
+            self.assertTrue(buf.push(i))
+        self.assertEqual([0, 1, 2], buf.drain())
+
+    def test_overflow_sampled(self):
+        buf = RingBuffer(3, overflow_sample=2)
+        for i in xrange(3):
+            buf.push(i)
+        # 3 is dropped, 4 replaces the oldest item, 5 is dropped...
+        self.assertEqual([False] * 4, [buf.push(i) for i in xrange(3, 7)])
+        self.assertEqual([2, 4, 6], buf.drain())
+        self.assertTrue(buf.push(7))
+        self.assertEqual([7], buf.drain())
+
+class AuditLogTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_records_written_to_db_in_batches(self):
+        log = AuditLog(DbWriter(), batch_size=2)
+        with patch.object(log, 'ensure_running'):
+            for i in xrange(5):
+                log.record(TEST_SITE, i, None, 200)
+        self.assertEqual(5, log.flush())
+        self.assertEqual(0, log.flush())
+        self.assertEqual(
+            [(TEST_SITE, i, None, 200) for i in xrange(5)],
+            list(AuditRecord.objects.order_by('user_id').values_list(
+                    'site_id', 'user_id', 'location_id', 'status')))
+
+    def test_records_written_to_rotated_files(self):
+        writer = FileWriter(self.dir, max_bytes=1, backup_count=2)
+        for i in xrange(3):
+            writer.write([(0, TEST_SITE, i, 7, 403)])
+        path = writer.path()
+        self.assertEqual(sorted(os.path.basename(path + suffix)
+                                for suffix in ('.1', '.2')),
+                         sorted(os.listdir(self.dir)))
+        with open(path + '.1') as src:
+            record = json.loads(src.read())
+        self.assertEqual({'site': TEST_SITE, 'user': 2, 'location': 7,
+                          'status': 403}, dict(
+                (k, v) for (k, v) in record.items() if k != 'time'))
+
+    def test_write_errors_do_not_propagate(self):
+        log = AuditLog(FileWriter(os.path.join(self.dir, 'nosuchdir')))
+        with patch.object(log, 'ensure_running'):
+            log.record(TEST_SITE, 1, 2, 200)
+        self.assertEqual(0, log.flush())
+
+class AuditedAuthTest(AuthTestCase):
+    def setUp(self):
+        super(AuditedAuthTest, self).setUp()
+        self.log = AuditLog(DbWriter())
+        patcher = patch.object(audit, 'log', self.log)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(self.log, 'ensure_running')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_decisions_recorded(self):
+        user = self.site.users.create_item('foo@example.com')
+        location = self.site.locations.create_item('/foo/')
+        location.grant_access(user.uuid)
+        self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.login('foo@example.com')
+        self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.get('/wwwhisper/auth/api/is-authorized/?path=/bar/')
+        self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/../bar')
+        self.assertEqual(3, self.log.flush())
+        self.assertEqual(
+            [(None, location.id, 401),
+             (user.id, location.id, 200),
+             (user.id, None, 403)],
+            list(AuditRecord.objects.order_by('id').values_list(
+                    'user_id', 'location_id', 'status')))
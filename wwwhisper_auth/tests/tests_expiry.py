@@ -0,0 +1,67 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.test import TestCase
+from django.utils import timezone
+from wwwhisper_auth import expiry
+from wwwhisper_auth.models import Permission
+from wwwhisper_auth.models import PermissionExpiration
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import User
+from wwwhisper_auth.models import UserExpiration
+
+import datetime
+
+TEST_SITE = 'https://example.com'
+TEST_SITE2 = 'https://example.org'
+
+class SweepTest(TestCase):
+    def setUp(self):
+        self.sites = SitesCollection()
+        self.site = self.sites.create_item(TEST_SITE)
+        self.site2 = self.sites.create_item(TEST_SITE2)
+        self.past = timezone.now() - datetime.timedelta(seconds=1)
+        self.future = timezone.now() + datetime.timedelta(hours=1)
+
+    def test_nothing_expired(self):
+        user = self.site.users.create_item(
+            'foo@example.com', expires_at=self.future)
+        self.site.locations.create_item('/foo/').grant_access(
+            user.uuid, expires_at=self.future)
+        mod_id = self.site.mod_id_from_db()
+        self.assertEqual(0, expiry.sweep())
+        self.assertEqual(mod_id, self.site.mod_id_from_db())
+        self.assertEqual(1, Permission.objects.count())
+
+    def test_expired_rows_deleted(self):
+        users = self.site.users
+        alice = users.create_item('alice@example.com')
+        bob = users.create_item('bob@example.com', expires_at=self.future)
+        carol = users.create_item('carol@example.com', expires_at=self.future)
+        location = self.site.locations.create_item('/foo/')
+        location.grant_access(alice.uuid, expires_at=self.past)
+        location.grant_access(bob.uuid)
+        location.grant_access(carol.uuid)
+        UserExpiration.objects.filter(user_id=bob.id).update(
+            expires_at=self.past)
+        mod_id = self.site.mod_id_from_db()
+        revoke_mod_id = self.site.revoke_mod_id_from_db()
+        # Bob and his permission, and the permission of Alice.
+        self.assertEqual(2, expiry.sweep(batch_size=1))
+        self.assertEqual(
+            ['alice@example.com', 'carol@example.com'],
+            sorted(User.objects.values_list('email', flat=True)))
+        self.assertEqual([carol.id], list(Permission.objects.values_list(
+                    'user_id', flat=True)))
+        self.assertEqual(0, PermissionExpiration.objects.count())
+        # Modified once per sweep, not once per deleted item.
+        self.assertEqual(mod_id + 1, self.site.mod_id_from_db())
+        self.assertEqual(mod_id + 1, self.site.revoke_mod_id_from_db())
+        self.assertNotEqual(revoke_mod_id, self.site.revoke_mod_id_from_db())
+
+    def test_only_sites_with_expired_rows_modified(self):
+        self.site.users.create_item('foo@example.com', expires_at=self.past)
+        mod_id = self.site2.mod_id_from_db()
+        self.assertEqual(1, expiry.sweep())
+        self.assertEqual(mod_id, self.site2.mod_id_from_db())
+        self.assertEqual(0, expiry.sweep())
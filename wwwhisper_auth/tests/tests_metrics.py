@@ -0,0 +1,150 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.test import TestCase
+from wwwhisper_auth import metrics
+from wwwhisper_auth import site_cache
+from wwwhisper_auth.metrics import Registry
+from wwwhisper_auth.tests.utils import HttpTestCase
+from wwwhisper_service.internal import InternalEndpoints
+
+import json
+import os
+import shutil
+import subprocess
+import tempfile
+
+class RegistryTest(TestCase):
+    def setUp(self):
+        self.registry = Registry()
+
+    def test_counter(self):
+        self.registry.inc('foo_total')
+        self.registry.inc('foo_total', 2)
+        self.registry.inc('foo_total', kind='bar')
+        exported = self.registry.export()
+        self.assertIn('# TYPE foo_total counter', exported)
+        self.assertIn('foo_total 3\n', exported)
+        self.assertIn('foo_total{kind="bar"} 1\n', exported)
+
+    def test_histogram(self):
+        self.registry.observe('latency', 0.0001, buckets=(0.001, 0.1), v='a')
+        self.registry.observe('latency', 0.05, buckets=(0.001, 0.1), v='a')
+        self.registry.observe('latency', 3, buckets=(0.001, 0.1), v='a')
+        exported = self.registry.export()
+        self.assertIn('# TYPE latency histogram', exported)
+        self.assertIn('latency_bucket{v="a",le="0.001"} 1\n', exported)
+        self.assertIn('latency_bucket{v="a",le="0.1"} 2\n', exported)
+        self.assertIn('latency_bucket{v="a",le="+Inf"} 3\n', exported)
+        self.assertIn('latency_count{v="a"} 3\n', exported)
+
+    def test_label_escaped(self):
+        self.registry.inc('foo_total', kind='a"b')
+        self.assertIn('foo_total{kind="a\\"b"} 1', self.registry.export())
+
+    def test_metrics_aggregated_from_all_processes(self):
+        metrics_dir = tempfile.mkdtemp()
+        try:
+            other_worker = Registry()
+            other_worker.inc('foo_total', 2)
+            other_worker.observe('latency', 0.01)
+            # Simulate a file dumped by another process.
+            with open(os.path.join(metrics_dir, '%d.json' % os.getppid()),
+                      'w') as out:
+                json.dump(other_worker.snapshot(), out)
+            worker = Registry(metrics_dir)
+            worker.inc('foo_total', 3)
+            worker.observe('latency', 0.01)
+            exported = worker.export()
+            self.assertIn('foo_total 5\n', exported)
+            self.assertIn('latency_count 2\n', exported)
+        finally:
+            shutil.rmtree(metrics_dir)
+
+    def test_files_of_dead_processes_removed(self):
+        metrics_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, metrics_dir)
+        dead_worker = Registry()
+        dead_worker.inc('foo_total', 2)
+        process = subprocess.Popen(['true'])
+        process.wait()
+        dead_path = os.path.join(metrics_dir, '%d.json' % process.pid)
+        with open(dead_path, 'w') as out:
+            json.dump(dead_worker.snapshot(), out)
+        worker = Registry(metrics_dir)
+        worker.inc('foo_total', 3)
+        self.assertIn('foo_total 3\n', worker.export())
+        self.assertFalse(os.path.exists(dead_path))
+        self.assertEqual(['%d.json' % os.getpid()], os.listdir(metrics_dir))
+
+class MetricsMiddlewareTest(HttpTestCase):
+    def test_auth_request_recorded(self):
+        self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        exported = metrics.registry.export()
+        self.assertRegexpMatches(
+            exported,
+            'wwwhisper_request_duration_seconds_count{view="Auth"} [1-9]')
+        self.assertRegexpMatches(
+            exported, 'wwwhisper_request_db_queries_count{view="Auth"} [1-9]')
+
+    def test_admin_collection_labeled(self):
+        self.get('/wwwhisper/admin/api/locations/')
+        self.get('/wwwhisper/admin/api/users/')
+        exported = metrics.registry.export()
+        self.assertRegexpMatches(
+            exported, 'wwwhisper_request_duration_seconds_count'
+            '{view="CollectionView:locations"} [1-9]')
+        self.assertRegexpMatches(
+            exported, 'wwwhisper_request_duration_seconds_count'
+            '{view="UsersView:users"} [1-9]')
+
+    def test_cache_reloads_recorded(self):
+        self.site.locations.create_item('/foo/')
+        self.site.locations.all()
+        self.assertRegexpMatches(
+            metrics.registry.export(),
+            'wwwhisper_cache_reload_seconds_count{collection="location"} [1-9]')
+
+class InternalEndpointsTest(TestCase):
+    def setUp(self):
+        self.passed_on = []
+        def app(environ, start_response):
+            self.passed_on.append(environ['PATH_INFO'])
+            return ['app']
+        self.app = InternalEndpoints(app)
+
+    def call(self, path):
+        result = {}
+        def start_response(status, headers):
+            result['status'] = status
+            result['headers'] = dict(headers)
+        body = self.app({'PATH_INFO': path}, start_response)
+        return result, ''.join(body)
+
+    def test_metrics_served(self):
+        metrics.registry.inc('wwwhisper_test_total')
+        result, body = self.call('/wwwhisper/metrics')
+        self.assertEqual('200 OK', result['status'])
+        self.assertRegexpMatches(result['headers']['Content-Type'],
+                                 'text/plain; version=0.0.4')
+        self.assertIn('wwwhisper_test_total', body)
+        self.assertEqual([], self.passed_on)
+
+    def test_other_requests_passed_to_application(self):
+        result, body = self.call('/wwwhisper/auth/api/whoami/')
+        self.assertEqual('app', body)
+        self.assertEqual(['/wwwhisper/auth/api/whoami/'], self.passed_on)
+
+    def test_ready(self):
+        result, body = self.call('/wwwhisper/ready')
+        self.assertEqual('200 OK', result['status'])
+        self.assertEqual('Ready.', body)
+
+    def test_not_ready_while_warming_up(self):
+        site_cache.warm_up._done.clear()
+        try:
+            result, body = self.call('/wwwhisper/ready')
+        finally:
+            site_cache.warm_up._done.set()
+        self.assertEqual('503 Service Unavailable', result['status'])
+        self.assertEqual('Warming up.', body)
@@ -1,17 +1,22 @@
 # wwwhisper - web access control.
 # Copyright (C) 2012-2015 Jan Wrobel <jan@mixedbit.org>
 
+from django.forms import ValidationError
 from django.http import HttpRequest
 from django.test import TestCase
+from django.test import override_settings
 from django.test.client import RequestFactory
 
 from wwwhisper_auth import http
+from wwwhisper_auth import site_cache
+from wwwhisper_auth.middleware import MultiTenantSiteMiddleware
 from wwwhisper_auth.middleware import SecuringHeadersMiddleware
 from wwwhisper_auth.middleware import ProtectCookiesMiddleware
 from wwwhisper_auth.middleware import SetSiteMiddleware
 from wwwhisper_auth.middleware import SiteUrlMiddleware
 from wwwhisper_auth.models import SitesCollection
 from wwwhisper_auth.models import SINGLE_SITE_ID
+from wwwhisper_auth.site_cache import AliasIndex
 
 class SetSiteMiddlewareTest(TestCase):
     def test_site_set_if_exists(self):
@@ -27,6 +32,16 @@ class SetSiteMiddlewareTest(TestCase):
         self.assertIsNone(middleware.process_request(r))
         self.assertIsNone(r.site)
 
+    def test_site_preloaded(self):
+        site = SitesCollection().create_item(SINGLE_SITE_ID)
+        with override_settings(WWWHISPER_PRELOAD_SITES=True):
+            middleware = SetSiteMiddleware()
+        r = HttpRequest()
+        # Only the query that checks if the cached site is up to date.
+        with self.assertNumQueries(1):
+            self.assertIsNone(middleware.process_request(r))
+        self.assertEqual(SINGLE_SITE_ID, r.site.site_id)
+
 class SiteUrlMiddlewareTest(TestCase):
     def setUp(self):
         self.middleware = SiteUrlMiddleware()
@@ -142,6 +157,119 @@ class SiteUrlMiddlewareTest(TestCase):
         self.assertEqual('https://foo.example.com/foo/bar/baz?x=y&z=1',
                          response['Location'])
 
+SITE_A = 'https://a.example.org'
+SITE_B = 'https://b.example.org'
+
+@override_settings(WWWHISPER_MULTI_TENANT=True)
+class MultiTenantSiteMiddlewareTest(TestCase):
+    def setUp(self):
+        sites_collection = SitesCollection()
+        self.site_a = sites_collection.create_item(SITE_A)
+        self.site_a.aliases.create_item(SITE_A)
+        self.site_b = sites_collection.create_item(SITE_B)
+        self.site_b.aliases.create_item(SITE_B)
+        self.site_b.aliases.create_item('http://b2.example.org')
+        self.middleware = MultiTenantSiteMiddleware()
+        # Not invalidated by changes to aliases, so behaves like an
+        # index of other process.
+        self.middleware.alias_index = AliasIndex(min_reload_interval=0)
+
+    def site_id(self, site_url):
+        request = HttpRequest()
+        if site_url is not None:
+            request.META['HTTP_SITE_URL'] = site_url
+        response = self.middleware.process_request(request)
+        if response is not None:
+            self.assertEqual(400, response.status_code)
+            return None
+        return request.site.site_id
+
+    def test_site_found_by_alias(self):
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+        self.assertEqual(SITE_B, self.site_id(SITE_B))
+        self.assertEqual(SITE_B, self.site_id('http://b2.example.org'))
+        self.assertEqual(SITE_A, self.site_id(SITE_A + ':443'))
+
+    def test_unknown_site_url_rejected(self):
+        self.assertIsNone(self.site_id(None))
+        self.assertIsNone(self.site_id('https://c.example.org'))
+        self.assertIsNone(self.site_id('https://b2.example.org'))
+
+    def test_http_site_url_redirects_to_https_alias(self):
+        request = RequestFactory().get('/foo')
+        request.META['HTTP_SITE_URL'] = 'http://a.example.org'
+        self.assertIsNone(self.middleware.process_request(request))
+        self.assertEqual(SITE_A, request.site.site_id)
+        response = SiteUrlMiddleware().process_request(request)
+        self.assertEqual(302, response.status_code)
+        self.assertEqual('https://a.example.org/foo', response['Location'])
+
+    def test_index_not_queried_for_each_request(self):
+        self.site_id(SITE_A)
+        # Only the query that checks if the cached site is up to date.
+        with self.assertNumQueries(1):
+            self.assertEqual(SITE_A, self.site_id(SITE_A))
+
+    def test_unknown_site_url_reloads_index_at_most_once_per_interval(self):
+        self.middleware.alias_index = AliasIndex(min_reload_interval=100)
+        self.assertIsNone(self.site_id('https://c.example.org'))
+        self.site_a.aliases.create_item('https://c.example.org')
+        with self.assertNumQueries(0):
+            self.assertIsNone(self.site_id('https://c.example.org'))
+        self.middleware.alias_index.invalidate()
+        self.assertEqual(SITE_A, self.site_id('https://c.example.org'))
+
+    def test_alias_added_by_other_process(self):
+        self.assertIsNone(self.site_id('https://c.example.org'))
+        self.site_b.aliases.create_item('https://c.example.org')
+        self.assertEqual(SITE_B, self.site_id('https://c.example.org'))
+
+    def test_alias_moved_by_other_process(self):
+        self.middleware.alias_index = AliasIndex(min_reload_interval=100)
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+        alias = self.site_a.aliases.find_item_by_url(SITE_A)
+        self.site_a.aliases.delete_item(alias.uuid)
+        self.site_b.aliases.create_item(SITE_A)
+        self.assertEqual(SITE_B, self.site_id(SITE_A))
+
+    def test_alias_removed_by_other_process(self):
+        self.middleware.alias_index = AliasIndex(min_reload_interval=100)
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+        alias = self.site_a.aliases.find_item_by_url(SITE_A)
+        self.site_a.aliases.delete_item(alias.uuid)
+        self.assertIsNone(self.site_id(SITE_A))
+
+    def test_site_deleted_by_other_process(self):
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+        SitesCollection().delete_item(SITE_A)
+        self.assertIsNone(self.site_id(SITE_A))
+
+    def test_alias_of_other_site_rejected(self):
+        self.assertRaisesRegexp(ValidationError,
+                                'belongs to other site',
+                                self.site_b.aliases.create_item,
+                                SITE_A)
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+
+    def test_alias_added_by_many_sites_before_multi_tenant_mode(self):
+        url = 'https://c.example.org'
+        with override_settings(WWWHISPER_MULTI_TENANT=False):
+            self.site_b.aliases.create_item(url)
+            self.site_a.aliases.create_item(url)
+            self.site_b.aliases.create_item(SITE_A)
+        # Not owned by any site.
+        self.assertIsNone(self.site_id(url))
+        # Owned by the site that added it in the multi-tenant mode.
+        self.assertEqual(SITE_A, self.site_id(SITE_A))
+
+    def test_alias_changes_invalidate_process_index(self):
+        index = site_cache.alias_index
+        self.assertEqual(SITE_A, index.find_site_id(SITE_A))
+        alias = self.site_a.aliases.find_item_by_url(SITE_A)
+        self.site_a.aliases.delete_item(alias.uuid)
+        with self.assertNumQueries(1):
+            self.assertIsNone(index.find_site_id(SITE_A))
+
 class ProtectCookiesMiddlewareTest(TestCase):
 
     def test_secure_flag_set_for_https_request(self):
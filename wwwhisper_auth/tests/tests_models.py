@@ -6,10 +6,19 @@
 from django.db import transaction
 from django.forms import ValidationError
 from django.test import TestCase
+from django.utils import timezone
 from contextlib import contextmanager
 from functools import wraps
+from mock import patch
 from wwwhisper_auth.models import LimitExceeded
+from wwwhisper_auth.models import Location
+from wwwhisper_auth.models import LocationsCollection
+from wwwhisper_auth.models import Permission
 from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import User
+
+import datetime
+import time
 
 FAKE_UUID = '41be0192-0fcc-4a9c-935d-69243b75533c'
 TEST_SITE = 'https://example.com'
@@ -69,6 +78,36 @@ class SiteModifiedTest(ModelTestCase):
         else:
             self.fail('Assertion not raised')
 
+class RevokingModificationTest(ModelTestCase):
+    def test_not_revoked_by_default(self):
+        self.site.site_modified()
+        self.assertEqual(0, self.site.revoke_mod_id_from_db())
+
+    def test_revoking_modification_recorded(self):
+        self.site.site_modified(revoking=True)
+        self.assertEqual(self.site.mod_id, self.site.revoke_mod_id_from_db())
+        self.site.site_modified()
+        self.assertEqual(self.site.mod_id - 1,
+                         self.site.revoke_mod_id_from_db())
+
+    def test_revoking_operations(self):
+        user = self.users.create_item(TEST_USER_EMAIL)
+        location = self.locations.create_item(TEST_LOCATION)
+        location.grant_access(user.uuid)
+        location.grant_open_access()
+        self.assertEqual(0, self.site.revoke_mod_id_from_db())
+        for revoke in (lambda: location.revoke_open_access(),
+                       lambda: location.revoke_access(user.uuid),
+                       lambda: self.users.delete_item(user.uuid),
+                       lambda: self.locations.delete_item(location.uuid)):
+            revoke()
+            self.assertEqual(self.site.mod_id,
+                             self.site.revoke_mod_id_from_db())
+
+    def test_missing_site(self):
+        self.sites.delete_item(TEST_SITE)
+        self.assertIsNone(self.site.revoke_mod_id_from_db())
+
 class SitesTest(ModelTestCase):
     def test_create_site(self):
         self.assertEqual(TEST_SITE, self.site.site_id)
@@ -141,11 +180,25 @@ class UsersCollectionTest(ModelTestCase):
         user1 = self.users.create_item(TEST_USER_EMAIL)
         self.assertIsNone(self.site2.users.find_item(user1.uuid))
 
+    def test_cached_user_hydrated_without_queries(self):
+        user = self.users.create_item(TEST_USER_EMAIL)
+        User.objects.filter(id=user.id).update(password='secret')
+        cached = self.users.find_item(user.uuid)
+        with self.assertNumQueries(0):
+            model = cached.as_model()
+        self.assertIsInstance(model, User)
+        self.assertEqual(user.uuid, model.uuid)
+        self.assertEqual(TEST_USER_EMAIL, model.email)
+        self.assertEqual(self.site, model.site)
+        # Fields not held by the record are not overwritten on save.
+        model.save()
+        self.assertEqual('secret', User.objects.get(id=user.id).password)
+
     def test_delete_site_deletes_user(self):
         user = self.users.create_item(TEST_USER_EMAIL)
-        self.assertEqual(1, user.__class__.objects.filter(id=user.id).count())
+        self.assertEqual(1, User.objects.filter(id=user.id).count())
         self.assertTrue(self.sites.delete_item(self.site.site_id))
-        self.assertEqual(0, user.__class__.objects.filter(id=user.id).count())
+        self.assertEqual(0, User.objects.filter(id=user.id).count())
 
     def test_find_user_by_email(self):
         self.assertIsNone(self.users.find_item_by_email(TEST_USER_EMAIL))
@@ -303,10 +356,10 @@ class LocationsCollectionTest(ModelTestCase):
     def test_delete_site_deletes_location(self):
         location = self.locations.create_item(TEST_LOCATION)
         self.assertEqual(
-            1, location.__class__.objects.filter(id=location.id).count())
+            1, Location.objects.filter(id=location.id).count())
         self.assertTrue(self.sites.delete_item(self.site.site_id))
         self.assertEqual(
-            0, location.__class__.objects.filter(id=location.id).count())
+            0, Location.objects.filter(id=location.id).count())
 
     def test_find_location_by_uuid(self):
         location1 = self.locations.create_item(TEST_LOCATION)
@@ -486,6 +539,48 @@ class LocationsCollectionTest(ModelTestCase):
                                 location.get_permission,
                                 user2.uuid)
 
+    def test_allowed_user_ids(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        user1 = self.users.create_item(TEST_USER_EMAIL)
+        user2 = self.users.create_item('bar@example.com')
+        self.assertEqual(frozenset(), location.allowed_user_ids())
+        location.grant_access(user1.uuid)
+        location.grant_access(user2.uuid)
+        self.assertEqual(frozenset([user1.id, user2.id]),
+                         location.allowed_user_ids())
+        location.revoke_access(user1.uuid)
+        self.assertEqual(frozenset([user2.id]), location.allowed_user_ids())
+
+    def test_cache_up_to_date_only_after_permissions_loaded(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        user = self.users.create_item(TEST_USER_EMAIL)
+        location.grant_access(user.uuid)
+        self.assertTrue(location.can_access(user))
+        location.revoke_access(user.uuid)
+        update_related_cache = LocationsCollection._update_related_cache
+        seen_obsolete = []
+        def check_obsolete(collection, site_id):
+            seen_obsolete.append(collection.is_cache_obsolete())
+            update_related_cache(collection, site_id)
+        with patch.object(LocationsCollection, '_update_related_cache',
+                          check_obsolete):
+            self.assertFalse(location.can_access(user))
+        # Concurrent readers would wait for the reload instead of
+        # using the revoked permission.
+        self.assertEqual([True], seen_obsolete)
+
+    def test_permission_retrieved_on_demand(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        user = self.users.create_item(TEST_USER_EMAIL)
+        location.grant_access(user.uuid)
+        # Force caches reload.
+        self.locations.all()
+        self.users.all()
+        with self.assertNumQueries(1):
+            permission = location.get_permission(user.uuid)
+            self.assertEqual(user.email, permission.user.email)
+            self.assertEqual(location.uuid, permission.http_location.uuid)
+
     def test_find_location_by_path(self):
         location = self.locations.create_item('/foo/bar')
         with self.assert_site_not_modified(self.site):
@@ -534,6 +629,20 @@ class LocationsCollectionTest(ModelTestCase):
             location2, self.locations.find_location('/foo/bar/baz/bam'))
         self.assertFalse(location2.can_access(user))
 
+    def test_pattern_location(self):
+        generic = self.locations.create_item('/users/')
+        private = self.locations.create_item('/users/*/private/')
+        self.assertEqual(
+            private, self.locations.find_location('/users/foo/private/x'))
+        self.assertEqual(
+            generic, self.locations.find_location('/users/foo/public/x'))
+        alice = self.locations.create_item('/users/alice/private/')
+        self.assertEqual(
+            alice, self.locations.find_location('/users/alice/private/x'))
+        self.locations.delete_item(private.uuid)
+        self.assertEqual(
+            generic, self.locations.find_location('/users/foo/private/x'))
+
     def test_trailing_slash_respected(self):
         location = self.locations.create_item('/foo/bar/')
         self.assertIsNone(self.locations.find_location('/foo/bar'))
@@ -655,6 +764,89 @@ class LocationsCollectionTest(ModelTestCase):
                                 self.locations.create_item,
                                 '/foo10')
 
+    def test_grant_domain_access(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        user = self.users.create_item(TEST_USER_EMAIL)
+        self.assertFalse(location.can_access(user))
+        self.assertFalse(self.locations.is_domain_granted(TEST_USER_EMAIL))
+        with self.assert_site_modified(self.site):
+            (permission, created) = location.grant_domain_access('@BAR.com ')
+        self.assertTrue(created)
+        self.assertEqual('bar.com', permission.domain)
+        (_, created) = location.grant_domain_access('bar.com')
+        self.assertFalse(created)
+        self.assertTrue(location.can_access(user))
+        self.assertEqual(frozenset(['bar.com']), location.allowed_domains())
+        self.assertEqual('bar.com',
+                         location.get_domain_permission('Bar.com').domain)
+        self.assertTrue(self.locations.is_domain_granted('new@Bar.com'))
+        self.assertEqual(frozenset([user.id]),
+                         self.locations.get_granted_user_ids(location.id))
+        # Grants do not leak to other domains, locations and sites.
+        self.assertFalse(location.can_access(
+                self.users.create_item('foo@foobar.com')))
+        self.assertFalse(location.can_access(
+                self.users.create_item('foo@sub.bar.com')))
+        self.assertFalse(self.locations.create_item('/foo').can_access(user))
+        self.assertFalse(self.site2.locations.is_domain_granted(
+                TEST_USER_EMAIL))
+
+    def test_revoke_domain_access(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        user = self.users.create_item(TEST_USER_EMAIL)
+        location.grant_domain_access('bar.com')
+        with self.assert_site_modified(self.site):
+            location.revoke_domain_access('bar.com')
+        self.assertFalse(location.can_access(user))
+        self.assertFalse(self.locations.is_domain_granted(TEST_USER_EMAIL))
+        self.assertRaisesRegexp(LookupError, 'Domain can not access',
+                                location.revoke_domain_access, 'bar.com')
+        self.assertRaisesRegexp(LookupError, 'Domain can not access',
+                                location.get_domain_permission, 'bar.com')
+
+    def test_domain_validation(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        with self.assert_site_not_modified(self.site):
+            for domain in ('', '@', 'foo@bar.com', 'bar', 'bar com'):
+                self.assertRaisesRegexp(ValidationError,
+                                        'Invalid domain format',
+                                        location.grant_domain_access, domain)
+            self.assertRaisesRegexp(ValidationError, 'Domain too long',
+                                    location.grant_domain_access,
+                                    'a' * 250 + '.com')
+
+    def test_deleting_location_revokes_domain_access(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        location.grant_domain_access('bar.com')
+        self.locations.delete_item(location.uuid)
+        self.assertFalse(self.locations.is_domain_granted(TEST_USER_EMAIL))
+
+    def test_domain_user_not_cached(self):
+        location = self.locations.create_item(TEST_LOCATION)
+        location.grant_domain_access('bar.com')
+        with self.assert_site_not_modified(self.site):
+            user = self.users.create_domain_user(TEST_USER_EMAIL)
+        self.assertEqual([], self.users.all())
+        self.assertEqual(user, self.users.find_item_by_email(TEST_USER_EMAIL))
+        self.assertEqual(user, self.users.find_item_by_pk(user.id))
+        self.assertTrue(location.can_access(user))
+        self.assertRaisesRegexp(ValidationError, 'User already exists',
+                                self.users.create_domain_user,
+                                TEST_USER_EMAIL)
+        location.revoke_domain_access('bar.com')
+        self.assertIsNone(self.users.find_item_by_email(TEST_USER_EMAIL))
+
+    def test_domain_user_becomes_regular_user(self):
+        self.locations.create_item(TEST_LOCATION).grant_domain_access(
+            'bar.com')
+        domain_user = self.users.create_domain_user(TEST_USER_EMAIL)
+        with self.assert_site_modified(self.site):
+            user = self.users.create_item(TEST_USER_EMAIL)
+        self.assertEqual(domain_user.id, user.id)
+        self.assertEqual([user], self.users.all())
+        self.assertRaisesRegexp(ValidationError, 'User already exists',
+                                self.users.create_item, TEST_USER_EMAIL)
+
 class AliasesCollectionTest(ModelTestCase):
 
     def test_add_alias(self):
@@ -734,3 +926,215 @@ class AliasesCollectionTest(ModelTestCase):
                                 'Url too long',
                                 self.aliases.create_item,
                                 long_url)
+
+class GroupsCollectionTest(ModelTestCase):
+    def setUp(self):
+        super(GroupsCollectionTest, self).setUp()
+        self.groups = self.site.groups
+        self.user = self.users.create_item(TEST_USER_EMAIL)
+        self.location = self.locations.create_item(TEST_LOCATION)
+
+    def test_create_group(self):
+        with self.assert_site_modified(self.site):
+            group = self.groups.create_item(' staff ')
+        self.assertEqual('staff', group.name)
+        self.assertEqual(group, self.groups.find_item(group.uuid))
+        self.assertEqual(group, self.groups.find_item_by_name('staff'))
+        self.assertIsNone(self.site2.groups.find_item_by_name('staff'))
+
+    def test_group_name_validation(self):
+        self.assertRaisesRegexp(ValidationError, 'should not be empty',
+                                self.groups.create_item, '  ')
+        self.assertRaisesRegexp(ValidationError, 'too long',
+                                self.groups.create_item, 'x' * 101)
+        self.groups.create_item('staff')
+        self.assertRaisesRegexp(ValidationError, 'already exists',
+                                self.groups.create_item, 'staff')
+        self.assertIsNotNone(self.site2.groups.create_item('staff'))
+
+    def test_groups_limit(self):
+        self.site.groups_limit = 1
+        self.groups.create_item('staff')
+        self.assertRaisesRegexp(LimitExceeded, 'Groups limit exceeded',
+                                self.groups.create_item, 'admins')
+
+    def test_add_and_remove_member(self):
+        group = self.groups.create_item('staff')
+        with self.assert_site_modified(self.site):
+            (membership, created) = group.add_member(self.user.uuid)
+        self.assertTrue(created)
+        self.assertEqual(self.user, membership.user)
+        (_, created) = group.add_member(self.user.uuid)
+        self.assertFalse(created)
+        self.assertEqual([self.user], group.members())
+        self.assertEqual(self.user, group.get_membership(self.user.uuid).user)
+        with self.assert_site_modified(self.site):
+            group.remove_member(self.user.uuid)
+        self.assertEqual([], group.members())
+        self.assertRaisesRegexp(LookupError, 'not a member',
+                                group.remove_member, self.user.uuid)
+        self.assertRaisesRegexp(LookupError, 'User not found',
+                                group.add_member, FAKE_UUID)
+
+    def test_group_grants_access_to_members(self):
+        group = self.groups.create_item('staff')
+        group.add_member(self.user.uuid)
+        self.assertFalse(self.location.can_access(self.user))
+        with self.assert_site_modified(self.site):
+            (permission, created) = self.location.grant_group_access(
+                group.uuid)
+        self.assertTrue(created)
+        self.assertEqual(group, permission.group)
+        self.assertTrue(self.location.can_access(self.user))
+        self.assertEqual(frozenset(), self.location.allowed_user_ids())
+        self.assertEqual([group], self.location.allowed_groups())
+        self.assertEqual(
+            frozenset([self.user.id]),
+            self.locations.get_granted_user_ids(self.location.id))
+        # Grants do not leak to other users and locations.
+        user2 = self.users.create_item('bar@example.org')
+        self.assertFalse(self.location.can_access(user2))
+        self.assertFalse(
+            self.locations.create_item('/foo').can_access(self.user))
+
+    def test_access_through_many_grants(self):
+        group1 = self.groups.create_item('staff')
+        group2 = self.groups.create_item('admins')
+        group1.add_member(self.user.uuid)
+        group2.add_member(self.user.uuid)
+        self.location.grant_group_access(group1.uuid)
+        self.location.grant_group_access(group2.uuid)
+        self.location.grant_access(self.user.uuid)
+        self.location.revoke_group_access(group1.uuid)
+        self.assertTrue(self.location.can_access(self.user))
+        self.location.revoke_access(self.user.uuid)
+        self.assertTrue(self.location.can_access(self.user))
+        group2.remove_member(self.user.uuid)
+        self.assertFalse(self.location.can_access(self.user))
+        self.assertRaisesRegexp(LookupError, 'Group can not access',
+                                self.location.revoke_group_access,
+                                group1.uuid)
+
+    def test_deleting_group_revokes_access(self):
+        group = self.groups.create_item('staff')
+        group.add_member(self.user.uuid)
+        self.location.grant_group_access(group.uuid)
+        self.assertTrue(self.groups.delete_item(group.uuid))
+        self.assertFalse(self.location.can_access(self.user))
+        self.assertEqual([], self.location.allowed_groups())
+
+    def test_deleting_user_removes_membership(self):
+        group = self.groups.create_item('staff')
+        group.add_member(self.user.uuid)
+        self.users.delete_item(self.user.uuid)
+        self.assertEqual(frozenset(), group.member_ids())
+
+    def test_group_of_different_site_can_not_be_granted_access(self):
+        group = self.site2.groups.create_item('staff')
+        self.assertRaisesRegexp(LookupError, 'Group not found',
+                                self.location.grant_group_access, group.uuid)
+        self.assertRaisesRegexp(LookupError, 'User not found',
+                                group.add_member, self.user.uuid)
+
+class ExpirationTest(ModelTestCase):
+    def setUp(self):
+        super(ExpirationTest, self).setUp()
+        self.user = self.users.create_item(TEST_USER_EMAIL)
+        self.location = self.locations.create_item(TEST_LOCATION)
+        self.expires_at = timezone.now() + datetime.timedelta(hours=1)
+
+    @contextmanager
+    def hours_later(self, hours):
+        with patch('wwwhisper_auth.models.time.time',
+                   return_value=time.time() + hours * 3600):
+            yield
+
+    def test_permission_expires(self):
+        (permission, _) = self.location.grant_access(
+            self.user.uuid, expires_at=self.expires_at)
+        self.assertEqual(self.expires_at, permission.get_expiration())
+        self.assertEqual(
+            self.expires_at.isoformat(),
+            permission.attributes_dict(TEST_SITE)['expiresAt'])
+        self.assertTrue(self.location.can_access(self.user))
+        with self.hours_later(2):
+            # No query is needed to drop the expired permission.
+            with self.assertNumQueries(0):
+                self.assertFalse(self.location.can_access(self.user))
+            self.assertEqual([], self.location.allowed_users())
+
+    def test_granting_again_replaces_expiration(self):
+        self.location.grant_access(self.user.uuid, expires_at=self.expires_at)
+        (permission, created) = self.location.grant_access(self.user.uuid)
+        self.assertFalse(created)
+        self.assertIsNone(permission.get_expiration())
+        with self.hours_later(2):
+            self.assertTrue(self.location.can_access(self.user))
+
+    def test_shortening_expiration_is_revoking(self):
+        self.location.grant_access(self.user.uuid, expires_at=self.expires_at)
+        self.assertEqual(0, self.site.revoke_mod_id_from_db())
+        self.location.grant_access(
+            self.user.uuid,
+            expires_at=self.expires_at + datetime.timedelta(hours=1))
+        self.assertEqual(0, self.site.revoke_mod_id_from_db())
+        self.location.grant_access(self.user.uuid)
+        self.assertEqual(0, self.site.revoke_mod_id_from_db())
+        self.location.grant_access(self.user.uuid, expires_at=self.expires_at)
+        self.assertEqual(self.site.mod_id, self.site.revoke_mod_id_from_db())
+        self.location.grant_access(
+            self.user.uuid,
+            expires_at=self.expires_at - datetime.timedelta(minutes=1))
+        self.assertEqual(self.site.mod_id, self.site.revoke_mod_id_from_db())
+
+    def test_user_expires(self):
+        user = self.users.create_item(
+            'bar@example.com', expires_at=self.expires_at.isoformat())
+        self.location.grant_access(user.uuid)
+        self.assertEqual(self.expires_at, self.users.get_expiration(user.id))
+        self.assertEqual(self.expires_at.isoformat(),
+                         user.attributes_dict(TEST_SITE)['expiresAt'])
+        self.assertEqual([self.user, user], self.users.all())
+        with self.hours_later(2):
+            self.assertEqual([self.user], self.users.all())
+            self.assertIsNone(self.users.find_item_by_email('bar@example.com'))
+            self.assertIsNone(self.users.find_item_by_pk(user.id))
+            self.assertEqual([], self.location.allowed_users())
+
+    def test_granting_again_after_expiration(self):
+        self.location.grant_access(
+            self.user.uuid,
+            expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        # Dropped from the cache, but not yet swept from the DB.
+        self.assertFalse(self.location.can_access(self.user))
+        (permission, created) = self.location.grant_access(self.user.uuid)
+        self.assertTrue(created)
+        self.assertIsNone(permission.get_expiration())
+        self.assertEqual(permission,
+                         self.location.get_permission(self.user.uuid))
+        self.assertEqual(1, Permission.objects.count())
+        self.assertTrue(self.location.can_access(self.user))
+
+    def test_expired_items_dropped_after_reload(self):
+        self.location.grant_access(
+            self.user.uuid,
+            expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        self.users.create_item(
+            'bar@example.com',
+            expires_at=timezone.now() - datetime.timedelta(seconds=1))
+        site = self.sites.find_item(TEST_SITE)
+        self.assertFalse(
+            site.locations.find_item(self.location.uuid).can_access(
+                self.user))
+        self.assertEqual([self.user], site.users.all())
+
+    def test_invalid_expiration(self):
+        with self.assert_site_not_modified(self.site):
+            self.assertRaisesRegexp(ValidationError,
+                                    'Invalid expiration time format',
+                                    self.location.grant_access,
+                                    self.user.uuid, expires_at='tomorrow')
+            self.assertRaisesRegexp(ValidationError,
+                                    'Invalid expiration time format',
+                                    self.users.create_item,
+                                    'bar@example.com', expires_at='2018-13-01')
@@ -0,0 +1,128 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.test import TestCase
+from wwwhisper_auth.path_matcher import PathMatcher
+from wwwhisper_auth.path_matcher import is_pattern
+
+import itertools
+import time
+
+def literal_match(location_paths, canonical_path):
+    """Matching of literal locations before patterns were supported."""
+    best = None
+    for path in location_paths:
+        if path.endswith('/'):
+            boundary = len(path) - 1
+        else:
+            boundary = len(path)
+        if (canonical_path.startswith(path) and
+            (best is None or len(path) > len(best)) and
+            (len(path) == len(canonical_path) or
+             canonical_path[boundary] == '/')):
+            best = path
+    return best
+
+class PathMatcherTest(TestCase):
+    def match(self, location_paths, canonical_path):
+        matcher = PathMatcher((path, path) for path in location_paths)
+        return matcher.match(canonical_path)
+
+    def test_is_pattern(self):
+        self.assertTrue(is_pattern('/users/*/private/'))
+        self.assertTrue(is_pattern('/**'))
+        self.assertFalse(is_pattern('/users/'))
+        self.assertFalse(is_pattern('/foo*/'))
+        self.assertFalse(is_pattern('/***'))
+
+    def test_same_results_as_literal_matching(self):
+        location_paths = ['/', '/foo', '/foo/', '/foo/bar', '/foo/bar/baz/',
+                          '/qux/', '/fo', '/bar/foo']
+        segments = ['', 'foo', 'fo', 'foobar', 'bar', 'baz', 'qux']
+        for depth in xrange(1, 5):
+            for parts in itertools.product(segments, repeat=depth):
+                path = '/' + '/'.join(parts)
+                if '//' in path:
+                    continue
+                for count in (1, 3, len(location_paths)):
+                    self.assertEqual(
+                        literal_match(location_paths[-count:], path),
+                        self.match(location_paths[-count:], path), path)
+
+    def test_star_matches_single_segment(self):
+        paths = ['/users/*/private/']
+        self.assertEqual(paths[0], self.match(paths, '/users/alice/private/'))
+        self.assertEqual(paths[0],
+                         self.match(paths, '/users/bob/private/a/b.jpg'))
+        self.assertIsNone(self.match(paths, '/users/alice/private'))
+        self.assertIsNone(self.match(paths, '/users/private/'))
+        self.assertIsNone(self.match(paths, '/users/a/b/private/'))
+
+    def test_star_does_not_match_empty_segment(self):
+        self.assertIsNone(self.match(['/users/*'], '/users/'))
+        self.assertEqual('/users/*', self.match(['/users/*'], '/users/a'))
+        self.assertEqual('/users/*', self.match(['/users/*'], '/users/a/'))
+
+    def test_globstar_matches_any_number_of_segments(self):
+        paths = ['/**/secret']
+        self.assertEqual(paths[0], self.match(paths, '/secret'))
+        self.assertEqual(paths[0], self.match(paths, '/a/secret'))
+        self.assertEqual(paths[0], self.match(paths, '/a/b/c/secret/d'))
+        self.assertIsNone(self.match(paths, '/a/secrets'))
+        self.assertIsNone(self.match(paths, '/a/b'))
+        self.assertEqual('/a/**/', self.match(['/a/**/'], '/a/b/c'))
+        self.assertEqual('/a/**/', self.match(['/a/**/'], '/a/'))
+        self.assertIsNone(self.match(['/a/**/'], '/a'))
+
+    def test_part_of_segment_is_not_wildcard(self):
+        self.assertIsNone(self.match(['/foo*'], '/foobar'))
+        self.assertEqual('/foo*', self.match(['/foo*'], '/foo*/bar'))
+
+    def test_location_with_more_segments_wins(self):
+        paths = ['/users/', '/users/alice/', '/users/*/private/', '/a/**',
+                 '/a/b/']
+        self.assertEqual('/users/alice/', self.match(paths, '/users/alice/x'))
+        self.assertEqual('/users/*/private/',
+                         self.match(paths, '/users/alice/private/x'))
+        self.assertEqual('/users/', self.match(paths, '/users/'))
+        self.assertEqual('/a/b/', self.match(paths, '/a/b/c/d'))
+        self.assertEqual('/a/**', self.match(paths, '/a/c/d'))
+
+    def test_literal_segment_wins_over_wildcard(self):
+        paths = ['/**/x/', '/*/x/', '/a/x/', '/*/*/', '/a/*/']
+        self.assertEqual('/a/x/', self.match(paths, '/a/x/y'))
+        self.assertEqual('/*/x/', self.match(paths, '/b/x/y'))
+        self.assertEqual('/a/*/', self.match(paths, '/a/y/z'))
+        self.assertEqual('/*/*/', self.match(paths, '/b/y/z'))
+        # More segments win over literal ones.
+        self.assertEqual('/*/*/', self.match(paths, '/b/c/x/y'))
+        self.assertEqual('/**/x/', self.match(paths[:3], '/b/c/x/y'))
+
+    def test_trailing_slash_wins(self):
+        paths = ['/*/x', '/*/x/']
+        self.assertEqual('/*/x/', self.match(paths, '/a/x/y'))
+        self.assertEqual('/*/x', self.match(paths, '/a/x'))
+
+    def test_precedence_does_not_depend_on_order(self):
+        paths = ['/', '/**/x/', '/*/x/', '/a/x/', '/*/*/', '/a/*/', '/a/**',
+                 '/a', '/*/x']
+        requests = ['/a/x/y', '/b/x/y', '/a/y/z', '/b/c/x/y', '/a', '/b/x',
+                    '/c']
+        expected = [self.match(paths, request) for request in requests]
+        for permutation in itertools.permutations(paths[1:5]):
+            reordered = list(permutation) + paths[5:] + paths[:1]
+            self.assertEqual(
+                expected,
+                [self.match(reordered, request) for request in requests])
+
+    def test_many_globstars_do_not_make_matching_exponential(self):
+        paths = ['/**/**/**/**/x', '/**/*/**/*/**/y/']
+        long_path = '/' + '/'.join('a' for _ in xrange(150))
+        start = time.time()
+        self.assertIsNone(self.match(paths, long_path))
+        self.assertEqual(paths[0], self.match(paths, long_path + '/x'))
+        self.assertEqual(paths[1], self.match(paths, long_path + '/y/z'))
+        self.assertLess(time.time() - start, 1)
+
+    def test_no_locations(self):
+        self.assertIsNone(self.match([], '/'))
@@ -0,0 +1,72 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.test import TestCase
+from django.test import override_settings
+from django.test.client import RequestFactory
+from mock import patch
+from wwwhisper_auth import http
+from wwwhisper_auth.views import WhoAmI
+from wwwhisper_service.profile import ENABLE_FILE
+from wwwhisper_service.profile import ProfileMiddleware
+
+import os
+import pstats
+import shutil
+import tempfile
+
+class ProfileMiddlewareTest(TestCase):
+    def setUp(self):
+        self.profile_dir = tempfile.mkdtemp()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        shutil.rmtree(self.profile_dir)
+
+    def middleware(self, **kwargs):
+        with override_settings(WWWHISPER_PROFILE_DIR=self.profile_dir,
+                               **kwargs):
+            return ProfileMiddleware()
+
+    def handle(self, middleware):
+        request = self.factory.get('/wwwhisper/auth/api/whoami/')
+        middleware.process_request(request)
+        middleware.process_view(request, WhoAmI.as_view(), (), {})
+        return middleware.process_response(
+            request, http.HttpResponseNoContent())
+
+    def test_not_used_without_profile_dir(self):
+        with override_settings(WWWHISPER_PROFILE_DIR=None):
+            self.assertRaises(MiddlewareNotUsed, ProfileMiddleware)
+
+    def test_disabled_by_default(self):
+        middleware = self.middleware()
+        self.handle(middleware)
+        middleware.dump()
+        self.assertEqual([], os.listdir(self.profile_dir))
+
+    def test_sampled_requests_profiled_per_endpoint(self):
+        middleware = self.middleware(WWWHISPER_PROFILE_ENABLED=True,
+                                     WWWHISPER_PROFILE_SAMPLE_RATE=1)
+        self.handle(middleware)
+        self.handle(middleware)
+        middleware.dump()
+        expected_file = 'WhoAmI.%d.prof' % os.getpid()
+        self.assertEqual([expected_file], os.listdir(self.profile_dir))
+        stats = pstats.Stats(os.path.join(self.profile_dir, expected_file))
+        self.assertTrue(stats.total_calls > 0)
+
+    def test_toggled_with_enable_file(self):
+        middleware = self.middleware(WWWHISPER_PROFILE_SAMPLE_RATE=1)
+        enable_path = os.path.join(self.profile_dir, ENABLE_FILE)
+        open(enable_path, 'w').close()
+        self.handle(middleware)
+        self.assertTrue(middleware.enabled)
+        self.handle(middleware)
+        os.remove(enable_path)
+        with patch('wwwhisper_service.profile.ENABLE_FILE_CHECK_INTERVAL', 0):
+            self.handle(middleware)
+        self.assertFalse(middleware.enabled)
+        # Disabling dumps collected stats.
+        self.assertEqual(1, len(os.listdir(self.profile_dir)))
@@ -0,0 +1,227 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Budgets of DB queries executed by performance critical paths.
+
+A change that adds a query to any of these paths must update the
+budget explicitly. When a budget is exceeded, the failure lists each
+executed query with the wwwhisper frames of the stack that issued it.
+"""
+
+from django.db.backends.utils import CursorWrapper
+from django.test import override_settings
+from django.test.client import Client
+from mock import patch
+from wwwhisper_auth import acl_io
+from wwwhisper_auth.login_token import generate_login_token
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.models import SINGLE_SITE_ID
+from wwwhisper_auth.tests.tests_views import AuthTestCase
+from wwwhisper_auth.tests.utils import TEST_SITE
+
+import json
+import os
+import traceback
+
+# Only frames of these directories are included in failure messages.
+_SOURCE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(
+            os.path.abspath(__file__))))
+
+class _QueryBudget(object):
+    """Fails a test if a block does not execute the expected number of queries.
+
+    Unlike assertNumQueries, reports the stack of each query.
+    """
+
+    def __init__(self, test, expected):
+        self._test = test
+        self._expected = expected
+        self.queries = []
+
+    def __enter__(self):
+        self._patchers = [
+            patch.object(CursorWrapper, name,
+                         self._recording(getattr(CursorWrapper, name)))
+            for name in ('execute', 'executemany')]
+        for patcher in self._patchers:
+            patcher.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, tb):
+        for patcher in self._patchers:
+            patcher.stop()
+        if exc_type is not None or len(self.queries) == self._expected:
+            return False
+        self._test.fail('%d queries executed, budget is %d:\n\n%s' % (
+                len(self.queries), self._expected,
+                '\n\n'.join('%d. %s\n%s' % (i + 1, sql, ''.join(stack))
+                            for i, (sql, stack)
+                            in enumerate(self.queries))))
+
+    def _recording(self, method):
+        queries = self.queries
+        def wrapper(cursor, sql, params=None):
+            stack = [frame for frame in traceback.extract_stack()[:-1]
+                     if frame[0].startswith(_SOURCE_DIR) and
+                     not frame[0].startswith(os.path.dirname(__file__))]
+            queries.append((sql, traceback.format_list(stack)))
+            return method(cursor, sql, params)
+        return wrapper
+
+class QueryBudgetTestCase(AuthTestCase):
+    def assertQueries(self, expected):
+        return _QueryBudget(self, expected)
+
+    def add_users(self, count, path=None):
+        """Adds users with acl_io, optionally grants them access to path."""
+        records = [{'type': 'user', 'email': 'user%d@example.org' % i}
+                   for i in xrange(count)]
+        if path is not None:
+            records.append({'type': 'location', 'path': path, 'open': False})
+            records.extend({'type': 'grant', 'path': path,
+                            'email': record['email']}
+                           for record in records[:count])
+        acl_io.Importer(self.site).import_records(
+            lambda: enumerate(records, 1))
+
+    def is_authorized(self, path):
+        return self.get('/wwwhisper/auth/api/is-authorized/?path=' + path)
+
+class HotPathsTest(QueryBudgetTestCase):
+    def setUp(self):
+        super(HotPathsTest, self).setUp()
+        self.add_users(100, path='/foo/')
+        self.site.users.create_item('alice@example.org')
+        # Warms up the cache of the client request handler.
+        self.assertEqual(401, self.is_authorized('/foo/').status_code)
+
+    def test_auth_warm_cache(self):
+        # Checks if the cached site is up to date.
+        with self.assertQueries(1):
+            self.assertEqual(401, self.is_authorized('/foo/').status_code)
+        self.login('user7@example.org')
+        # Sessions are cached, users are in the cached site.
+        with self.assertQueries(1):
+            self.assertEqual(200, self.is_authorized('/foo/').status_code)
+        with self.assertQueries(1):
+            self.assertEqual(403, self.is_authorized('/bar/').status_code)
+
+    def test_auth_cold_cache(self):
+        self.login('user7@example.org')
+        self.client = Client()
+        self.login('user7@example.org')
+        # The site, groups, memberships (shared by the groups and
+        # the locations collections), locations, permissions, group
+        # permissions, domain permissions, permission expirations,
+        # users, user expirations and aliases.
+        with self.assertQueries(11):
+            self.assertEqual(200, self.is_authorized('/foo/').status_code)
+
+    def test_auth_after_modification(self):
+        self.login('user7@example.org')
+        self.is_authorized('/foo/')
+        SitesCollection().find_item(SINGLE_SITE_ID).locations.create_item(
+            '/bar/')
+        # Mod id and all the collections of the site.
+        with self.assertQueries(12):
+            self.assertEqual(403, self.is_authorized('/bar/').status_code)
+        with self.assertQueries(1):
+            self.assertEqual(403, self.is_authorized('/bar/').status_code)
+
+    def test_auth_of_domain_user(self):
+        self.site.locations.find_location('/foo/').grant_domain_access(
+            'example.com')
+        token = generate_login_token(self.site, TEST_SITE, 'bob@example.com')
+        self.get('/wwwhisper/auth/api/login/?token=' + token)
+        # Mod id and the user, which is not cached with other users.
+        with self.assertQueries(2):
+            self.assertEqual(200, self.is_authorized('/foo/').status_code)
+        # The user is retrieved once per cache reload.
+        with self.assertQueries(1):
+            self.assertEqual(200, self.is_authorized('/foo/').status_code)
+
+    def test_whoami(self):
+        with self.assertQueries(1):
+            self.assertEqual(
+                401, self.get('/wwwhisper/auth/api/whoami/').status_code)
+        self.login('user7@example.org')
+        with self.assertQueries(1):
+            self.assertEqual(
+                200, self.get('/wwwhisper/auth/api/whoami/').status_code)
+
+    def test_site_url_rejected_without_user_queries(self):
+        with self.assertQueries(1):
+            response = self.client.get(
+                '/wwwhisper/auth/api/is-authorized/?path=/foo/',
+                HTTP_SITE_URL='https://other.example.org')
+        self.assertEqual(400, response.status_code)
+
+    def test_login_and_logout(self):
+        token = generate_login_token(
+            self.site, TEST_SITE, 'user7@example.org')
+        # Mod id, user, session insert, last_login update, marking
+        # the site as modified (revoking, so the token can not be
+        # reused) and session update, with savepoints.
+        with self.assertQueries(20):
+            response = self.get('/wwwhisper/auth/api/login/?token=' + token)
+        self.assertEqual(302, response.status_code)
+        # Collections are reloaded lazily, only these needed by the
+        # request are loaded.
+        with self.assertQueries(10):
+            self.assertEqual(200, self.is_authorized('/foo/').status_code)
+        # Mod id, user (by Django auth), session select and delete.
+        with self.assertQueries(4):
+            self.assertEqual(
+                204, self.post('/wwwhisper/auth/api/logout/', {}).status_code)
+
+# Access counters are enabled, so reads of their totals are counted.
+@override_settings(WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL=1)
+class AdminTest(QueryBudgetTestCase):
+    """Admin requests execute the same number of queries for any site size."""
+
+    def setUp(self):
+        super(AdminTest, self).setUp()
+        # Like in any site with a history, revoking modifications
+        # update an existing SiteRevocation row.
+        self.site.site_modified(revoking=True)
+
+    def test_list_users(self):
+        for count in (10, 100):
+            self.add_users(count)
+            self.assertEqual(401, self.is_authorized('/').status_code)
+            with self.assertQueries(2):
+                response = self.get('/wwwhisper/admin/api/users/')
+            self.assertEqual(
+                count, len(json.loads(response.content)['users']))
+
+    def test_list_locations(self):
+        for count in (10, 100):
+            self.add_users(count, path='/foo%d/' % count)
+            self.assertEqual(401, self.is_authorized('/').status_code)
+            with self.assertQueries(2):
+                response = self.get('/wwwhisper/admin/api/locations/')
+            self.assertIn(count, [
+                    len(location['allowedUsers']) for location
+                    in json.loads(response.content)['locations']])
+
+    def test_delete_location_with_many_grants(self):
+        for count in (10, 100):
+            path = '/foo%d/' % count
+            self.add_users(count, path=path)
+            location = self.site.locations.find_location(path)
+            self.assertEqual(401, self.is_authorized('/').status_code)
+            # Permissions of the location are deleted with a single
+            # query, not one per permission.
+            with self.assertQueries(16):
+                response = self.delete(
+                    '/wwwhisper/admin/api/locations/%s/' % location.uuid)
+            self.assertEqual(204, response.status_code)
+
+    def test_bulk_import(self):
+        # Existing records (and domain users, which become regular
+        # users if imported) are read once, for both validation and
+        # writes. Users, the location and grants are each written with
+        # an insert and a select of ids of a whole chunk of records.
+        for count in (10, 100):
+            with self.assertQueries(19):
+                self.add_users(count, path='/foo%d/' % count)
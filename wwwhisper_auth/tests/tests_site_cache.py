@@ -1,10 +1,25 @@
 # wwwhisper - web access control.
 # Copyright (C) 2013 Jan Wrobel <jan@mixedbit.org>
 
+from django.core.exceptions import ImproperlyConfigured
+from django.db import DatabaseError
+from django.db import connection
 from django.test import TestCase
+from django.test import TransactionTestCase
 from mock import Mock
+from mock import patch
+from wwwhisper_auth.models import LocationsCollection
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.site_cache import CacheUpdater
 from wwwhisper_auth.site_cache import CachingSitesCollection
 from wwwhisper_auth.site_cache import SiteCache
+from wwwhisper_auth.site_cache import WarmUp
+
+import os
+import shutil
+import tempfile
+import threading
+import time
 
 TEST_SITE = 'https://example.com'
 
@@ -65,3 +80,216 @@ class CachingSitesCollectionTest(TestCase):
         site = self.sites.create_item(TEST_SITE)
         self.assertTrue(self.sites.delete_item(TEST_SITE))
         self.assertIsNone(self.sites.find_item(TEST_SITE))
+
+class RefresherTest(TestCase):
+
+    def setUp(self):
+        self.cache = SiteCache(CacheUpdater(), refresh_interval=3600)
+        self.sites = CachingSitesCollection(self.cache)
+
+    def test_get_does_not_check_site(self):
+        site = self.sites.create_item(TEST_SITE)
+        with self.assertNumQueries(0):
+            self.assertTrue(site is self.sites.find_item(TEST_SITE))
+        self.assertEqual(os.getpid(), self.cache._refresher._pid)
+
+    def test_modified_site_replaced(self):
+        site = self.sites.create_item(TEST_SITE)
+        # Modification by an external process.
+        other_process_site = SitesCollection().find_item(TEST_SITE)
+        other_process_site.locations.create_item('/foo/')
+
+        self.assertTrue(site is self.sites.find_item(TEST_SITE))
+        self.assertEqual(1, self.cache._refresher.refresh())
+        fresh_site = self.sites.find_item(TEST_SITE)
+        self.assertTrue(site is not fresh_site)
+        self.assertEqual(other_process_site.mod_id, fresh_site.mod_id)
+        with self.assertNumQueries(0):
+            self.assertIsNotNone(fresh_site.locations.find_location('/foo/'))
+        self.assertEqual(0, self.cache._refresher.refresh())
+
+    def test_deleted_site_removed(self):
+        self.sites.create_item(TEST_SITE)
+        SitesCollection().delete_item(TEST_SITE)
+        self.assertEqual(1, self.cache._refresher.refresh())
+        self.assertEqual([], self.cache.items())
+
+class StaleWhileRevalidateTest(TransactionTestCase):
+
+    def setUp(self):
+        SitesCollection().create_item(TEST_SITE)
+        self.cache = SiteCache(CacheUpdater(), stale_grace=60)
+        self.sites = CachingSitesCollection(self.cache)
+        self.site = self.sites.find_item(TEST_SITE)
+        # Modifications by another process.
+        self.other_site = SitesCollection().find_item(TEST_SITE)
+
+    def wait_for_reload(self):
+        for _ in xrange(100):
+            if self.cache.peek(TEST_SITE) is not self.site:
+                return self.cache.peek(TEST_SITE)
+            time.sleep(0.05)
+        self.fail('Site not reloaded')
+
+    def test_stale_site_served_while_reloaded(self):
+        self.other_site.locations.create_item('/foo/')
+        self.assertTrue(self.site is self.sites.find_item(TEST_SITE))
+        fresh_site = self.wait_for_reload()
+        self.assertEqual(self.other_site.mod_id, fresh_site.mod_id)
+        self.assertIsNotNone(fresh_site.locations.find_location('/foo/'))
+
+    def test_revoking_change_not_served_stale(self):
+        user = self.other_site.users.create_item('foo@example.com')
+        self.site = self.sites.find_item(TEST_SITE)
+        self.wait_for_reload()
+        self.site = self.cache.peek(TEST_SITE)
+        self.assertIsNotNone(self.site.users.find_item(user.uuid))
+
+        self.other_site.users.delete_item(user.uuid)
+        site = self.sites.find_item(TEST_SITE)
+        self.assertTrue(site is not self.site)
+        self.assertEqual(self.other_site.mod_id, site.mod_id)
+        self.assertIsNone(site.users.find_item(user.uuid))
+
+    def test_not_served_stale_after_grace_period(self):
+        self.other_site.locations.create_item('/foo/')
+        self.cache._stale_since[TEST_SITE] = time.time() - 61
+        site = self.sites.find_item(TEST_SITE)
+        self.assertTrue(site is not self.site)
+        self.assertIsNotNone(site.locations.find_location('/foo/'))
+
+class WarmUpTest(TransactionTestCase):
+
+    def setUp(self):
+        self.site_ids = ['https://foo%d.example.com' % i for i in range(5)]
+        for site_id in self.site_ids:
+            CachingSitesCollection().create_item(site_id)
+        self.sites = CachingSitesCollection()
+        self.warm_up = WarmUp()
+
+    def tearDown(self):
+        # Stops retries of failed loads.
+        self.warm_up.run(self.sites, [])
+
+    def assert_all_cached(self, site_ids):
+        for site_id in site_ids:
+            self.assertIsNotNone(self.sites.site_cache.get(site_id))
+
+    def test_all_sites_loaded(self):
+        self.warm_up.run(self.sites, concurrency=3)
+        self.assertTrue(self.warm_up.is_ready())
+        self.assert_all_cached(self.site_ids)
+
+    def test_hot_set_loaded(self):
+        self.warm_up.run(self.sites, self.site_ids[:2], concurrency=3)
+        self.assert_all_cached(self.site_ids[:2])
+        self.assertIsNone(self.sites.site_cache.get(self.site_ids[2]))
+
+    def test_background_warm_up(self):
+        self.warm_up.run(self.sites, concurrency=2, block=False)
+        self.assertTrue(self.warm_up.wait(10))
+        self.assertTrue(self.warm_up.is_ready())
+        self.assert_all_cached(self.site_ids)
+
+    def test_not_ready_if_failed(self):
+        self.sites.find_item = Mock(side_effect=DatabaseError('db down'))
+        self.warm_up.run(self.sites, concurrency=2)
+        self.assertFalse(self.warm_up.is_ready())
+        self.assertEqual('db down', self.warm_up.error)
+
+    def test_failed_loads_retried(self):
+        find_item = self.sites.find_item
+        failures = [DatabaseError('db down')] * 3
+        def flaky_find_item(site_id):
+            if failures:
+                raise failures.pop()
+            return find_item(site_id)
+        self.sites.find_item = flaky_find_item
+        with patch.object(WarmUp, 'RETRY_INITIAL_DELAY', 0.01):
+            self.warm_up.run(self.sites, concurrency=1)
+            self.assertFalse(self.warm_up.is_ready())
+            for _ in xrange(100):
+                if self.warm_up.is_ready():
+                    break
+                time.sleep(0.05)
+        self.assertTrue(self.warm_up.is_ready())
+        self.assertIsNone(self.warm_up.error)
+        self.assert_all_cached(self.site_ids)
+
+class SingleFlightTest(TransactionTestCase):
+
+    def setUp(self):
+        SitesCollection().create_item(TEST_SITE)
+
+    def run_threads(self, target, count=5):
+        start = threading.Event()
+        results = []
+        def run():
+            start.wait()
+            try:
+                results.append(target())
+            finally:
+                connection.close()
+        threads = [threading.Thread(target=run) for _ in xrange(count)]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+        return results
+
+    def slow(self, method, calls):
+        def wrapper(*args, **kwargs):
+            calls.append(1)
+            time.sleep(0.1)
+            return method(*args, **kwargs)
+        return wrapper
+
+    def test_site_loaded_once(self):
+        sites = CachingSitesCollection()
+        calls = []
+        with patch.object(SitesCollection, 'find_item',
+                          self.slow(SitesCollection.find_item, calls)):
+            results = self.run_threads(lambda: sites.find_item(TEST_SITE))
+        self.assertEqual(1, len(calls))
+        self.assertEqual(5, len(results))
+        self.assertTrue(all(site is results[0] for site in results))
+
+    def test_site_loaded_once_by_many_processes(self):
+        lock_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, lock_dir)
+        snapshot_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, snapshot_dir)
+        def find_in_new_process():
+            # Each process has own cache, only the file lock is shared.
+            sites = CachingSitesCollection(
+                SiteCache(CacheUpdater()), lock_dir=lock_dir,
+                snapshot_dir=snapshot_dir)
+            return sites.find_item(TEST_SITE)
+        calls = []
+        with patch.object(SitesCollection, 'find_item',
+                          self.slow(SitesCollection.find_item, calls)):
+            results = self.run_threads(find_in_new_process)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(1, len(os.listdir(lock_dir)))
+        self.assertEqual([TEST_SITE] * 5,
+                         [site.site_id for site in results])
+
+    def test_lock_dir_requires_snapshot_dir(self):
+        self.assertRaises(ImproperlyConfigured, CachingSitesCollection,
+                          lock_dir=tempfile.gettempdir())
+
+    def test_collection_reloaded_once(self):
+        site = SitesCollection().find_item(TEST_SITE)
+        # Modification by another thread, visible to this one.
+        other_site = SitesCollection().find_item(TEST_SITE)
+        other_site.locations.create_item('/foo/')
+        site.mod_id = other_site.mod_id
+        calls = []
+        with patch.object(
+            LocationsCollection, 'update_cache',
+            self.slow(LocationsCollection.update_cache, calls)):
+            results = self.run_threads(
+                lambda: [l.path for l in site.locations.all()])
+        self.assertEqual(1, len(calls))
+        self.assertEqual([['/foo/']] * 5, results)
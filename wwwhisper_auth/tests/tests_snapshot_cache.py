@@ -0,0 +1,119 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+from django.test import TestCase
+from wwwhisper_auth.models import SitesCollection
+from wwwhisper_auth.site_cache import CachingSitesCollection
+from wwwhisper_auth.site_cache import CacheUpdater
+from wwwhisper_auth.site_cache import SiteCache
+from wwwhisper_auth.snapshot_cache import SnapshotCache
+
+import os
+import shutil
+import tempfile
+
+TEST_SITE = 'https://example.com'
+
+class SnapshotCacheTest(TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.snapshots = SnapshotCache(self.dir)
+        self.site = SitesCollection().create_item(TEST_SITE)
+        self.site.update_skin(title='Foo', header='Bar', message='Baz',
+                              branding=False)
+        self.site.aliases.create_item('https://foo.example.org')
+        self.user = self.site.users.create_item('alice@example.org')
+        self.location = self.site.locations.create_item('/foo/')
+        self.location.grant_access(self.user.uuid)
+        self.site.locations.create_item('/bar/').grant_open_access()
+        self.group = self.site.groups.create_item('staff')
+        self.group.add_member(self.user.uuid)
+        self.site.locations.create_item('/baz/').grant_group_access(
+            self.group.uuid)
+        self.site.locations.create_item('/qux/').grant_domain_access(
+            'example.org')
+        # Refresh caches of the collections.
+        self.site = SitesCollection().find_item(TEST_SITE)
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_site_recreated_from_disk(self):
+        self.assertTrue(self.snapshots.store(self.site))
+        with self.assertNumQueries(1):
+            site = self.snapshots.load(TEST_SITE)
+            self.assertEqual(self.site.mod_id, site.mod_id)
+            self.assertEqual(self.site.skin(), site.skin())
+            self.assertEqual(['https://foo.example.org'],
+                             [alias.url for alias in site.aliases.all()])
+            user = site.users.find_item(self.user.uuid)
+            self.assertEqual('alice@example.org', user.email)
+            self.assertEqual(self.user.last_login, user.last_login)
+            location = site.locations.find_location('/foo/bar')
+            self.assertEqual(self.location.uuid, location.uuid)
+            self.assertTrue(location.can_access(user))
+            self.assertTrue(
+                site.locations.find_location('/bar/').open_access_granted())
+            self.assertTrue(
+                site.locations.find_location('/baz/').can_access(user))
+            self.assertEqual([user], site.groups.find_item(
+                    self.group.uuid).members())
+            self.assertTrue(
+                site.locations.find_location('/qux/').can_access(user))
+            self.assertTrue(site.users.find_item_by_email(
+                    'Alice@example.org') is user)
+
+    def test_recreated_site_can_be_modified(self):
+        self.snapshots.store(self.site)
+        site = self.snapshots.load(TEST_SITE)
+        site.locations.find_item(self.location.uuid).revoke_access(
+            self.user.uuid)
+        site = SitesCollection().find_item(TEST_SITE)
+        self.assertFalse(site.locations.find_item(
+                self.location.uuid).can_access(self.user))
+
+    def test_modified_site_not_loaded(self):
+        self.snapshots.store(self.site)
+        self.site.users.create_item('bob@example.org')
+        self.assertIsNone(self.snapshots.load(TEST_SITE))
+
+    def test_deleted_site_not_loaded(self):
+        self.snapshots.store(self.site)
+        SitesCollection().delete_item(TEST_SITE)
+        self.assertIsNone(self.snapshots.load(TEST_SITE))
+
+    def test_site_with_obsolete_collection_not_stored(self):
+        self.site.users.create_item('bob@example.org')
+        self.assertFalse(self.snapshots.store(self.site))
+        self.assertEqual([], os.listdir(self.dir))
+
+    def test_old_snapshots_removed(self):
+        self.snapshots.store(self.site)
+        self.site.users.create_item('bob@example.org')
+        self.site.users.all()
+        self.site.locations.all()
+        self.site.aliases.all()
+        self.site.groups.all()
+        self.assertTrue(self.snapshots.store(self.site))
+        self.assertEqual(1, len(os.listdir(self.dir)))
+        site = self.snapshots.load(TEST_SITE)
+        self.assertIsNotNone(site.users.find_item_by_email('bob@example.org'))
+
+    def test_corrupted_snapshot_ignored(self):
+        self.snapshots.store(self.site)
+        [file_name] = os.listdir(self.dir)
+        with open(os.path.join(self.dir, file_name), 'w') as out:
+            out.write('{"format": 1')
+        self.assertIsNone(self.snapshots.load(TEST_SITE))
+
+    def test_caching_sites_collection_uses_snapshots(self):
+        sites = CachingSitesCollection(
+            SiteCache(CacheUpdater()), snapshot_dir=self.dir)
+        site = sites.find_item(TEST_SITE)
+        self.assertEqual(1, len(os.listdir(self.dir)))
+        # A new process, with an empty cache.
+        sites = CachingSitesCollection(
+            SiteCache(CacheUpdater()), snapshot_dir=self.dir)
+        with self.assertNumQueries(1):
+            site2 = sites.find_item(TEST_SITE)
+        self.assertEqual(site.mod_id, site2.mod_id)
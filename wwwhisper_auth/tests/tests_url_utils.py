@@ -2,6 +2,8 @@
 # Copyright (C) 2012 Jan Wrobel <jan@mixedbit.org>
 
 from django.test import TestCase
+from wwwhisper_auth import url_utils
+from wwwhisper_auth.url_utils import canonicalize_auth_path
 from wwwhisper_auth.url_utils import collapse_slashes
 from wwwhisper_auth.url_utils import contains_fragment
 from wwwhisper_auth.url_utils import contains_params
@@ -13,6 +15,8 @@ from wwwhisper_auth.url_utils import validate_site_url
 from wwwhisper_auth.url_utils import remove_default_port
 from wwwhisper_auth.url_utils import strip_query
 
+import random
+
 class PathTest(TestCase):
 
     def test_is_canonical(self):
@@ -135,3 +139,58 @@ class SiteUrlTest(TestCase):
                          remove_default_port('http://example.com:80'))
         self.assertEqual('https://example.com:80',
                          remove_default_port('https://example.com:80'))
+
+def reference_canonicalize_auth_path(encoded_path):
+    """Validation done by the auth view before canonicalize_auth_path."""
+    if contains_fragment(encoded_path):
+        return (None, url_utils.FRAGMENT_ERROR)
+    decoded_path = collapse_slashes(decode(strip_query(encoded_path)))
+    if not is_canonical(decoded_path):
+        return (None, url_utils.NOT_CANONICAL_ERROR)
+    return (decoded_path, None)
+
+class CanonicalizeAuthPathTest(TestCase):
+
+    def assert_same_as_reference(self, encoded_path):
+        self.assertEqual(reference_canonicalize_auth_path(encoded_path),
+                         url_utils._canonicalize_auth_path(encoded_path),
+                         repr(encoded_path))
+
+    def test_canonicalize_auth_path(self):
+        self.assertEqual(('/foo/bar/', None),
+                         canonicalize_auth_path('/foo//bar/?a=b'))
+        self.assertEqual(('/foo bar /', None),
+                         canonicalize_auth_path('/foo%20bar+/'))
+        self.assertEqual(('/a/#', None), canonicalize_auth_path('/a/%23'))
+        self.assertEqual((None, url_utils.FRAGMENT_ERROR),
+                         canonicalize_auth_path('/foo#bar'))
+        for path in ['', 'foo', '/foo/..', '/./foo', '/%2e%2E/', '/foo/.?a']:
+            self.assertEqual((None, url_utils.NOT_CANONICAL_ERROR),
+                             canonicalize_auth_path(path), path)
+
+    def test_results_cached(self):
+        path = '/cached/path'
+        self.assertEqual((path, None), canonicalize_auth_path(path))
+        self.assertIs(canonicalize_auth_path(path),
+                      canonicalize_auth_path(path))
+
+    def test_lru_cache_evicts_least_recently_used(self):
+        cache = url_utils._LruCache(2)
+        cache.put('a', 1)
+        cache.put('b', 2)
+        cache.get('a')
+        cache.put('c', 3)
+        self.assertEqual(1, cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertEqual(3, cache.get('c'))
+
+    def test_same_results_as_reference_for_random_paths(self):
+        tokens = ['/', '/', '/', '.', '..', 'a', 'b.', '%', '%2f', '%2F',
+                  '%2e', '%2E', '%23', '%3f', '%', '%4', '%zz', '+', '?',
+                  '#', ';', ' ', '\n', '\xe9', '%e9', '//']
+        generator = random.Random(0)
+        for _ in xrange(20000):
+            path = ''.join(generator.choice(tokens)
+                           for _ in xrange(generator.randint(0, 12)))
+            self.assert_same_as_reference(path)
+            self.assert_same_as_reference(unicode(path, 'latin-1'))
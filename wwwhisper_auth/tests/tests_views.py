@@ -10,6 +10,8 @@ from django.core import mail
 from django.test import override_settings
 
 from wwwhisper_auth.login_token import generate_login_token
+from wwwhisper_auth.models import DomainUser
+from wwwhisper_auth.models import Site
 from wwwhisper_auth.tests.utils import HttpTestCase
 from wwwhisper_auth.tests.utils import TEST_SITE
 
@@ -199,6 +201,45 @@ class AuthTest(AuthTestCase):
         self.assertEqual(403, response.status_code)
         self.assertRegexpMatches(response['Content-Type'], 'text/plain')
 
+class AuthCacheHintsTest(AuthTestCase):
+    def test_no_hints_by_default(self):
+        self.site.locations.create_item('/foo/').grant_open_access()
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.assertEqual(200, response.status_code)
+        self.assertFalse(response.has_header('X-Accel-Expires'))
+        self.assertFalse(response.has_header('X-Wwwhisper-Version'))
+
+    @override_settings(WWWHISPER_AUTH_CACHE_TTL=5)
+    def test_decisions_cacheable(self):
+        self.site.locations.create_item('/foo/').grant_open_access()
+        self.site.locations.create_item('/bar/')
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('5', response['X-Accel-Expires'])
+        version = response['X-Wwwhisper-Version']
+        self.assertEqual(str(self.site.get_mod_id_ts()), version)
+        # Browsers still must not cache the response.
+        self.assertRegexpMatches(response['Cache-Control'], 'no-store')
+
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/bar/')
+        self.assertEqual(401, response.status_code)
+        self.assertEqual('5', response['X-Accel-Expires'])
+        self.assertEqual(version, response['X-Wwwhisper-Version'])
+
+        self.site.users.create_item('foo@example.com')
+        self.login('foo@example.com')
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/bar/')
+        self.assertEqual(403, response.status_code)
+        self.assertEqual('5', response['X-Accel-Expires'])
+        # Creating a user changed the site.
+        self.assertNotEqual(version, response['X-Wwwhisper-Version'])
+
+    @override_settings(WWWHISPER_AUTH_CACHE_TTL=5)
+    def test_bad_request_not_cacheable(self):
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/./')
+        self.assertEqual(400, response.status_code)
+        self.assertFalse(response.has_header('X-Accel-Expires'))
+
 class LogoutTest(AuthTestCase):
     def test_authentication_requested_after_logout(self):
         user = self.site.users.create_item('foo@example.com')
@@ -275,6 +316,20 @@ class SendTokenTest(AuthTestCase):
         self.assertEqual(204, response.status_code)
         self.assertEqual(0, len(mail.outbox))
 
+    def test_email_sent_if_domain_granted(self):
+        self.site.locations.create_item('/foo/').grant_domain_access(
+            'example.org')
+        response = self.post('/wwwhisper/auth/api/send-token/',
+                             {'email': 'Alice@example.org', 'path': '/foo/'})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual(1, len(mail.outbox))
+        response = self.post('/wwwhisper/auth/api/send-token/',
+                             {'email': 'alice@example.com', 'path': '/foo/'})
+        self.assertEqual(204, response.status_code)
+        self.assertEqual(1, len(mail.outbox))
+        # The user is created only after the login.
+        self.assertEqual(0, self.site.users.count())
+
     def test_email_address_is_none(self):
         response = self.post('/wwwhisper/auth/api/send-token/',
                              {'email': None, 'path': '/'})
@@ -361,6 +416,42 @@ class LoginTest(AuthTestCase):
         self.assertRegexpMatches(response['Content-Type'], 'text/html')
         self.assertRegexpMatches(response.content, '<body')
 
+    def test_login_creates_user_if_domain_granted(self):
+        location = self.site.locations.create_item('/foo/')
+        location.grant_domain_access('example.org')
+        mod_id = self.site.mod_id_from_db()
+        token = generate_login_token(self.site, TEST_SITE, 'foo@example.org')
+        response = self.get('/wwwhisper/auth/api/login/?token=' + token)
+        self.assertEqual(302, response.status_code)
+        # The user is not cached with other users, so creating it
+        # and logging it in does not modify the site.
+        self.assertEqual(mod_id, self.site.mod_id_from_db())
+        site = self.sites.find_item(self.site.site_id)
+        self.assertIsNotNone(site.users.find_item_by_email('foo@example.org'))
+        self.assertEqual([], site.users.all())
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('foo@example.org', response['User'])
+        response = self.get('/wwwhisper/auth/api/whoami/')
+        self.assertEqual('foo@example.org',
+                         json.loads(response.content)['email'])
+        # The token can be used only once.
+        response = self.get('/wwwhisper/auth/api/login/?token=' + token)
+        self.assertEqual(400, response.status_code)
+        self.assertEqual(1, DomainUser.objects.count())
+
+    def test_login_fails_if_domain_granted_and_users_limit_exceeded(self):
+        self.site.locations.create_item('/foo/').grant_domain_access(
+            'example.org')
+        token = generate_login_token(self.site, TEST_SITE, 'foo@example.org')
+        Site.users_limit = 0
+        try:
+            response = self.get('/wwwhisper/auth/api/login/?token=' + token)
+        finally:
+            Site.users_limit = None
+        self.assertEqual(400, response.status_code)
+        self.assertEqual('Users limit exceeded.', response.content)
+
     def test_tricky_redirection_replaced(self):
         # 'next' argument is not signed, so can be replaced by the
         # user. This is OK as long as all tricky paths are replaced.
@@ -394,3 +485,39 @@ class SessionCacheTest(AuthTestCase):
         user_id = s['user_id']
         self.assertIsNotNone(user_id)
         self.assertEqual(user_id, user.id)
+
+class AuthNodeTest(AuthTestCase):
+    def setUp(self):
+        from wwwhisper_service import auth_node_settings
+        super(AuthNodeTest, self).setUp()
+        self.node_settings = override_settings(
+            MIDDLEWARE_CLASSES=auth_node_settings.MIDDLEWARE_CLASSES,
+            ROOT_URLCONF=auth_node_settings.ROOT_URLCONF,
+            TEMPLATES=auth_node_settings.TEMPLATES)
+        self.node_settings.enable()
+
+    def tearDown(self):
+        self.node_settings.disable()
+        super(AuthNodeTest, self).tearDown()
+
+    def test_login_and_is_authorized(self):
+        location = self.site.locations.create_item('/foo/')
+        location.grant_access(
+            self.site.users.create_item('foo@example.org').uuid)
+        token = generate_login_token(self.site, TEST_SITE, 'foo@example.org')
+        response = self.get('/wwwhisper/auth/api/login/?token=' + token)
+        self.assertEqual(302, response.status_code)
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/')
+        self.assertEqual(200, response.status_code)
+        self.assertEqual('foo@example.org', response['User'])
+
+    def test_login_page_rendered(self):
+        self.site.locations.create_item('/foo/')
+        response = self.get('/wwwhisper/auth/api/is-authorized/?path=/foo/',
+                            HTTP_ACCEPT='text/html')
+        self.assertEqual(401, response.status_code)
+        self.assertRegexpMatches(response.content, '<body')
+
+    def test_admin_api_not_served(self):
+        response = self.get('/wwwhisper/admin/api/users/')
+        self.assertEqual(404, response.status_code)
@@ -3,9 +3,11 @@
 
 """Functions that operate on an HTTP resource path."""
 
+import itertools
 import posixpath
 import urllib
 import re
+import threading
 import urlparse
 
 def strip_query(path):
@@ -39,6 +41,94 @@ def is_canonical(path):
         return False
     return True
 
+FRAGMENT_ERROR = "Path should not include fragment ('#')"
+NOT_CANONICAL_ERROR = ('Path should be absolute and normalized '
+                       '(starting with / without /../ or /./ or //).')
+
+_SLASHES_RE = re.compile('//+')
+_DOT_SEGMENT_RE = re.compile(r'/\.\.?(?:/|\Z)')
+
+def _canonicalize_auth_path(encoded_path):
+    if '#' in encoded_path:
+        return (None, FRAGMENT_ERROR)
+    path = encoded_path
+    query_start = path.find('?')
+    if query_start != -1:
+        path = path[:query_start]
+    # Each step below is skipped when the path has nothing to
+    # transform, which is the case for most paths.
+    if '%' in path or '+' in path:
+        path = urllib.unquote_plus(path)
+    if '//' in path:
+        path = _SLASHES_RE.sub('/', path)
+    # With slashes collapsed, a path is canonical if it is absolute
+    # and has no '.' or '..' segments (see is_canonical).
+    if not path.startswith('/') or _DOT_SEGMENT_RE.search(path):
+        return (None, NOT_CANONICAL_ERROR)
+    return (path, None)
+
+class _LruCache(object):
+    """Thread safe cache that keeps at most max_size recently used items.
+
+    When the cache is full, the least recently used half of items is
+    evicted at once. This way a hit only records the time of use and
+    does not need to take a lock or reorder items.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        # Maps a key to [value, last use time].
+        self._items = {}
+        # Calls to next() of itertools.count are atomic.
+        self._clock = itertools.count()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        entry = self._items.get(key)
+        if entry is None:
+            return None
+        entry[1] = next(self._clock)
+        return entry[0]
+
+    def put(self, key, value):
+        if len(self._items) >= self._max_size:
+            with self._lock:
+                if len(self._items) >= self._max_size:
+                    self._evict()
+        self._items[key] = [value, next(self._clock)]
+
+    def _evict(self):
+        by_last_use = sorted(self._items.items(),
+                             key=lambda (key, entry): entry[1])
+        for (key, _) in by_last_use[:(len(by_last_use) + 1) // 2]:
+            self._items.pop(key, None)
+
+# Raw paths of auth requests repeat a lot (the same pages and
+# assets are requested over and over). Long paths are not cached to
+# bound memory used by the cache.
+CANONICAL_PATHS_CACHE_SIZE = 4096
+CACHED_PATH_LEN_LIMIT = 1024
+_canonical_paths = _LruCache(CANONICAL_PATHS_CACHE_SIZE)
+
+def canonicalize_auth_path(encoded_path):
+    """Validates and decodes a raw path of an auth request.
+
+    Returns the same result as rejecting a path with a fragment and
+    applying strip_query, decode, collapse_slashes and is_canonical,
+    but scans the path fewer times and skips steps that have nothing
+    to do. Results for recently seen paths are cached.
+
+    Returns:
+        (decoded canonical path, None) if the path is valid,
+        (None, error message) otherwise.
+    """
+    result = _canonical_paths.get(encoded_path)
+    if result is None:
+        result = _canonicalize_auth_path(encoded_path)
+        if len(encoded_path) <= CACHED_PATH_LEN_LIMIT:
+            _canonical_paths.put(encoded_path, result)
+    return result
+
 def contains_fragment(path):
     """True if path contains fragment id ('#' part)."""
     return path.count('#') != 0
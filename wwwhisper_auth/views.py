@@ -12,11 +12,14 @@ from django.template.loader import render_to_string
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import ensure_csrf_cookie
 from django.views.generic import View
+from wwwhisper_auth import access_counters
+from wwwhisper_auth import audit
 from wwwhisper_auth import http
 from wwwhisper_auth import login_token
 from wwwhisper_auth import models
 from wwwhisper_auth import url_utils
 from wwwhisper_auth.backend import AuthenticationError
+from functools import wraps
 
 import logging
 import urllib
@@ -30,9 +33,45 @@ def _get_user(request):
     """
     user_id = request.session.get('user_id', None)
     if user_id is not None:
-        return request.site.users.get_unique(lambda user: user.id == user_id)
+        return request.site.users.find_item_by_pk(user_id)
     return None
 
+def _auth_cache_hints(decorated_method):
+    """Allows the HTTP server to cache auth decisions for a short time.
+
+    Enabled with WWWHISPER_AUTH_CACHE_TTL (seconds). X-Accel-Expires
+    overrides cache disabling headers, but is used only by nginx and
+    is not passed to the client. X-Wwwhisper-Version is the site
+    modification id the decision was based on. Revoked access can
+    still be granted from the nginx cache until the TTL expires.
+    """
+    @wraps(decorated_method)
+    def wrapper(self, request, *args, **kwargs):
+        response = decorated_method(self, request, *args, **kwargs)
+        ttl = getattr(settings, 'WWWHISPER_AUTH_CACHE_TTL', None)
+        # 400 errors are not cached, these are rare and can be caused
+        # by a transient problem with a request.
+        if ttl and response.status_code in (200, 401, 403):
+            response['X-Accel-Expires'] = str(ttl)
+            response['X-Wwwhisper-Version'] = str(
+                request.site.get_mod_id_ts())
+        return response
+    return wrapper
+
+def _record_decision(request, user, location, response):
+    """Records a decision of an auth request.
+
+    The decision is added to the audit log, granted accesses of
+    authenticated users are counted.
+    """
+    site_id = request.site.site_id
+    user_id = user.id if user is not None else None
+    location_id = location.id if location is not None else None
+    audit.record(site_id, user_id, location_id, response.status_code)
+    if response.status_code == 200 and user_id is not None:
+        access_counters.hit(site_id, location_id, user_id)
+    return response
+
 def _html_or_none(request, template, context={}):
     """Renders html response string from a given template.
 
@@ -76,6 +115,7 @@ class Auth(View):
     """
 
     @http.never_ever_cache
+    @_auth_cache_hints
     def get(self, request):
         """Invoked by the HTTP server with a single path argument.
 
@@ -116,16 +156,8 @@ class Auth(View):
 
         debug_msg = "Auth request to '%s'" % (encoded_path)
 
-        path_validation_error = None
-        if url_utils.contains_fragment(encoded_path):
-            path_validation_error = "Path should not include fragment ('#')"
-        else:
-            stripped_path = url_utils.strip_query(encoded_path)
-            decoded_path = url_utils.decode(stripped_path)
-            decoded_path = url_utils.collapse_slashes(decoded_path)
-            if not url_utils.is_canonical(decoded_path):
-                path_validation_error = 'Path should be absolute and ' \
-                    'normalized (starting with / without /../ or /./ or //).'
+        (decoded_path, path_validation_error) = \
+            url_utils.canonicalize_auth_path(encoded_path)
         if path_validation_error is not None:
             logger.debug('%s: incorrect path.' % (debug_msg))
             return http.HttpResponseBadRequest(path_validation_error)
@@ -146,15 +178,17 @@ class Auth(View):
                     _html_or_none(request, 'not_authorized.html',
                                   {'email' : user.email}))
             response['User'] = user.email
-            return response
+            return _record_decision(request, user, location, response)
 
         if location is not None and location.open_access_granted():
             logger.debug('%s: authentication not required, access granted.'
                          % (debug_msg))
-            return http.HttpResponseOK('Access granted.')
+            return _record_decision(request, None, location,
+                                    http.HttpResponseOK('Access granted.'))
         logger.debug('%s: user not authenticated.' % (debug_msg))
-        return http.HttpResponseNotAuthenticated(
+        response = http.HttpResponseNotAuthenticated(
             _html_or_none(request, 'login.html', request.site.skin()))
+        return _record_decision(request, None, location, response)
 
     @staticmethod
     def _extract_encoded_path_argument(request):
@@ -199,7 +233,8 @@ class Login(View):
         """Logs a user in (establishes a session cookie).
 
         Verifies a token and check that a user with an email encoded
-        in the token is known.
+        in the token is known. A user with an email in a domain that
+        is granted access is created at the first login.
 
         On success redirects to path passed in the 'next' url
         argument.
@@ -261,7 +296,8 @@ class SendToken(http.RestView):
         if path is None or not url_utils.validate_redirection_target(path):
             path = '/'
 
-        if request.site.users.find_item_by_email(email) is None:
+        if (request.site.users.find_item_by_email(email) is None and
+            not request.site.locations.is_domain_granted(email)):
             # The email owner can not access the site. The token is
             # not sent, but the response is identical to the response
             # returned when the token is sent. This way it is not
@@ -0,0 +1,62 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Settings for an auth node: a process that serves only wwwhisper_auth.
+
+Most requests to wwwhisper are is-authorized checks issued by the
+frontend server for each request to a protected site. An auth node
+does not load the admin application, static files and messages
+framework, and runs only middlewares needed by the auth endpoints.
+The admin API needs to be served by a separate process that uses the
+full wwwhisper_service.settings (both processes share the DB).
+
+To use, set DJANGO_SETTINGS_MODULE (or WWWHISPER_SETTINGS_MODULE for
+run_wwwhisper_for_site.sh) to wwwhisper_service.auth_node_settings.
+"""
+
+from wwwhisper_service.settings import *
+
+MIDDLEWARE_CLASSES = [
+    'wwwhisper_auth.middleware.MetricsMiddleware',
+    'wwwhisper_service.profile.ProfileMiddleware',
+    SET_SITE_MIDDLEWARE,
+    'wwwhisper_auth.middleware.SiteUrlMiddleware',
+    # Must be placed before session middleware to alter session cookies.
+    'wwwhisper_auth.middleware.ProtectCookiesMiddleware',
+    'wwwhisper_auth.middleware.SecuringHeadersMiddleware',
+    # Auth views read the user directly from the session, so the
+    # AuthenticationMiddleware (that sets request.user) is not needed.
+    'django.contrib.sessions.middleware.SessionMiddleware',
+]
+
+ROOT_URLCONF = 'wwwhisper_service.auth_node_urls'
+
+# auth and contenttypes are needed by the wwwhisper_auth User model
+# and the authentication backend.
+INSTALLED_APPS = [
+    'django.contrib.auth',
+    'django.contrib.contenttypes',
+    'django.contrib.sessions',
+    'wwwhisper_auth',
+]
+
+# Templates are rendered only to produce error pages of the
+# is-authorized endpoint, without a request context. Each template is
+# compiled on first use and then kept in memory.
+TEMPLATES = [
+    {
+        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'DIRS': [
+            os.path.join(PROJECT_DIR, 'templates')
+        ],
+        'OPTIONS': {
+            'context_processors': [],
+            'loaders': [
+                ('django.template.loaders.cached.Loader', [
+                    'django.template.loaders.filesystem.Loader',
+                    'django.template.loaders.app_directories.Loader',
+                ]),
+            ],
+        },
+    },
+]
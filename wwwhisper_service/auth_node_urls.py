@@ -0,0 +1,44 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Urls served by an auth node (see auth_node_settings.py).
+
+Exposes only wwwhisper_auth endpoints and static files used during
+login and logout. The admin API is added to these by urls.py.
+"""
+
+from django.conf import settings
+from django.conf.urls import include, url
+from wwwhisper_auth.assets import Asset, HtmlFileView, JsFileView
+
+import logging
+
+logger = logging.getLogger(__name__)
+
+def _add_suffix(suffix):
+    return r'^%s%s' % (settings.WWWHISPER_PATH_PREFIX, suffix)
+
+def prefixed_url(path, *args):
+    """Like django url(), but prepends WWWHISPER_PATH_PREFIX to path."""
+    return url(_add_suffix(path), *args)
+
+urlpatterns = [
+    prefixed_url(r'auth/api/', include('wwwhisper_auth.urls')),
+]
+
+if settings.WWWHISPER_STATIC is not None:
+    logger.debug('wwwhisper configured to serve static files.')
+    overlay = Asset(settings.WWWHISPER_STATIC, 'auth', 'overlay.html')
+    iframe = Asset(settings.WWWHISPER_STATIC, 'auth', 'iframe.js')
+    logout = Asset(settings.WWWHISPER_STATIC, 'auth', 'logout.html')
+    goodbye = Asset(settings.WWWHISPER_STATIC, 'auth', 'goodbye.html')
+
+    urlpatterns += [
+        prefixed_url('auth/overlay.html$',
+                     HtmlFileView.as_view(asset=overlay)),
+        prefixed_url('auth/iframe.js$', JsFileView.as_view(asset=iframe)),
+        prefixed_url('auth/logout/$', HtmlFileView.as_view(asset=logout)),
+        prefixed_url('auth/logout.html$', HtmlFileView.as_view(asset=logout)),
+        prefixed_url('auth/goodbye.html$',
+                     HtmlFileView.as_view(asset=goodbye))
+    ]
@@ -0,0 +1,61 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Internal endpoints served before a request reaches Django.
+
+The endpoints are not bound to any site: they do not require the
+Site-Url header and bypass all Django middlewares. The nginx
+configuration does not pass /wwwhisper/metrics and /wwwhisper/ready
+to wwwhisper, so these endpoints are accessible only to clients that
+talk directly to the uWSGI socket (for example a monitoring agent or
+a load balancer health check on the same host).
+"""
+
+from django.conf import settings
+from wwwhisper_auth import metrics
+from wwwhisper_auth import site_cache
+
+TEXT_MIME_TYPE = 'text/plain; charset=utf-8'
+PROMETHEUS_MIME_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+def _path(suffix):
+    return '/' + settings.WWWHISPER_PATH_PREFIX + suffix
+
+def metrics_endpoint():
+    return ('200 OK', PROMETHEUS_MIME_TYPE, metrics.registry.export())
+
+def ready_endpoint():
+    """Reports if the process completed the cache warm-up."""
+    if site_cache.warm_up.is_ready():
+        return ('200 OK', TEXT_MIME_TYPE, 'Ready.')
+    error = site_cache.warm_up.error
+    return ('503 Service Unavailable', TEXT_MIME_TYPE,
+            'Warm-up failed, retrying: %s' % error if error is not None
+            else 'Warming up.')
+
+class InternalEndpoints(object):
+    """WSGI wrapper that handles internal paths, passes other requests on.
+
+    Attributes:
+       endpoints: Maps a path to a function that returns (status,
+          content type, body) tuple.
+    """
+
+    def __init__(self, application):
+        self.application = application
+        self.endpoints = {
+            _path('metrics'): metrics_endpoint,
+            _path('ready'): ready_endpoint,
+        }
+
+    def __call__(self, environ, start_response):
+        endpoint = self.endpoints.get(environ.get('PATH_INFO'))
+        if endpoint is None:
+            return self.application(environ, start_response)
+        status, content_type, body = endpoint()
+        start_response(status, [
+                ('Content-Type', content_type),
+                ('Content-Length', str(len(body))),
+                ('Cache-Control', 'no-cache, no-store, must-revalidate'),
+                ])
+        return [body]
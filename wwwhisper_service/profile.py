@@ -0,0 +1,126 @@
+# wwwhisper - web access control.
+# Copyright (C) 2012-2018 Jan Wrobel <jan@mixedbit.org>
+
+"""Sampling profiler middleware.
+
+Profiles a fraction (WWWHISPER_PROFILE_SAMPLE_RATE) of requests with
+cProfile and accumulates per-function cumulative times separately for
+each endpoint. Accumulated stats are periodically written to
+WWWHISPER_PROFILE_DIR as pstats files named ENDPOINT.PID.prof, these
+can be examined with 'python -m pstats FILE'.
+
+Profiling is enabled at startup with WWWHISPER_PROFILE_ENABLED, and
+can be enabled at runtime, without a restart, by creating an 'enabled'
+file in WWWHISPER_PROFILE_DIR (all processes notice the file within
+a second and dump their stats when it is removed). Signals are not
+used, because uWSGI workers handle SIGUSR2 themselves, and a handler
+that dumps stats could interrupt a request that holds the stats
+lock. The middleware is not used at all if WWWHISPER_PROFILE_DIR is
+not set.
+"""
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from wwwhisper_auth import metrics
+
+import cProfile
+import logging
+import os
+import pstats
+import random
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+# File in the profile dir that enables profiling when present.
+ENABLE_FILE = 'enabled'
+# How often (in seconds) a process checks if the file exists.
+ENABLE_FILE_CHECK_INTERVAL = 1
+
+class ProfileMiddleware(object):
+    """Profiles sampled requests, writes stats per endpoint.
+
+    Should go right after the MetricsMiddleware, so time spent in all
+    other middlewares is included in the profile.
+    """
+
+    def __init__(self):
+        self.profile_dir = getattr(settings, 'WWWHISPER_PROFILE_DIR', None)
+        if self.profile_dir is None:
+            raise MiddlewareNotUsed()
+        self.enabled_by_settings = getattr(
+            settings, 'WWWHISPER_PROFILE_ENABLED', False)
+        self.enabled = self.enabled_by_settings
+        self.sample_rate = getattr(
+            settings, 'WWWHISPER_PROFILE_SAMPLE_RATE', 0.01)
+        self.dump_interval = getattr(
+            settings, 'WWWHISPER_PROFILE_DUMP_INTERVAL', 60)
+        self._lock = threading.Lock()
+        self._stats = {}
+        self._last_dump = time.time()
+        self._last_enable_check = 0
+
+    def _check_enable_file(self):
+        """Enables or disables profiling if the enable file changed."""
+        now = time.time()
+        if now - self._last_enable_check < ENABLE_FILE_CHECK_INTERVAL:
+            return
+        self._last_enable_check = now
+        enabled = self.enabled_by_settings or os.path.exists(
+            os.path.join(self.profile_dir, ENABLE_FILE))
+        if enabled == self.enabled:
+            return
+        self.enabled = enabled
+        logger.info('Profiling %s.' % ('enabled' if enabled else 'disabled'))
+        if not enabled:
+            self.dump()
+
+    def process_request(self, request):
+        self._check_enable_file()
+        if not self.enabled or random.random() >= self.sample_rate:
+            return None
+        request.profiler = cProfile.Profile()
+        request.profile_endpoint = 'unresolved'
+        request.profiler.enable()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, 'profiler'):
+            request.profile_endpoint = metrics.view_label(view_func)
+        return None
+
+    def process_response(self, request, response):
+        profiler = getattr(request, 'profiler', None)
+        if profiler is None:
+            return response
+        profiler.disable()
+        del request.profiler
+        with self._lock:
+            stats = self._stats.get(request.profile_endpoint)
+            if stats is None:
+                self._stats[request.profile_endpoint] = pstats.Stats(profiler)
+            else:
+                stats.add(profiler)
+            dump_needed = time.time() - self._last_dump >= self.dump_interval
+        if dump_needed:
+            self.dump()
+        return response
+
+    def dump(self):
+        """Writes stats accumulated for each endpoint to the profile dir.
+
+        Files are overwritten with a complete set of stats collected
+        by the process so far.
+        """
+        with self._lock:
+            self._last_dump = time.time()
+            for endpoint, stats in self._stats.iteritems():
+                file_name = '%s.%d.prof' % (endpoint.replace(':', '-'),
+                                            os.getpid())
+                path = os.path.join(self.profile_dir, file_name)
+                try:
+                    stats.dump_stats(path)
+                except (IOError, OSError) as ex:
+                    logger.warning('Failed to write profile %s: %s'
+                                   % (path, ex))
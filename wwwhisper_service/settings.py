@@ -15,11 +15,86 @@ WWWHISPER_PATH_PREFIX = 'wwwhisper/'
 import cdn_container
 STATIC_URL = cdn_container.CDN_CONTAINER + '/' + 'wwwhisper/'
 
+# A directory to which each wwwhisper process periodically dumps its
+# metrics. If set, metrics exported by /wwwhisper/metrics are
+# aggregated from all uWSGI workers (the directory should be
+# private to the site's wwwhisper instance).
+WWWHISPER_METRICS_DIR = None
+# A directory to which the sampling profiler writes per endpoint
+# pstats files. Profiler is disabled if not set. Profiling can be
+# enabled at runtime by creating an 'enabled' file in the directory.
+WWWHISPER_PROFILE_DIR = None
+WWWHISPER_PROFILE_ENABLED = False
+# Fraction of requests that are profiled.
+WWWHISPER_PROFILE_SAMPLE_RATE = 0.01
+
+# If set, is-authorized responses allow nginx to cache auth decisions
+# for the given number of seconds (see the commented out uwsgi_cache
+# configuration in nginx/wwwhisper.conf). Changes to access rights
+# take effect only after cached decisions expire.
+WWWHISPER_AUTH_CACHE_TTL = None
+# If set, decisions of auth requests are logged to files in the given
+# directory, or, if set to 'db', to the DB (see
+# wwwhisper_auth/audit.py). Records are written in background, with
+# a delay of up to WWWHISPER_AUDIT_FLUSH_INTERVAL seconds.
+WWWHISPER_AUDIT_LOG = None
+WWWHISPER_AUDIT_FLUSH_INTERVAL = 1
+# Max number of records buffered by a process, records above the
+# limit are only sampled.
+WWWHISPER_AUDIT_BUFFER_SIZE = 10000
+# If set, each process counts accesses of users to locations in memory
+# and adds the counts to the DB every given number of seconds (see
+# wwwhisper_auth/access_counters.py). Admin API then returns
+# approximate hits and last seen times of locations and users.
+WWWHISPER_ACCESS_COUNTERS_FLUSH_INTERVAL = None
+
 import os
 import sys
 
 TESTING = sys.argv[1:2] == ['test']
 
+# Load sites into the cache when the application starts (before
+# uWSGI forks workers). /wwwhisper/ready reports the process as ready
+# only after the warm-up completes.
+WWWHISPER_PRELOAD_SITES = not TESTING
+# Load sites in background, while the application already handles
+# requests (useful with uWSGI --lazy-apps, when each worker loads the
+# application itself).
+WWWHISPER_WARM_UP_IN_BACKGROUND = False
+# Max number of threads (and DB connections) used by the warm-up.
+WWWHISPER_WARM_UP_CONCURRENCY = 4
+# If set, requests do not check if cached sites are up to date,
+# instead a background thread checks this every given number of
+# seconds and replaces modified sites with reloaded ones. Requests
+# never wait for a reload, but changes made by other processes are
+# visible with a delay of up to the interval.
+WWWHISPER_REFRESH_INTERVAL = None
+# If set, when a request finds that a cached site was modified, the
+# site is reloaded in background and the request (and requests that
+# follow for up to the given number of seconds) uses the previous
+# version of the site. Changes that revoke access (user, location or
+# permission removal) are never served stale.
+WWWHISPER_STALE_GRACE = None
+# If set, a directory for lock files that allow only one process at a
+# time to load a site (for example, after an admin change one uWSGI
+# worker loads the site from the DB, and other workers, one by one,
+# from the file stored by the first one). Requires
+# WWWHISPER_SNAPSHOT_CACHE_DIR.
+WWWHISPER_RELOAD_LOCK_DIR = None
+# If set, a directory in which loaded sites are stored, so restarted
+# workers load sites from disk instead of the DB, as long as the
+# sites were not modified (see wwwhisper_auth/snapshot_cache.py).
+WWWHISPER_SNAPSHOT_CACHE_DIR = None
+# If set, a single wwwhisper instance serves all sites from the DB, a
+# site of a request is found by the Site-Url header (see
+# MultiTenantSiteMiddleware). Otherwise, the instance serves only the
+# site with SINGLE_SITE_ID.
+WWWHISPER_MULTI_TENANT = False
+# If set, each process deletes expired users and permissions from the
+# DB every given number of seconds (see wwwhisper_auth/expiry.py).
+# Expired items are denied access even before they are deleted.
+WWWHISPER_EXPIRY_SWEEP_INTERVAL = None
+
 if TESTING:
     from test_site_settings import *
 else:
@@ -71,11 +146,18 @@ USE_X_FORWARDED_HOST = True
 # X-Forwarded-Host. Host header is not used.
 ALLOWED_HOSTS = ['*']
 
+if WWWHISPER_MULTI_TENANT:
+    SET_SITE_MIDDLEWARE = 'wwwhisper_auth.middleware.MultiTenantSiteMiddleware'
+else:
+    SET_SITE_MIDDLEWARE = 'wwwhisper_auth.middleware.SetSiteMiddleware'
+
 MIDDLEWARE_CLASSES = [
-    #'wwwhisper_service.profile.ProfileMiddleware',
+    # Must go first to measure time spent in all other middlewares.
+    'wwwhisper_auth.middleware.MetricsMiddleware',
+    'wwwhisper_service.profile.ProfileMiddleware',
     # Must go before CommonMiddleware, to set a correct url to which
     # CommonMiddleware redirects.
-    'wwwhisper_auth.middleware.SetSiteMiddleware',
+    SET_SITE_MIDDLEWARE,
     'wwwhisper_auth.middleware.SiteUrlMiddleware',
     'django.middleware.common.CommonMiddleware',
     # Must be placed before session middleware to alter session cookies.
@@ -6,5 +6,11 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': '/tmp/wwwhisper_test_db',
+        # File (not in-memory) test DB is visible to all threads,
+        # which allows to test code that accesses the DB from
+        # background threads.
+        'TEST': {
+            'NAME': '/tmp/wwwhisper_test_db_test',
+        },
     }
 }
@@ -22,4 +22,5 @@ os.environ.setdefault("DJANGO_SETTINGS_MODULE", "wwwhisper_service.settings")
 # setting points here.
 # Apply WSGI middleware here.
 from django.core.wsgi import get_wsgi_application
-application = get_wsgi_application()
+from wwwhisper_service.internal import InternalEndpoints
+application = InternalEndpoints(get_wsgi_application())